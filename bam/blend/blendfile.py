@@ -20,16 +20,141 @@
 # (c) 2014, Blender Foundation - Campbell Barton
 
 import os
+import sys
 import struct
 import logging
 import gzip
 import tempfile
+import collections
+import threading
+import array
+import bisect
 
 log = logging.getLogger("blendfile")
 log.setLevel(logging.ERROR)
 
 FILE_BUFFER_SIZE = 1024 * 1024
 
+# compressed files opened read-only are decompressed into memory,
+# above this size a temporary file is used instead.
+DECOMPRESS_MEMORY_LIMIT = 512 * 1024 * 1024
+
+# total size of decompressed files to keep in memory between opening files,
+# zero disables.
+DECOMPRESS_CACHE_LIMIT = 256 * 1024 * 1024
+
+# modified compressed files are compressed on close using multiple threads,
+# each thread compresses chunks of this size.
+COMPRESS_LEVEL = 9
+# zero to use all CPU's
+COMPRESS_THREADS = 0
+COMPRESS_CHUNK_SIZE = 1024 * 1024
+
+# IOStats, when set, I/O and decoding is counted (see 'stats_enable').
+_stats = None
+
+
+# -----------------------------------------------------------------------------
+# I/O statistics
+#
+# Opt-in counters for profiling, so we can tell if time is spent on raw I/O,
+# pointer chasing or decoding.
+
+class IOStats:
+    """
+    Counters for blend file reading (shared by all files opened while enabled).
+    """
+    __slots__ = (
+        # blend files opened
+        "files",
+        # file handle seek calls
+        "seeks",
+        # file handle read calls (including positional reads)
+        "reads",
+        # bytes read from file handles (memory and memory mapped access isn't counted)
+        "bytes_read",
+        # {code: count} block objects created
+        "blocks",
+        # {code: count} field values decoded
+        "fields",
+        # block address lookups (pointer chasing)
+        "lookups",
+        # DNA catalogs decoded (cache misses)
+        "dna_decode",
+        # DNA catalogs found in the cache
+        "dna_cache_hit",
+        # seconds spent decoding DNA catalogs
+        "dna_decode_time",
+        )
+
+    def __init__(self):
+        self.files = 0
+        self.seeks = 0
+        self.reads = 0
+        self.bytes_read = 0
+        self.blocks = collections.Counter()
+        self.fields = collections.Counter()
+        self.lookups = 0
+        self.dna_decode = 0
+        self.dna_cache_hit = 0
+        self.dna_decode_time = 0.0
+
+    def read_add(self, size):
+        self.reads += 1
+        self.bytes_read += size
+
+    def as_dict(self):
+        return {
+            "files": self.files,
+            "seeks": self.seeks,
+            "reads": self.reads,
+            "bytes_read": self.bytes_read,
+            "blocks": {code.decode('ascii'): count for code, count in sorted(self.blocks.items())},
+            "fields": {code.decode('ascii'): count for code, count in sorted(self.fields.items())},
+            "lookups": self.lookups,
+            "dna_decode": self.dna_decode,
+            "dna_cache_hit": self.dna_cache_hit,
+            "dna_decode_time": self.dna_decode_time,
+            }
+
+    def report(self):
+        """
+        Return the statistics as text (for printing).
+        """
+        lines = [
+            "files: %d" % self.files,
+            "seeks: %d" % self.seeks,
+            "reads: %d (%d bytes)" % (self.reads, self.bytes_read),
+            "blocks: %d" % sum(self.blocks.values()),
+            ]
+        lines.extend("    %s: %d" % (code.decode('ascii'), count) for code, count in sorted(self.blocks.items()))
+        lines.append("fields: %d" % sum(self.fields.values()))
+        lines.extend("    %s: %d" % (code.decode('ascii'), count) for code, count in sorted(self.fields.items()))
+        lines.append("lookups: %d" % self.lookups)
+        lines.append("dna decode: %d (%.4f sec), cached: %d" % (self.dna_decode, self.dna_decode_time, self.dna_cache_hit))
+        return "\n".join(lines)
+
+
+def stats_enable():
+    """
+    Start counting I/O and decoding, returns the :class:`IOStats`.
+    """
+    global _stats
+    _stats = IOStats()
+    return _stats
+
+
+def stats_disable():
+    global _stats
+    _stats = None
+
+
+def stats_get():
+    """
+    Return the active :class:`IOStats` or None.
+    """
+    return _stats
+
 
 # -----------------------------------------------------------------------------
 # module global routines
@@ -38,10 +163,18 @@ FILE_BUFFER_SIZE = 1024 * 1024
 # open a filename
 # determine if the file is compressed
 # and returns a handle
-def open_blend(filename, access="rb"):
+def open_blend(filename, access="rb", use_mmap=False, use_journal=False):
     """Opens a blend file for reading or writing pending on the access
     supports 2 kind of blend files. Uncompressed and compressed.
     Known issue: does not support packaged blend files
+
+    When ``use_mmap`` is enabled the file is memory mapped,
+    block headers, DNA and field values are decoded directly from the mapping
+    (avoiding seek/read calls for every access).
+
+    When ``use_journal`` is enabled (and the file isn't memory mapped),
+    changes are kept in memory and written in a single sorted pass on close,
+    instead of writing each change as it's made.
     """
     handle = open(filename, access)
     magic_test = b"BLENDER"
@@ -49,27 +182,68 @@ def open_blend(filename, access="rb"):
     if magic == magic_test:
         log.debug("normal blendfile detected")
         handle.seek(0, os.SEEK_SET)
-        bfile = BlendFile(handle)
+        bfile = BlendFile(handle, data=_mmap_from_handle(handle, access) if use_mmap else None)
         bfile.is_compressed = False
         bfile.filepath_orig = filename
+        if use_journal and bfile.data is None:
+            bfile.journal = BlendFileJournal()
         return bfile
     elif magic[:2] == b'\x1f\x8b':
         log.debug("gzip blendfile detected")
+        if access == "rb":
+            # re-opening the same library, skip decompressing
+            cache_key = DecompressCache.key_from_handle(filename, handle)
+            data_mem = DecompressCache.get(cache_key)
+            if data_mem is not None:
+                log.debug("decompressed blendfile found in cache")
+                handle.close()
+                bfile = BlendFile(None, data=data_mem)
+                bfile.is_compressed = True
+                bfile.filepath_orig = filename
+                return bfile
         handle.close()
         log.debug("decompressing started")
         fs = gzip.open(filename, "rb")
         data = fs.read(FILE_BUFFER_SIZE)
         magic = data[:len(magic_test)]
         if magic == magic_test:
-            handle = tempfile.TemporaryFile()
-            while data:
-                handle.write(data)
-                data = fs.read(FILE_BUFFER_SIZE)
+            handle = None
+            if access == "rb":
+                # read-only, decompress into memory and parse the buffer directly
+                # (unless it exceeds the limit, then continue into a temp file).
+                data_mem = []
+                data_mem_len = 0
+                while data and (data_mem_len + len(data) <= DECOMPRESS_MEMORY_LIMIT):
+                    data_mem.append(data)
+                    data_mem_len += len(data)
+                    data = fs.read(FILE_BUFFER_SIZE)
+                if data:
+                    log.debug("decompressing exceeds memory limit, using a temp file")
+                    handle = tempfile.TemporaryFile()
+                    for data_chunk in data_mem:
+                        handle.write(data_chunk)
+                    del data_mem
+                else:
+                    # immutable, so it can be shared between files
+                    data_mem = b''.join(data_mem)
+            else:
+                handle = tempfile.TemporaryFile()
+
+            if handle is not None:
+                while data:
+                    handle.write(data)
+                    data = fs.read(FILE_BUFFER_SIZE)
             log.debug("decompressing finished")
             fs.close()
-            log.debug("resetting decompressed file")
-            handle.seek(os.SEEK_SET, 0)
-            bfile = BlendFile(handle)
+            if handle is None:
+                DecompressCache.add(cache_key, data_mem)
+                bfile = BlendFile(None, data=data_mem)
+            else:
+                log.debug("resetting decompressed file")
+                handle.seek(os.SEEK_SET, 0)
+                bfile = BlendFile(handle, data=_mmap_from_handle(handle, access) if use_mmap else None)
+                if use_journal and bfile.data is None:
+                    bfile.journal = BlendFileJournal()
             bfile.is_compressed = True
             bfile.filepath_orig = filename
             return bfile
@@ -79,6 +253,119 @@ def open_blend(filename, access="rb"):
         raise Exception("filetype not a blend or a gzip blend")
 
 
+def probe(filepath):
+    """
+    Return a :class:`BlendFileProbe` summary of a blend file (for listings),
+    only reading the block headers, the libraries & images,
+    and the parts of the DNA needed to read them.
+
+    This is much faster than :func:`open_blend` since the block table,
+    address lookup and full DNA catalog aren't created.
+    """
+    handle = open(filepath, 'rb')
+    try:
+        is_compressed = (handle.read(2) == b'\x1f\x8b')
+        if is_compressed:
+            handle.close()
+            handle = gzip.open(filepath, 'rb')
+        else:
+            handle.seek(0, os.SEEK_SET)
+        return BlendFileProbe.from_handle(handle, filepath, is_compressed)
+    finally:
+        handle.close()
+
+
+def _gzip_write_parallel(handle, filepath, level, threads):
+    """
+    Compress the contents of handle (from the current position) into a gzip file,
+    compressing chunks in parallel (as pigz does).
+
+    Each chunk is compressed as raw deflate data, ending on a byte boundary,
+    using the end of the previous chunk as a dictionary,
+    the chunks are joined into a single (regular) gzip stream.
+    """
+    import zlib
+    from concurrent.futures import ThreadPoolExecutor
+
+    # the deflate window size, the dictionary used by each chunk.
+    DICT_SIZE = 32 * 1024
+
+    def compress_chunk(data, zdict, is_last):
+        if zdict:
+            compress = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0, zdict)
+        else:
+            compress = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compress.compress(data) + compress.flush(zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH)
+
+    if threads <= 0:
+        threads = os.cpu_count() or 1
+
+    crc = 0
+    size = 0
+    with open(filepath, "wb") as fs, ThreadPoolExecutor(max_workers=threads) as executor:
+        # header: magic, deflate, no flags, no mtime, no extra flags, unknown OS
+        fs.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+
+        # compressed chunks are written in order,
+        # keep a limited number queued so the whole file isn't read into memory.
+        pending = collections.deque()
+        zdict = b''
+        data = handle.read(COMPRESS_CHUNK_SIZE)
+        while True:
+            data_next = handle.read(COMPRESS_CHUNK_SIZE)
+            is_last = not data_next
+            pending.append(executor.submit(compress_chunk, data, zdict, is_last))
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            if is_last:
+                break
+            zdict = data[-DICT_SIZE:]
+            data = data_next
+            if len(pending) >= threads * 2:
+                fs.write(pending.popleft().result())
+
+        while pending:
+            fs.write(pending.popleft().result())
+
+        fs.write(struct.pack(b'<II', crc & 0xffffffff, size & 0xffffffff))
+
+
+def _mmap_from_handle(handle, access):
+    import mmap
+    return mmap.mmap(
+            handle.fileno(), 0,
+            access=mmap.ACCESS_READ if access == "rb" else mmap.ACCESS_WRITE,
+            )
+
+
+# positional reads/writes (don't use the file position),
+# so a single BlendFile can be read from multiple threads.
+if hasattr(os, "pread"):
+    def _pread(handle, size, offset):
+        if _stats is not None:
+            _stats.read_add(size)
+        return os.pread(handle.fileno(), size, offset)
+
+    def _pwrite(handle, data, offset):
+        os.pwrite(handle.fileno(), data, offset)
+else:
+    _handle_lock = threading.Lock()
+
+    def _pread(handle, size, offset):
+        if _stats is not None:
+            _stats.seeks += 1
+            _stats.read_add(size)
+        with _handle_lock:
+            handle.seek(offset, os.SEEK_SET)
+            return handle.read(size)
+
+    def _pwrite(handle, data, offset):
+        with _handle_lock:
+            handle.seek(offset, os.SEEK_SET)
+            handle.write(data)
+            handle.flush()
+
+
 def align(offset, by):
     n = by - 1
     return (offset + n) & ~n
@@ -93,57 +380,223 @@ class BlendFile:
     Blend file.
     """
     __slots__ = (
-        # file (result of open())
+        # file (result of open()) or None for in-memory files
         "handle",
+        # mmap, bytes or None (when set, reads use offsets into this buffer)
+        "data",
         # str (original name of the file path)
         "filepath_orig",
         # BlendFileHeader
         "header",
         # struct.Struct
         "block_header_struct",
-        # BlendFileBlock
+        # BlendFileBlockTable (sequence of BlendFileBlock)
         "blocks",
         # [DNAStruct, ...]
         "structs",
         # dict {b'StructName': sdna_index}
         # (where the index is an index into 'structs')
         "sdna_index_from_id",
-        # dict {addr_old: block}
+        # BlendFileBlockAddrMap (mapping like {addr_old: block})
         "block_from_offset",
-        # int
+        # dict {code: BlendFileBlockList}
         "code_index",
         # bool (did we make a change)
         "is_modified",
         # bool (is file gzipped)
         "is_compressed",
+        # dict {(sdna_index, path): DNAFieldAccessor or None}
+        "field_accessors",
+        # BlendFileJournal or None (when set, writes are deferred until closing)
+        "journal",
+        # dict {code: {id_name: block}} (created on demand, see id_name_index)
+        "id_name_indices",
+        # dict {addr_old: [(block, path), ...]} (created on demand, see pointer_index)
+        "pointer_references",
         )
 
-    def __init__(self, handle):
+    def __init__(self, handle, data=None):
         log.debug("initializing reading blend-file")
         self.handle = handle
-        self.header = BlendFileHeader(handle)
+        self.data = data
+        self.header = BlendFileHeader(handle, data)
         self.block_header_struct = self.header.create_block_header_struct()
-        self.blocks = []
+        self.blocks = BlendFileBlockTable(self)
         self.code_index = {}
+        self.field_accessors = {}
+        self.journal = None
+        self.id_name_indices = {}
+        self.pointer_references = None
 
-        block = BlendFileBlock(handle, self)
-        while block.code != b'ENDB':
-            if block.code == b'DNA1':
-                (self.structs,
-                 self.sdna_index_from_id,
-                 ) = BlendFile.decode_structs(self.header, block, handle)
+        if _stats is not None:
+            _stats.files += 1
+
+        self._read_block_headers()
+        self.is_modified = False
+
+        # lookups are created on first use
+        self.block_from_offset = BlendFileBlockAddrMap(self.blocks)
+
+    def _read_block_headers(self):
+        """
+        Read all block headers into the block table (in a single pass),
+        the DNA is decoded when its found.
+
+        When reading from a file handle, headers are read in chunks
+        (only reading again when the next header is past the end of the chunk).
+        """
+        OLDBLOCK = struct.Struct(b'4sI')
+        # large enough to include the headers of many small blocks,
+        # chunks never overlap, so no more than the file size is read.
+        CHUNK_SIZE = 64 * 1024
+
+        handle = self.handle
+        data = self.data
+        table = self.blocks
+        header_struct = self.block_header_struct
+        header_size = header_struct.size
+
+        # {code_raw: code_id}
+        code_id_from_raw = {}
+        # [array, ...] block indices for each code_id
+        code_indices = []
+
+        offset = BlendFileHeader.FILEHEADER.size
+        if data is not None:
+            data_len = len(data)
+        else:
+            # the chunk read from the handle & its offset in the file
+            chunk = b''
+            chunk_offset = offset
+            chunk_end = offset
+
+        # I/O statistics (handle reads & seeks).
+        stats_reads = stats_seeks = stats_bytes = 0
+        dna_found = False
+
+        while True:
+            if data is None:
+                if offset + header_size > chunk_end:
+                    if offset != chunk_end:
+                        handle.seek(offset, os.SEEK_SET)
+                        stats_seeks += 1
+                    chunk = handle.read(CHUNK_SIZE)
+                    chunk_offset = offset
+                    chunk_end = offset + len(chunk)
+                    stats_reads += 1
+                    stats_bytes += len(chunk)
+                header = chunk
+                header_offset = offset - chunk_offset
+                header_len = min(chunk_end - offset, header_size)
             else:
-                handle.seek(block.size, os.SEEK_CUR)
+                header = data
+                header_offset = offset
+                header_len = min(data_len - offset, header_size)
+
+            # header size can be 8, 20, or 24 bytes long
+            # 8: old blend files ENDB block (exception)
+            # 20: normal headers 32 bit platform
+            # 24: normal headers 64 bit platform
+            if header_len < header_size:
+                # only the ENDB block is expected here, otherwise the file is truncated
+                if ((header_len < OLDBLOCK.size) or
+                        (DNA_IO.read_data0(OLDBLOCK.unpack_from(header, header_offset)[0]) != b'ENDB')):
+                    raise Exception("blend file ended before the ENDB block")
+                break
+
+            code_raw, size, addr_old, sdna_index, count = header_struct.unpack_from(header, header_offset)
+            if code_raw == b'ENDB':
+                break
+            offset += header_size
+
+            code_id = code_id_from_raw.get(code_raw)
+            if code_id is None:
+                code_id = code_id_from_raw[code_raw] = table.code_id_ensure(code_raw.partition(b'\0')[0])
+                while len(code_indices) <= code_id:
+                    code_indices.append(array.array('I'))
+            code_indices[code_id].append(len(table))
+            table.append(code_id, size, addr_old, sdna_index, count, offset)
+
+            if code_raw == b'DNA1':
+                if data is None:
+                    if offset + size <= chunk_end:
+                        dna_data = chunk[offset - chunk_offset:offset - chunk_offset + size]
+                    else:
+                        if offset != chunk_end:
+                            handle.seek(offset, os.SEEK_SET)
+                            stats_seeks += 1
+                        dna_data = handle.read(size)
+                        stats_reads += 1
+                        stats_bytes += size
+                        # the next header is read from a new chunk
+                        chunk_end = offset + size
+                        if len(dna_data) != size:
+                            raise Exception("blend file ended before the ENDB block")
+                    (self.structs,
+                     self.sdna_index_from_id,
+                     ) = DNACache.decode_structs(self.header, dna_data, 0, size)
+                elif offset + size > data_len:
+                    raise Exception("blend file ended before the ENDB block")
+                elif isinstance(data, memoryview):
+                    # decoding needs 'find', copy the DNA (it's small)
+                    (self.structs,
+                     self.sdna_index_from_id,
+                     ) = DNACache.decode_structs(self.header, bytes(data[offset:offset + size]), 0, size)
+                else:
+                    (self.structs,
+                     self.sdna_index_from_id,
+                     ) = DNACache.decode_structs(self.header, data, offset, size)
+                dna_found = True
 
-            self.blocks.append(block)
-            self.code_index.setdefault(block.code, []).append(block)
+            offset += size
 
-            block = BlendFileBlock(handle, self)
-        self.is_modified = False
-        self.blocks.append(block)
+        if _stats is not None and data is None:
+            _stats.reads += stats_reads
+            _stats.seeks += stats_seeks
+            _stats.bytes_read += stats_bytes
+
+        if not dna_found:
+            raise Exception("blend file has no DNA1 block")
 
-        # cache (could lazy init, incase we never use?)
-        self.block_from_offset = {block.addr_old: block for block in self.blocks if block.code != b'ENDB'}
+        # the ENDB block isn't included in the code index (or offset lookups).
+        table.append(table.code_id_ensure(b'ENDB'), 0, 0, 0, 0, 0)
+
+        for code_id, indices in enumerate(code_indices):
+            if indices:
+                self.code_index[table.codes[code_id]] = BlendFileBlockList(table, indices)
+
+    @staticmethod
+    def from_buffer(data, filepath=None):
+        """
+        Return a blend file read from memory (bytes, bytearray or memoryview),
+        compressed data is decompressed.
+
+        The buffer isn't copied, changes are written into it when it's writable.
+        ``filepath`` is only for reference (stored as ``filepath_orig``).
+        """
+        if isinstance(data, memoryview) and data.format != 'B':
+            data = data.cast('B')
+
+        is_compressed = bytes(data[:2]) == b'\x1f\x8b'
+        if is_compressed:
+            log.debug("decompressing buffer")
+            data = gzip.decompress(data)
+
+        if bytes(data[:7]) != b'BLENDER':
+            raise Exception("filetype not a blend or a gzip blend")
+
+        bfile = BlendFile(None, data=data)
+        bfile.is_compressed = is_compressed
+        bfile.filepath_orig = filepath
+        return bfile
+
+    @staticmethod
+    def from_zip(zip_handle, member):
+        """
+        Return a blend file read from a member of a :class:`zipfile.ZipFile`
+        (without extracting it to disk).
+        """
+        return BlendFile.from_buffer(zip_handle.read(member), filepath=member)
 
     def find_blocks_from_code(self, code):
         assert(type(code) == bytes)
@@ -157,11 +610,282 @@ class BlendFile:
         assert(type(offset) is int)
         return self.block_from_offset.get(offset)
 
-    def close(self):
+    def find_blocks_from_offsets(self, offsets):
+        """
+        Return a list of blocks for a sequence of addresses
+        (None for addresses that aren't found),
+        resolved in a single pass over the address index.
+        """
+        return self.block_from_offset.get_many(offsets)
+
+    def id_name_index(self, code):
+        """
+        Return a dict ``{id_name: block}`` for the ID blocks of this code (in file order).
+
+        The names are read directly from the block table on first access,
+        so filtering blocks by name doesn't need to access each blocks fields.
+        """
+        try:
+            return self.id_name_indices[code]
+        except KeyError:
+            pass
+
+        index = self.id_name_indices[code] = {}
+        code_blocks = self.code_index.get(code)
+        if code_blocks is None:
+            return index
+
+        table = self.blocks
+        table_sdna_index = table.sdna_index
+        table_file_offset = table.file_offset
+        data = self.data
+        read_data0 = DNA_IO.read_data0
+        # {sdna_index: (offset, size)}
+        name_fields = {}
+        for i in code_blocks.indices:
+            sdna_index = table_sdna_index[i]
+            name_field = name_fields.get(sdna_index)
+            if name_field is None:
+                accessor = self.field_accessor(sdna_index, b'id.name')
+                if accessor is None:
+                    raise KeyError("'id.name' not found in %r" % self.structs[sdna_index].dna_type_id)
+                name_field = name_fields[sdna_index] = (accessor.offset, accessor.field.dna_name.array_size)
+            offset = table_file_offset[i] + name_field[0]
+            if data is not None:
+                name = read_data0(bytes(data[offset:offset + name_field[1]]))
+            else:
+                name = read_data0(self.read_at(offset, name_field[1]))
+            index[name] = table[i]
+        return index
+
+    def pointer_index(self):
+        """
+        Return a dict ``{addr_old: [(block, path), ...]}`` of the pointer fields referencing each block.
+
+        The ID list & runtime pointers (``id.next``, ``id.prev``... see ``DNAStruct.ID_LINK_POINTERS``)
+        aren't included, since they don't reference the ID's they point to.
+
+        Created on first use, reading the pointer fields of every block (using the DNA) in a single pass.
+        Blocks with multiple items are listed once for each item referencing the address.
+
+        Raw data blocks (written without a struct type) are only read when a pointer to a pointer array
+        references them (``**mat`` for example), then each item is listed as referenced by that field.
+        """
+        index = self.pointer_references
+        if index is not None:
+            return index
+
+        index = {}
+        table = self.blocks
+        header = self.header
+        structs = self.structs
+        data = self.data
+        addr_all = set(table.addr_old)
+        # NULL pointers (blocks such as 'ENDB' have no address)
+        addr_all.discard(0)
+        # {sdna_index: (struct.Struct, paths, is_pointer_array) or None}
+        layouts = {}
+
+        for i in range(len(table)):
+            sdna_index = table.sdna_index[i]
+            # raw data (pointer arrays, vertices... etc)
+            if sdna_index == 0:
+                continue
+            try:
+                layout = layouts[sdna_index]
+            except KeyError:
+                layout = layouts[sdna_index] = structs[sdna_index].pointer_layout(
+                        header, DNAStruct.pointer_is_reference)
+            if layout is None:
+                continue
+            st, paths, is_pointer_array = layout
+
+            struct_size = structs[sdna_index].size
+            if data is not None:
+                buf, buf_offset = data, table.file_offset[i]
+            else:
+                buf, buf_offset = self.read_at(table.file_offset[i], table.size[i]), 0
+            block = None
+            for item_index in range(min(table.count[i], table.size[i] // struct_size)):
+                values = st.unpack_from(buf, buf_offset + (item_index * struct_size))
+                for field_index, addr in enumerate(values):
+                    if addr not in addr_all:
+                        continue
+                    if block is None:
+                        block = table[i]
+                    path = paths[field_index]
+                    index.setdefault(addr, []).append((block, path))
+                    if is_pointer_array[field_index]:
+                        block_array = self.find_block_from_offset(addr)
+                        if block_array.sdna_index == 0:
+                            for addr_item in self.read_pointers(
+                                    block_array.file_offset, block_array.size // header.pointer_size):
+                                if addr_item in addr_all:
+                                    index.setdefault(addr_item, []).append((block, path))
+
+        self.pointer_references = index
+        return index
+
+    def find_blocks_referencing(self, offset):
+        """
+        Return a list of ``(block, path)`` pairs for the pointers to this address
+        (see :meth:`pointer_index`).
+        """
+        return self.pointer_index().get(offset, [])
+
+    def find_id_references(self, block, pointer_exclude=None):
+        """
+        Return a list of the ID blocks referenced by this ID block (without duplicates),
+        found by following the pointers of the ID and the data it owns.
+
+        Only pointers which may lead to an ID are read, directly from the block data,
+        using a table created once for each DNA (see :meth:`DNACache.id_pointer_table`).
+        Linked ID placeholders (``b'ID'`` blocks) are included, the ID's library isn't.
+
+        ``pointer_exclude`` is an optional dict of pointers not to follow
+        ``{(struct_name, path): test}``, where ``test`` is None to always skip the pointer,
+        otherwise a callback ``test(block, base_index) -> bool`` to skip it for some items.
+        """
+        layouts = DNACache.id_pointer_table(self.structs, self.header)
+        structs = self.structs
+        data = self.data
+        pointer_size = self.header.pointer_size
+        table = self.blocks
+        codes = table.codes
+        code_id = table.code_id
+        sdna_index_all = table.sdna_index
+        index_from_offset = table.index_from_offset
+
+        # {sdna_index: {field_index: test}}
+        exclude = {}
+        if pointer_exclude:
+            sdna_index_from_id = self.sdna_index_from_id
+            for (struct_name, path), test in pointer_exclude.items():
+                sdna_index = sdna_index_from_id.get(struct_name)
+                if sdna_index is None or layouts[sdna_index] is None:
+                    continue
+                paths = layouts[sdna_index][1]
+                if path in paths:
+                    exclude.setdefault(sdna_index, {})[paths.index(path)] = test
+
+        block_index = index_from_offset(block.addr_old)
+        # block indices of the ID's found & data blocks which have been read
+        id_visit = {block_index}
+        ids = []
+        data_visit = {block_index}
+        stack = [block_index]
+
+        def follow(index, is_pointer_array):
+            sdna_index = sdna_index_all[index]
+            if sdna_index == 0:
+                # raw data, only read for pointer arrays
+                if is_pointer_array:
+                    for addr_item in self.read_pointers(table.file_offset[index], table.size[index] // pointer_size):
+                        if addr_item != 0:
+                            index_item = index_from_offset(addr_item)
+                            if index_item != -1 and sdna_index_all[index_item] != 0:
+                                follow(index_item, False)
+            elif len(codes[code_id[index]]) == 2:
+                if index not in id_visit:
+                    id_visit.add(index)
+                    ids.append(index)
+            elif index not in data_visit and layouts[sdna_index] is not None:
+                data_visit.add(index)
+                stack.append(index)
+
+        while stack:
+            index = stack.pop()
+            sdna_index = sdna_index_all[index]
+            layout = layouts[sdna_index]
+            if layout is None:
+                continue
+            st, _paths, is_pointer_array = layout
+            exclude_fields = exclude.get(sdna_index)
+            struct_size = structs[sdna_index].size
+            size = table.size[index]
+            if data is not None:
+                buf, buf_offset = data, table.file_offset[index]
+            else:
+                buf, buf_offset = self.read_at(table.file_offset[index], size), 0
+            for item_index in range(min(table.count[index], size // struct_size)):
+                values = st.unpack_from(buf, buf_offset + (item_index * struct_size))
+                for field_index, addr in enumerate(values):
+                    if addr != 0:
+                        if exclude_fields is not None and field_index in exclude_fields:
+                            test = exclude_fields[field_index]
+                            if test is None or test(table[index], item_index):
+                                continue
+                        index_ref = index_from_offset(addr)
+                        if index_ref != -1:
+                            follow(index_ref, is_pointer_array[field_index])
+
+        return [table[index] for index in ids]
+
+    def read_pointers(self, offset, count):
+        """
+        Read an array of pointers at offset (a single copy).
+        """
+        size = count * self.header.pointer_size
+        data = self.data
+        if data is not None:
+            data = data[offset:offset + size]
+        else:
+            data = self.read_at(offset, size)
+        if len(data) != size:
+            raise struct.error("unpack requires a buffer of %d bytes" % size)
+        return DNA_IO.read_pointers(data, self.header)
+
+    def read_at(self, offset, size):
+        """
+        Read bytes at offset, without using the file position
+        (safe to call from multiple threads).
+        """
+        data = self.data
+        if data is not None:
+            return bytes(data[offset:offset + size])
+        data = _pread(self.handle, size, offset)
+        if self.journal:
+            data = self.journal.apply(offset, data)
+        return data
+
+    def field_accessor(self, sdna_index, path):
+        """
+        Return a :class:`DNAFieldAccessor` for the path in this struct
+        (or None when the path isn't found).
+
+        The path is only resolved once per struct.
+        """
+        key = (sdna_index, path)
+        try:
+            return self.field_accessors[key]
+        except KeyError:
+            pass
+        accessor = self.structs[sdna_index].field_accessor_from_path(self.header, path)
+        self.field_accessors[key] = accessor
+        return accessor
+
+    def close(self, compress_level=None, compress_threads=None):
         """
         Close the blend file
         writes the blend file to disk if changes has happened
+
+        Compressed files are written using ``compress_level`` and ``compress_threads``,
+        (defaulting to ``COMPRESS_LEVEL`` and ``COMPRESS_THREADS``).
         """
+        if self.handle is None:
+            # in-memory, nothing to write back to
+            self.data = None
+            return
+
+        if self.data is not None:
+            if self.is_modified:
+                self.data.flush()
+            self.data.close()
+            self.data = None
+
+        if self.journal is not None:
+            self.journal_flush()
+
         if not self.is_modified:
             self.handle.close()
         else:
@@ -170,16 +894,42 @@ class BlendFile:
                 log.debug("close compressed blend file")
                 handle.seek(os.SEEK_SET, 0)
                 log.debug("compressing started")
-                fs = gzip.open(self.filepath_orig, "wb")
-                data = handle.read(FILE_BUFFER_SIZE)
-                while data:
-                    fs.write(data)
-                    data = handle.read(FILE_BUFFER_SIZE)
-                fs.close()
+                _gzip_write_parallel(
+                        handle, self.filepath_orig,
+                        COMPRESS_LEVEL if compress_level is None else compress_level,
+                        COMPRESS_THREADS if compress_threads is None else compress_threads,
+                        )
                 log.debug("compressing finished")
 
             handle.close()
 
+    def write_at(self, offset, data):
+        """
+        Write bytes at offset (into the journal when its used).
+        """
+        self.is_modified = True
+        if self.id_name_indices:
+            # names may have changed
+            self.id_name_indices.clear()
+        if self.data is not None:
+            self.data[offset:offset + len(data)] = data
+        elif self.journal is not None:
+            self.journal.add(offset, data)
+        else:
+            _pwrite(self.handle, data, offset)
+
+    def journal_flush(self):
+        """
+        Write all changes from the journal to the file, in order.
+        """
+        journal = self.journal
+        if journal:
+            log.debug("writing %d journal changes" % len(journal))
+            handle = self.handle
+            for offset, data in journal.iter_runs():
+                _pwrite(handle, data, offset)
+            journal.clear()
+
     def ensure_subtype_smaller(self, sdna_index_curr, sdna_index_next):
         # never refine to a smaller type
         if (self.structs[sdna_index_curr].size >
@@ -194,19 +944,41 @@ class BlendFile:
         """
         DNACatalog is a catalog of all information in the DNA1 file-block
         """
+        data = DNA_IO.read_bytes(handle, block.size)
+        return BlendFile.decode_structs_from_buffer(header, data, 0)
+
+    @staticmethod
+    def decode_structs_from_buffer(header, data, offset, struct_ids=None):
+        """
+        Decode the DNA1 file-block,
+        where offset is the start of the block data within the buffer.
+
+        When ``struct_ids`` is given, only the fields of these structs are decoded
+        (other structs have no fields), the catalog must not be cached.
+        """
+        if _stats is not None:
+            import time
+            time_start = time.perf_counter()
+            result = BlendFile._decode_structs_from_buffer(header, data, offset, struct_ids)
+            _stats.dna_decode += 1
+            _stats.dna_decode_time += time.perf_counter() - time_start
+            return result
+        return BlendFile._decode_structs_from_buffer(header, data, offset, struct_ids)
+
+    @staticmethod
+    def _decode_structs_from_buffer(header, data, offset, struct_ids=None):
         log.debug("building DNA catalog")
         shortstruct = DNA_IO.USHORT[header.endian_index]
         shortstruct2 = struct.Struct(header.endian_str + b'HH')
         intstruct = DNA_IO.UINT[header.endian_index]
 
-        data = handle.read(block.size)
         types = []
         names = []
 
         structs = []
         sdna_index_from_id = {}
 
-        offset = 8
+        offset += 8
         names_len = intstruct.unpack_from(data, offset)[0]
         offset += 4
 
@@ -214,7 +986,8 @@ class BlendFile:
         for i in range(names_len):
             tName = DNA_IO.read_data0_offset(data, offset)
             offset = offset + len(tName) + 1
-            names.append(DNAName(tName))
+            # when only some structs are used, names are created on demand (below)
+            names.append(DNAName(tName) if struct_ids is None else tName)
         del names_len
 
         offset = align(offset, 4)
@@ -228,50 +1001,910 @@ class BlendFile:
             types.append(DNAStruct(dna_type_id))
             offset += len(dna_type_id) + 1
 
-        offset = align(offset, 4)
-        offset += 4
-        log.debug("building #%d type-lengths" % types_len)
-        for i in range(types_len):
-            tLen = shortstruct.unpack_from(data, offset)[0]
-            offset = offset + 2
-            types[i].size = tLen
-        del types_len
+        offset = align(offset, 4)
+        offset += 4
+        log.debug("building #%d type-lengths" % types_len)
+        for i in range(types_len):
+            tLen = shortstruct.unpack_from(data, offset)[0]
+            offset = offset + 2
+            types[i].size = tLen
+        del types_len
+
+        offset = align(offset, 4)
+        offset += 4
+
+        structs_len = intstruct.unpack_from(data, offset)[0]
+        offset += 4
+        log.debug("building #%d structures" % structs_len)
+        for sdna_index in range(structs_len):
+            d = shortstruct2.unpack_from(data, offset)
+            struct_type_index = d[0]
+            offset += 4
+            dna_struct = types[struct_type_index]
+            sdna_index_from_id[dna_struct.dna_type_id] = sdna_index
+            structs.append(dna_struct)
+
+            fields_len = d[1]
+            dna_offset = 0
+
+            if struct_ids is not None and dna_struct.dna_type_id not in struct_ids:
+                offset += 4 * fields_len
+                continue
+
+            for field_index in range(fields_len):
+                d2 = shortstruct2.unpack_from(data, offset)
+                field_type_index = d2[0]
+                field_name_index = d2[1]
+                offset += 4
+                dna_type = types[field_type_index]
+                dna_name = names[field_name_index]
+                if type(dna_name) is bytes:
+                    dna_name = names[field_name_index] = DNAName(dna_name)
+                if dna_name.is_pointer or dna_name.is_method_pointer:
+                    dna_size = header.pointer_size * dna_name.array_size
+                else:
+                    dna_size = dna_type.size * dna_name.array_size
+
+                field = DNAField(dna_type, dna_name, dna_size, dna_offset)
+                dna_struct.fields.append(field)
+                dna_struct.field_from_name[dna_name.name_only] = field
+                dna_offset += dna_size
+
+        return structs, sdna_index_from_id
+
+
+class BlendFileJournal:
+    """
+    Changes to a file which haven't been written yet ``{offset: bytes}``.
+
+    Reading from the file applies these changes,
+    so values are the same as if they were written immediately.
+    """
+    __slots__ = (
+        # dict {offset: (order, bytes)}
+        "edits",
+        # sorted list of offsets in 'edits'
+        "offsets",
+        # largest edit (to find edits overlapping a range)
+        "size_max",
+        # incremented for each edit, used to apply overlapping edits in order
+        "order",
+        )
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.edits = {}
+        self.offsets = []
+        self.size_max = 0
+        self.order = 0
+
+    def __len__(self):
+        return len(self.edits)
+
+    def add(self, offset, data):
+        data = bytes(data)
+        item = self.edits.get(offset)
+        if item is None:
+            bisect.insort(self.offsets, offset)
+        elif len(item[1]) > len(data):
+            # replacing a longer change, keep its tail (with any changes made since),
+            # as writing the file would.
+            data += self.apply(offset + len(data), item[1][len(data):])
+        self.edits[offset] = (self.order, data)
+        self.order += 1
+        self.size_max = max(self.size_max, len(data))
+
+    def _iter_overlapping(self, offset, size):
+        offsets = self.offsets
+        i = bisect.bisect_right(offsets, offset - self.size_max)
+        end = offset + size
+        while i < len(offsets) and offsets[i] < end:
+            edit_offset = offsets[i]
+            order, edit = self.edits[edit_offset]
+            if edit_offset + len(edit) > offset:
+                yield order, edit_offset, edit
+            i += 1
+
+    def apply(self, offset, data):
+        """
+        Return data read from the file at offset, with changes applied.
+        """
+        edits = sorted(self._iter_overlapping(offset, len(data)))
+        if not edits:
+            return data
+        data = bytearray(data)
+        end = offset + len(data)
+        for _order, edit_offset, edit in edits:
+            src_start = max(offset - edit_offset, 0)
+            src_end = min(end - edit_offset, len(edit))
+            dst_start = edit_offset + src_start - offset
+            data[dst_start:dst_start + (src_end - src_start)] = edit[src_start:src_end]
+        return bytes(data)
+
+    def iter_runs(self):
+        """
+        Yield (offset, bytes) in file order,
+        with adjacent and overlapping changes joined together.
+        """
+        run_offset = run_end = None
+        run = []
+        for offset in self.offsets:
+            order, edit = self.edits[offset]
+            if run and offset <= run_end:
+                run.append((order, offset, edit))
+                run_end = max(run_end, offset + len(edit))
+                continue
+            if run:
+                yield run_offset, self._run_join(run_offset, run_end, run)
+            run = [(order, offset, edit)]
+            run_offset = offset
+            run_end = offset + len(edit)
+        if run:
+            yield run_offset, self._run_join(run_offset, run_end, run)
+
+    @staticmethod
+    def _run_join(run_offset, run_end, run):
+        if len(run) == 1:
+            return run[0][2]
+        data = bytearray(run_end - run_offset)
+        # apply in the order the changes were made (last change wins).
+        for _order, offset, edit in sorted(run):
+            data[offset - run_offset:offset - run_offset + len(edit)] = edit
+        return bytes(data)
+
+
+class BlendFileBlockTable:
+    """
+    Block headers, stored as parallel arrays (one item per block).
+
+    This avoids creating an object for every block when opening files with many blocks,
+    a :class:`BlendFileBlock` is only created when a block is accessed (and then reused).
+    """
+    __slots__ = (
+        # BlendFile
+        "file",
+        # [bytes, ...] unique block codes, indexed by 'code_id'
+        "codes",
+        # array columns
+        "code_id",
+        "size",
+        "addr_old",
+        "sdna_index",
+        "count",
+        "file_offset",
+        # dict {index: BlendFileBlock} (blocks which have been accessed)
+        "blocks_cache",
+        # arrays of 'addr_old' sorted & the matching block index (created on demand)
+        "addr_sorted",
+        "addr_sorted_index",
+        )
+
+    def __init__(self, bfile):
+        self.file = bfile
+        self.codes = []
+        self.code_id = array.array('H')
+        self.size = array.array('Q')
+        self.addr_old = array.array('Q')
+        self.sdna_index = array.array('I')
+        self.count = array.array('I')
+        self.file_offset = array.array('Q')
+        self.blocks_cache = {}
+        self.addr_sorted = None
+        self.addr_sorted_index = None
+
+    def code_id_ensure(self, code):
+        try:
+            return self.codes.index(code)
+        except ValueError:
+            self.codes.append(code)
+            return len(self.codes) - 1
+
+    def append(self, code_id, size, addr_old, sdna_index, count, file_offset):
+        self.code_id.append(code_id)
+        self.size.append(size)
+        self.addr_old.append(addr_old)
+        self.sdna_index.append(sdna_index)
+        self.count.append(count)
+        self.file_offset.append(file_offset)
+
+    def __len__(self):
+        return len(self.code_id)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        block = self.blocks_cache.get(index)
+        if block is None:
+            if not (0 <= index < len(self)):
+                raise IndexError("block index out of range")
+            block = self.blocks_cache.setdefault(index, BlendFileBlock.from_table(self, index))
+            if _stats is not None:
+                _stats.blocks[block.code] += 1
+        return block
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def index_from_offset(self, addr_old):
+        """
+        Return the index of the block with this address or -1.
+        """
+        if _stats is not None:
+            _stats.lookups += 1
+        if self.addr_sorted is None:
+            self._addr_sorted_ensure()
+        addr_sorted = self.addr_sorted
+        i = bisect.bisect_right(addr_sorted, addr_old) - 1
+        if i != -1 and addr_sorted[i] == addr_old:
+            return self.addr_sorted_index[i]
+        return -1
+
+    def indices_from_offsets(self, addr_list):
+        """
+        Return a list of block indices for a sequence of addresses (-1 when not found).
+
+        Addresses are looked up in order, merging with the sorted address index
+        instead of searching the whole index for each one.
+        """
+        if _stats is not None:
+            _stats.lookups += len(addr_list)
+        if self.addr_sorted is None:
+            self._addr_sorted_ensure()
+        addr_sorted = self.addr_sorted
+        addr_sorted_index = self.addr_sorted_index
+        addr_sorted_len = len(addr_sorted)
+
+        index_from_addr = {}
+        i = 0
+        for addr_old in sorted(set(addr_list)):
+            i = bisect.bisect_left(addr_sorted, addr_old, i)
+            if i == addr_sorted_len:
+                break
+            if addr_sorted[i] == addr_old:
+                # the last block wins when addresses are duplicated (match 'index_from_offset')
+                i = bisect.bisect_right(addr_sorted, addr_old, i) - 1
+                index_from_addr[addr_old] = addr_sorted_index[i]
+        return [index_from_addr.get(addr_old, -1) for addr_old in addr_list]
+
+    def _addr_sorted_ensure(self):
+        addr_old = self.addr_old
+        # skip the ENDB block (always last)
+        # stable sort, so the last block wins when addresses are duplicated
+        index_sorted = sorted(range(len(addr_old) - 1), key=addr_old.__getitem__)
+        # assign 'addr_sorted' last, other threads check it to see if this is done.
+        self.addr_sorted_index = array.array('I', index_sorted)
+        self.addr_sorted = array.array('Q', (addr_old[i] for i in index_sorted))
+
+
+class BlendFileBlockList:
+    """
+    Sequence of blocks from the block table (used for the code index).
+    """
+    __slots__ = (
+        # BlendFileBlockTable
+        "table",
+        # array of block indices
+        "indices",
+        )
+
+    def __init__(self, table, indices):
+        self.table = table
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.table[i] for i in self.indices[index]]
+        return self.table[self.indices[index]]
+
+    def __iter__(self):
+        table = self.table
+        for index in self.indices:
+            yield table[index]
+
+
+class BlendFileBlockAddrMap:
+    """
+    Mapping like access to blocks by their address ``{addr_old: block}``.
+    """
+    __slots__ = (
+        # BlendFileBlockTable
+        "table",
+        )
+
+    def __init__(self, table):
+        self.table = table
+
+    def get(self, addr_old, default=None):
+        index = self.table.index_from_offset(addr_old)
+        if index == -1:
+            return default
+        return self.table[index]
+
+    def __getitem__(self, addr_old):
+        index = self.table.index_from_offset(addr_old)
+        if index == -1:
+            raise KeyError(addr_old)
+        return self.table[index]
+
+    def __contains__(self, addr_old):
+        return self.table.index_from_offset(addr_old) != -1
+
+    def get_many(self, addr_list, default=None):
+        table = self.table
+        return [
+            table[index] if index != -1 else default
+            for index in table.indices_from_offsets(addr_list)
+            ]
+
+    def __len__(self):
+        return len(self.table) - 1
+
+
+class DNACache:
+    """
+    Module like class, caches decoded DNA catalogs.
+
+    Almost every file in a project is written by the same Blender build,
+    so the DNA1 block is byte-identical, this way each distinct catalog is decoded once.
+
+    The catalogs are keyed by a hash of the raw DNA1 data, the endianness and the pointer size.
+    Decoded catalogs are shared between files and must not be modified.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, *args, **kwargs):
+        raise RuntimeError("%s should not be instantiated" % cls)
+
+    # {key: (structs, sdna_index_from_id)}
+    catalogs = {}
+    # {id(structs): (structs, table)} see 'id_pointer_table'
+    id_pointer_tables = {}
+
+    # optional directory to store catalogs on disk, when None (the default) only the in-process cache is used.
+    # Only enable this for trusted directories (files are unpickled)
+    # and where decoding is slow compared to loading (large DNA, slow CPU).
+    cache_dir = None
+
+    # increment when 'DNAStruct', 'DNAField' or 'DNAName' change (stored in the file names).
+    VERSION = 1
+
+    @staticmethod
+    def key_from_buffer(header, data, offset, size):
+        import hashlib
+        with memoryview(data) as view:
+            digest = hashlib.sha1(view[offset:offset + size]).hexdigest()
+        return "%s_%s%d" % (digest, "le" if header.is_little_endian else "be", header.pointer_size)
+
+    @staticmethod
+    def decode_structs(header, data, offset, size):
+        """
+        Cached version of :meth:`BlendFile.decode_structs_from_buffer`.
+        """
+        key = DNACache.key_from_buffer(header, data, offset, size)
+        result = DNACache.catalogs.get(key)
+        if result is not None:
+            if _stats is not None:
+                _stats.dna_cache_hit += 1
+            return result
+
+        cache_dir = DNACache.cache_dir
+        if cache_dir is not None:
+            result = DNACache._load(cache_dir, key)
+
+        if result is None:
+            result = BlendFile.decode_structs_from_buffer(header, data, offset)
+            if cache_dir is not None:
+                DNACache._save(cache_dir, key, result)
+
+        DNACache.catalogs[key] = result
+        return result
+
+    @staticmethod
+    def clear():
+        DNACache.catalogs.clear()
+        DNACache.id_pointer_tables.clear()
+
+    @staticmethod
+    def id_pointer_table(structs, header):
+        """
+        Return a list indexed by ``sdna_index``, for each struct which can reference ID's
+        a ``(struct.Struct, paths, is_pointer_array)`` tuple to read the pointers which may lead to an ID
+        (see :meth:`DNAStruct.pointer_layout`), otherwise None.
+
+        Created once for each catalog (shared by all files using the same DNA),
+        see :meth:`BlendFile.find_id_references`.
+        """
+        item = DNACache.id_pointer_tables.get(id(structs))
+        if item is not None and item[0] is structs:
+            return item[1]
+        table = DNACache._id_pointer_table_create(structs, header)
+        DNACache.id_pointer_tables[id(structs)] = (structs, table)
+        return table
+
+    @staticmethod
+    def _id_pointer_table_create(structs, header):
+
+        def is_id(dna_struct):
+            fields = dna_struct.fields
+            return (
+                dna_struct.dna_type_id == b'ID' or
+                (fields and fields[0].dna_type.dna_type_id == b'ID' and not fields[0].dna_name.is_pointer)
+                )
+
+        # the ID's library isn't a dependency either
+        def pointer_is_link(dna_struct, field):
+            return DNAStruct.pointer_is_id_link(dna_struct, field) or (
+                dna_struct.dna_type_id == b'ID' and field.dna_name.name_only == b'lib')
+
+        def pointer_targets(dna_struct, targets):
+            for field in dna_struct.fields:
+                dna_name = field.dna_name
+                if dna_name.is_method_pointer:
+                    continue
+                if dna_name.is_pointer:
+                    if not pointer_is_link(dna_struct, field):
+                        targets.add(field.dna_type)
+                elif field.dna_type.fields:
+                    pointer_targets(field.dna_type, targets)
+            return targets
+
+        # types which may lead to an ID: ID's, 'void' (decided by the block pointed to)
+        # and structs with pointers to these types.
+        reach = set()
+        for dna_struct in structs:
+            if is_id(dna_struct):
+                reach.add(dna_struct)
+            for field in dna_struct.fields:
+                if field.dna_type.dna_type_id == b'void':
+                    reach.add(field.dna_type)
+        targets_all = [pointer_targets(dna_struct, set()) for dna_struct in structs]
+        is_changed = True
+        while is_changed:
+            is_changed = False
+            for dna_struct, targets in zip(structs, targets_all):
+                if dna_struct not in reach and not reach.isdisjoint(targets):
+                    reach.add(dna_struct)
+                    is_changed = True
+
+        def pointer_test(dna_struct, field):
+            return (field.dna_type in reach) and not pointer_is_link(dna_struct, field)
+
+        return [
+            dna_struct.pointer_layout(header, pointer_test) if dna_struct in reach else None
+            for dna_struct in structs
+            ]
+
+    @staticmethod
+    def _filepath(cache_dir, key):
+        return os.path.join(cache_dir, "%s_v%d.pickle" % (key, DNACache.VERSION))
+
+    @staticmethod
+    def _load(cache_dir, key):
+        import pickle
+        filepath = DNACache._filepath(cache_dir, key)
+        try:
+            with open(filepath, 'rb') as fh:
+                result = pickle.load(fh)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # corrupt or written by an incompatible version, decode again
+            log.debug("failed to load DNA cache %r" % filepath)
+            return None
+        if not (type(result) is tuple and len(result) == 2 and
+                type(result[0]) is list and type(result[1]) is dict):
+            log.debug("invalid DNA cache %r" % filepath)
+            return None
+        return result
+
+    @staticmethod
+    def _save(cache_dir, key, result):
+        import pickle
+        import tempfile
+        filepath = DNACache._filepath(cache_dir, key)
+        # write to a unique temp name first (other threads & processes may write the same file),
+        # so a partially written file is never read.
+        filepath_tmp = None
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, filepath_tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            with open(fd, 'wb') as fh:
+                pickle.dump(result, fh, pickle.HIGHEST_PROTOCOL)
+            os.replace(filepath_tmp, filepath)
+        except OSError:
+            log.debug("failed to write DNA cache %r" % filepath)
+            if filepath_tmp is not None:
+                try:
+                    os.remove(filepath_tmp)
+                except OSError:
+                    pass
+
+
+class DecompressCache:
+    """
+    Module like class, a process-wide LRU cache of decompressed (read-only) blend files.
+
+    Recursive walks may open the same compressed library many times,
+    this avoids decompressing it each time.
+
+    Files are keyed by their path, modification time, size and inode,
+    the total size of all files is kept under ``DECOMPRESS_CACHE_LIMIT``.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, *args, **kwargs):
+        raise RuntimeError("%s should not be instantiated" % cls)
+
+    # {key: bytes}, least recently used first
+    files = collections.OrderedDict()
+    files_size = 0
+    lock = threading.Lock()
+
+    @staticmethod
+    def key_from_handle(filename, handle):
+        st = os.fstat(handle.fileno())
+        return (os.path.abspath(filename), st.st_mtime_ns, st.st_size, st.st_ino)
+
+    @staticmethod
+    def get(key):
+        cls = DecompressCache
+        with cls.lock:
+            data = cls.files.get(key)
+            if data is not None:
+                cls.files.move_to_end(key)
+            return data
+
+    @staticmethod
+    def add(key, data):
+        cls = DecompressCache
+        if len(data) > DECOMPRESS_CACHE_LIMIT:
+            return
+        with cls.lock:
+            data_prev = cls.files.pop(key, None)
+            if data_prev is not None:
+                cls.files_size -= len(data_prev)
+            cls.files[key] = data
+            cls.files_size += len(data)
+            while cls.files_size > DECOMPRESS_CACHE_LIMIT:
+                _key, data_prev = cls.files.popitem(last=False)
+                cls.files_size -= len(data_prev)
+
+    @staticmethod
+    def clear():
+        cls = DecompressCache
+        with cls.lock:
+            cls.files.clear()
+            cls.files_size = 0
+
+
+class BlendFileProbe:
+    """
+    Summary of a blend file, see :func:`probe`.
+    """
+    __slots__ = (
+        "filepath",
+        # bool (is file gzipped)
+        "is_compressed",
+        "pointer_size",
+        "is_little_endian",
+        "version",
+        # dict {code: int} number of blocks for each code
+        "block_counts",
+        # [(id_name, filepath, is_packed), ...]
+        "libraries",
+        "images",
+        )
+
+    # {code: paths} read for each block (the 'libraries' & 'images' items)
+    ID_PATHS = {
+        b'LI': (b'id.name', b'name', b'packedfile'),
+        b'IM': (b'id.name', b'name', b'packedfile'),
+        }
+
+    # the only structs needed to read 'ID_PATHS'
+    STRUCT_IDS = {b'ID', b'Library', b'Image'}
+
+    def __init__(self, filepath, is_compressed, header):
+        self.filepath = filepath
+        self.is_compressed = is_compressed
+        self.pointer_size = header.pointer_size
+        self.is_little_endian = header.is_little_endian
+        self.version = header.version
+        self.block_counts = {}
+        self.libraries = []
+        self.images = []
+
+    @staticmethod
+    def from_handle(handle, filepath, is_compressed):
+        header = BlendFileHeader(handle)
+        if header.magic != b'BLENDER':
+            raise Exception("%r is not a blend file" % filepath)
+        header_struct = header.create_block_header_struct()
+
+        probe = BlendFileProbe(filepath, is_compressed, header)
+        block_counts = probe.block_counts
+        # [(code, sdna_index, data), ...]
+        id_blocks = []
+        dna_data = None
+
+        while True:
+            data = handle.read(header_struct.size)
+            # old blend files ENDB block (see 'BlendFile._read_block_headers')
+            if len(data) < header_struct.size:
+                if len(data) < 8 or DNA_IO.read_data0(data[:4]) != b'ENDB':
+                    raise Exception("blend file ended before the ENDB block")
+                break
+            code_raw, size, _addr_old, sdna_index, _count = header_struct.unpack(data)
+            if code_raw == b'ENDB':
+                break
+            code = code_raw.partition(b'\0')[0]
+            block_counts[code] = block_counts.get(code, 0) + 1
+            if code in BlendFileProbe.ID_PATHS:
+                data = handle.read(size)
+                id_blocks.append((code, sdna_index, data))
+            elif code == b'DNA1':
+                data = dna_data = handle.read(size)
+            else:
+                handle.seek(size, os.SEEK_CUR)
+                continue
+            if len(data) != size:
+                raise Exception("blend file ended before the ENDB block")
+
+        # the same errors as 'BlendFile' for truncated files
+        if dna_data is None:
+            raise Exception("blend file has no DNA1 block")
+
+        if id_blocks:
+            # use the catalog when its already decoded, otherwise only decode the structs needed here
+            catalog = DNACache.catalogs.get(DNACache.key_from_buffer(header, dna_data, 0, len(dna_data)))
+            if catalog is not None:
+                structs = catalog[0]
+            else:
+                structs, _sdna_index_from_id = BlendFile.decode_structs_from_buffer(
+                        header, dna_data, 0, struct_ids=BlendFileProbe.STRUCT_IDS)
+            for code, sdna_index, data in id_blocks:
+                dna_struct = structs[sdna_index]
+                id_name, path, packedfile = (
+                        dna_struct.field_get_offset(header, data, 0, path, default=None, use_str=False)
+                        for path in BlendFileProbe.ID_PATHS[code])
+                (probe.libraries if code == b'LI' else probe.images).append((id_name, path, bool(packedfile)))
+
+        return probe
+
+    @property
+    def dependencies_count(self):
+        """
+        Number of libraries & images which aren't packed.
+        """
+        return sum(1 for items in (self.libraries, self.images) for item in items if not item[2])
+
+    def as_dict(self):
+        """
+        Return the summary as a dict (which can be written as JSON).
+        """
+        def as_str(value):
+            return value.decode('utf-8', 'replace')
+
+        return {
+            "is_compressed": self.is_compressed,
+            "pointer_size": self.pointer_size,
+            "is_little_endian": self.is_little_endian,
+            "version": self.version,
+            "block_counts": {as_str(code): count for code, count in self.block_counts.items()},
+            "libraries": [(as_str(id_name), as_str(path), is_packed) for id_name, path, is_packed in self.libraries],
+            "images": [(as_str(id_name), as_str(path), is_packed) for id_name, path, is_packed in self.images],
+            "dependencies_count": self.dependencies_count,
+            }
+
+
+class BlendFileStreamBlock:
+    """
+    Block header found by :class:`BlendFileStream`.
+    """
+    __slots__ = (
+        "code",
+        "size",
+        "addr_old",
+        "sdna_index",
+        "count",
+        # offset of the block data in the (uncompressed) file
+        "file_offset",
+        )
+
+    def __init__(self, code, size, addr_old, sdna_index, count, file_offset):
+        self.code = code
+        self.size = size
+        self.addr_old = addr_old
+        self.sdna_index = sdna_index
+        self.count = count
+        self.file_offset = file_offset
+
+    def __repr__(self):
+        return ("<%s.%s (%s), size=%d at %s>" %
+                (self.__class__.__name__,
+                 self.code.decode(),
+                 self.sdna_index,
+                 self.size,
+                 hex(self.addr_old),
+                 ))
+
 
-        offset = align(offset, 4)
-        offset += 4
+class BlendFileStream:
+    """
+    Push parser, for blend files that arrive in chunks (eg: downloading).
 
-        structs_len = intstruct.unpack_from(data, offset)[0]
-        offset += 4
-        log.debug("building #%d structures" % structs_len)
-        for sdna_index in range(structs_len):
-            d = shortstruct2.unpack_from(data, offset)
-            struct_type_index = d[0]
-            offset += 4
-            dna_struct = types[struct_type_index]
-            sdna_index_from_id[dna_struct.dna_type_id] = sdna_index
-            structs.append(dna_struct)
+    Each call to :meth:`feed` yields ``(block, values)`` as soon as the data is available:
 
-            fields_len = d[1]
-            dna_offset = 0
+    - ``(block, None)`` for every block header.
+    - ``(block, {path: value})`` for blocks with a code in ``fields``,
+      once the block data and the DNA are available.
 
-            for field_index in range(fields_len):
-                d2 = shortstruct2.unpack_from(data, offset)
-                field_type_index = d2[0]
-                field_name_index = d2[1]
-                offset += 4
-                dna_type = types[field_type_index]
-                dna_name = names[field_name_index]
-                if dna_name.is_pointer or dna_name.is_method_pointer:
-                    dna_size = header.pointer_size * dna_name.array_size
+    The DNA1 block is written at the end of blend files,
+    so values are held back until it arrives, unless ``structs``
+    (the DNA catalog of a file written by the same Blender build) is passed in.
+
+    Only the data of blocks in ``fields`` is kept (until decoded), other data is skipped.
+    gzip compressed streams are decompressed.
+    """
+    __slots__ = (
+        # {code: (path, ...)} fields to decode for blocks of each code
+        "fields",
+        # BlendFileHeader or None (until the first bytes arrive)
+        "header",
+        # struct.Struct
+        "block_header_struct",
+        # [DNAStruct, ...] or None (until the DNA1 block arrives)
+        "structs",
+        # bytearray, data which hasn't been parsed yet
+        "buffer",
+        # offset in the (uncompressed) file of the start of 'buffer'
+        "offset",
+        # BlendFileStreamBlock, block which data is being read (or None)
+        "block",
+        # bytes of block data left to skip
+        "skip",
+        # [(BlendFileStreamBlock, bytes), ...] blocks waiting for the DNA
+        "pending",
+        # zlib decompress object (for gzip streams) or None
+        "decompress",
+        # bool, set when the ENDB block is found
+        "is_done",
+        )
+
+    def __init__(self, fields, structs=None):
+        self.fields = fields
+        self.header = None
+        self.block_header_struct = None
+        self.structs = structs
+        self.buffer = bytearray()
+        self.offset = 0
+        self.block = None
+        self.skip = 0
+        self.pending = []
+        self.decompress = None
+        self.is_done = False
+
+    def feed(self, data):
+        """
+        Parse the next chunk of the file, yielding ``(block, values)``.
+        """
+        if self.is_done:
+            return
+
+        buffer = self.buffer
+        if self.decompress is not None:
+            buffer += self.decompress.decompress(data)
+        elif self.header is None:
+            # check the first bytes for gzip compression
+            buffer += data
+            if len(buffer) < 2:
+                return
+            if buffer[:2] == b'\x1f\x8b':
+                import zlib
+                self.decompress = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                data = bytes(buffer)
+                buffer.clear()
+                buffer += self.decompress.decompress(data)
+        else:
+            buffer += data
+
+        yield from self._parse()
+
+    def close(self):
+        """
+        Call once all data has been passed to :meth:`feed`, raises an exception for incomplete files.
+        """
+        if not self.is_done:
+            raise Exception("blend file stream ended before the ENDB block")
+        if self.pending:
+            raise Exception("blend file stream has no DNA1 block")
+
+    def _parse(self):
+        buffer = self.buffer
+        FILEHEADER = BlendFileHeader.FILEHEADER
+
+        if self.header is None:
+            if len(buffer) < FILEHEADER.size:
+                return
+            if buffer[:7] != b'BLENDER':
+                raise Exception("filetype not a blend or a gzip blend")
+            self.header = BlendFileHeader(None, data=buffer)
+            self.block_header_struct = self.header.create_block_header_struct()
+            self._consume(FILEHEADER.size)
+
+        header_struct = self.block_header_struct
+        while True:
+            if self.skip:
+                skip = min(self.skip, len(buffer))
+                self._consume(skip)
+                self.skip -= skip
+                if self.skip:
+                    return
+
+            block = self.block
+            if block is None:
+                # ENDB may be written with a short header (old files)
+                if buffer[:4] == b'ENDB':
+                    self.is_done = True
+                    self._consume(len(buffer))
+                    return
+                if len(buffer) < header_struct.size:
+                    return
+                code_raw, size, addr_old, sdna_index, count = header_struct.unpack_from(buffer, 0)
+                self._consume(header_struct.size)
+                block = BlendFileStreamBlock(
+                        code_raw.partition(b'\0')[0], size, addr_old, sdna_index, count, self.offset)
+                yield block, None
+
+                if block.code == b'DNA1' or block.code in self.fields:
+                    self.block = block
                 else:
-                    dna_size = dna_type.size * dna_name.array_size
+                    self.skip = size
+                continue
 
-                field = DNAField(dna_type, dna_name, dna_size, dna_offset)
-                dna_struct.fields.append(field)
-                dna_struct.field_from_name[dna_name.name_only] = field
-                dna_offset += dna_size
+            if len(buffer) < block.size:
+                return
+            data = bytes(buffer[:block.size])
+            self._consume(block.size)
+            self.block = None
 
-        return structs, sdna_index_from_id
+            if block.code == b'DNA1':
+                if self.structs is None:
+                    self.structs = DNACache.decode_structs(self.header, data, 0, block.size)[0]
+                pending = self.pending
+                self.pending = []
+                for block_pending, data_pending in pending:
+                    yield block_pending, self._decode(block_pending, data_pending)
+            elif self.structs is None:
+                self.pending.append((block, data))
+            else:
+                yield block, self._decode(block, data)
+
+    def _consume(self, size):
+        del self.buffer[:size]
+        self.offset += size
+
+    def _decode(self, block, data):
+        header = self.header
+        dna_struct = self.structs[block.sdna_index]
+        values = {}
+        for path in self.fields[block.code]:
+            accessor = dna_struct.field_accessor_from_path(header, path)
+            if accessor is None:
+                values[path] = None
+            else:
+                values[path] = accessor.decode(data, accessor.offset, use_nil=True, use_str=False)
+        return values
 
 
 class BlendFileBlock:
@@ -300,41 +1933,20 @@ class BlendFileBlock:
                  hex(self.addr_old),
                  ))
 
-    def __init__(self, handle, bfile):
-        OLDBLOCK = struct.Struct(b'4sI')
-
-        self.file = bfile
-
-        data = handle.read(bfile.block_header_struct.size)
-        # header size can be 8, 20, or 24 bytes long
-        # 8: old blend files ENDB block (exception)
-        # 20: normal headers 32 bit platform
-        # 24: normal headers 64 bit platform
-        if len(data) > 15:
-
-            blockheader = bfile.block_header_struct.unpack(data)
-            self.code = blockheader[0].partition(b'\0')[0]
-            if self.code != b'ENDB':
-                self.size = blockheader[1]
-                self.addr_old = blockheader[2]
-                self.sdna_index = blockheader[3]
-                self.count = blockheader[4]
-                self.file_offset = handle.tell()
-            else:
-                self.size = 0
-                self.addr_old = 0
-                self.sdna_index = 0
-                self.count = 0
-                self.file_offset = 0
-        else:
-            blockheader = OLDBLOCK.unpack(data)
-            self.code = blockheader[0].partition(b'\0')[0]
-            self.code = DNA_IO.read_data0(blockheader[0])
-            self.size = 0
-            self.addr_old = 0
-            self.sdna_index = 0
-            self.count = 0
-            self.file_offset = 0
+    @staticmethod
+    def from_table(table, index):
+        """
+        Create a block from a row in the :class:`BlendFileBlockTable`.
+        """
+        self = BlendFileBlock.__new__(BlendFileBlock)
+        self.file = table.file
+        self.code = table.codes[table.code_id[index]]
+        self.size = table.size[index]
+        self.addr_old = table.addr_old[index]
+        self.sdna_index = table.sdna_index[index]
+        self.count = table.count[index]
+        self.file_offset = table.file_offset[index]
+        return self
 
     @property
     def dna_type(self):
@@ -364,18 +1976,16 @@ class BlendFileBlock:
         if base_index != 0:
             assert(base_index < self.count)
             ofs += (self.size // self.count) * base_index
-        self.file.handle.seek(ofs, os.SEEK_SET)
 
         if sdna_index_refine is None:
             sdna_index_refine = self.sdna_index
         else:
             self.file.ensure_subtype_smaller(self.sdna_index, sdna_index_refine)
 
-        dna_struct = self.file.structs[sdna_index_refine]
-        field = dna_struct.field_from_path(
-                self.file.header, self.file.handle, path)
+        accessor = self.file.field_accessor(sdna_index_refine, path)
+        field = accessor.field
 
-        return (self.file.handle.tell(), field.dna_name.array_size)
+        return (ofs + accessor.offset, field.dna_name.array_size)
 
     def get(self, path,
             default=...,
@@ -388,19 +1998,28 @@ class BlendFileBlock:
         if base_index != 0:
             assert(base_index < self.count)
             ofs += (self.size // self.count) * base_index
-        self.file.handle.seek(ofs, os.SEEK_SET)
 
         if sdna_index_refine is None:
             sdna_index_refine = self.sdna_index
         else:
             self.file.ensure_subtype_smaller(self.sdna_index, sdna_index_refine)
 
-        dna_struct = self.file.structs[sdna_index_refine]
-        return dna_struct.field_get(
-                self.file.header, self.file.handle, path,
-                default=default,
-                use_nil=use_nil, use_str=use_str,
-                )
+        accessor = self.file.field_accessor(sdna_index_refine, path)
+        if accessor is None:
+            if default is not ...:
+                return default
+            else:
+                dna_struct = self.file.structs[sdna_index_refine]
+                raise KeyError("%r not found in %r (%r)" % (path, [f.dna_name.name_only for f in dna_struct.fields], dna_struct.dna_type_id))
+
+        ofs += accessor.offset
+        data = self.file.data
+        if data is None:
+            data = self.file.read_at(ofs, accessor.size)
+            ofs = 0
+        if _stats is not None:
+            _stats.fields[self.code] += 1
+        return accessor.decode(data, ofs, use_nil=use_nil, use_str=use_str)
 
     def set(self, path, value,
             sdna_index_refine=None,
@@ -411,11 +2030,12 @@ class BlendFileBlock:
         else:
             self.file.ensure_subtype_smaller(self.sdna_index, sdna_index_refine)
 
-        dna_struct = self.file.structs[sdna_index_refine]
-        self.file.handle.seek(self.file_offset, os.SEEK_SET)
-        self.file.is_modified = True
-        return dna_struct.field_set(
-                self.file.header, self.file.handle, path, value)
+        accessor = self.file.field_accessor(sdna_index_refine, path)
+        if accessor is None:
+            dna_struct = self.file.structs[sdna_index_refine]
+            raise KeyError("%r not found in %r" % (path, [f.dna_name.name_only for f in dna_struct.fields]))
+
+        self.file.write_at(self.file_offset + accessor.offset, accessor.encode(value))
 
     # ---------------
     # Utility get/set
@@ -435,7 +2055,7 @@ class BlendFileBlock:
         if type(result) is not int:
             return result
 
-        assert(self.file.structs[sdna_index_refine].field_from_path(self.file.header, self.file.handle, path).dna_name.is_pointer)
+        assert(self.file.field_accessor(sdna_index_refine, path).field.dna_name.is_pointer)
         if result != 0:
             # possible (but unlikely)
             # that this fails and returns None
@@ -444,6 +2064,219 @@ class BlendFileBlock:
         else:
             return None
 
+    # ---------------
+    # Batch field access
+    #
+    #   read the struct once, decode many fields from it
+    def read_data(self,
+            sdna_index_refine=None,
+            base_index=0,
+            ):
+        """
+        Return (data, offset) for the struct of this block,
+        where data is a buffer containing the struct at offset.
+        """
+        ofs = self.file_offset
+        if base_index != 0:
+            assert(base_index < self.count)
+            ofs += (self.size // self.count) * base_index
+
+        data = self.file.data
+        if data is not None:
+            return data, ofs
+
+        if sdna_index_refine is None:
+            sdna_index_refine = self.sdna_index
+        return self.file.read_at(ofs, self.file.structs[sdna_index_refine].size), 0
+
+    def get_all(self, path,
+            default=...,
+            sdna_index_refine=None,
+            use_nil=True, use_str=False,
+            ):
+        """
+        Return a list with the value of ``path`` for each item in this block (see :meth:`get`),
+        reading the block once.
+        """
+        if sdna_index_refine is None:
+            sdna_index_refine = self.sdna_index
+        else:
+            self.file.ensure_subtype_smaller(self.sdna_index, sdna_index_refine)
+
+        accessor = self.file.field_accessor(sdna_index_refine, path)
+        if accessor is None:
+            if default is not ...:
+                return [default] * self.count
+            else:
+                dna_struct = self.file.structs[sdna_index_refine]
+                raise KeyError("%r not found in %r (%r)" % (path, [f.dna_name.name_only for f in dna_struct.fields], dna_struct.dna_type_id))
+
+        if self.count == 0:
+            return []
+
+        stride = self.size // self.count
+        ofs = self.file_offset
+        data = self.file.data
+        if data is None:
+            data = self.file.read_at(ofs, self.size)
+            ofs = 0
+        if _stats is not None:
+            _stats.fields[self.code] += self.count
+        ofs += accessor.offset
+        return [
+            accessor.decode(data, ofs + (stride * i), use_nil=use_nil, use_str=use_str)
+            for i in range(self.count)
+            ]
+
+    def as_array(self, sdna_index_refine=None):
+        """
+        Return all items of this block as a NumPy structured array,
+        using a dtype created from the blocks struct.
+
+        When NumPy isn't available, or the items don't match the struct size (raw data),
+        an array of bytes with the shape ``(count, item_size)`` is returned instead
+        (a ``memoryview`` without NumPy).
+
+        The data is copied, so the array stays valid after closing the file,
+        a block without items gives an empty array.
+        """
+        if sdna_index_refine is None:
+            sdna_index_refine = self.sdna_index
+        else:
+            self.file.ensure_subtype_smaller(self.sdna_index, sdna_index_refine)
+
+        dna_struct = self.file.structs[sdna_index_refine]
+        if self.count == 0:
+            stride = dna_struct.size
+            data = b''
+        else:
+            stride = self.size // self.count
+            data = self.file.read_at(self.file_offset, stride * self.count)
+
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+
+        if numpy is None:
+            if self.count == 0:
+                # memoryview can't have zeros in its shape
+                return memoryview(data)
+            return memoryview(data).cast('B', shape=[self.count, stride])
+        if stride != dna_struct.size:
+            return numpy.frombuffer(data, dtype=numpy.uint8).reshape(self.count, stride)
+        return numpy.frombuffer(data, dtype=dna_struct.numpy_dtype(self.file.header, numpy), count=self.count)
+
+    def iter_fields(self, paths,
+            default=...,
+            sdna_index_refine=None,
+            use_nil=True, use_str=True,
+            base_index=0,
+            ):
+        """
+        Like :meth:`get` for each path, reading the struct only once.
+        """
+        if sdna_index_refine is None:
+            sdna_index_refine = self.sdna_index
+        else:
+            self.file.ensure_subtype_smaller(self.sdna_index, sdna_index_refine)
+
+        data, ofs = self.read_data(sdna_index_refine=sdna_index_refine, base_index=base_index)
+        field_accessor = self.file.field_accessor
+        for path in paths:
+            accessor = field_accessor(sdna_index_refine, path)
+            if accessor is None:
+                if default is not ...:
+                    yield default
+                    continue
+                else:
+                    dna_struct = self.file.structs[sdna_index_refine]
+                    raise KeyError("%r not found in %r (%r)" % (path, [f.dna_name.name_only for f in dna_struct.fields], dna_struct.dna_type_id))
+            if _stats is not None:
+                _stats.fields[self.code] += 1
+            yield accessor.decode(data, ofs + accessor.offset, use_nil=use_nil, use_str=use_str)
+
+    def read_fields(self, paths,
+            default=...,
+            sdna_index_refine=None,
+            use_nil=True, use_str=False,
+            base_index=0,
+            ):
+        """
+        Return a tuple of values for paths, reading the struct only once.
+
+        Missing paths use ``default`` (or raise a KeyError when not given).
+
+        Note that unlike :meth:`get`, ``use_str`` is off by default,
+        so strings are returned as bytes (as with ``block[path]``).
+        """
+        return tuple(self.iter_fields(
+                paths,
+                default=default,
+                sdna_index_refine=sdna_index_refine,
+                use_nil=use_nil, use_str=use_str,
+                base_index=base_index,
+                ))
+
+    def as_dict(self,
+            sdna_index_refine=None,
+            use_nil=True, use_str=False,
+            base_index=0,
+            ):
+        """
+        Return all fields of the struct as a dict, reading the struct only once.
+
+        Nested structs are returned as dicts, arrays as lists (except for char arrays, which are strings)
+        and single chars as ints, fields of types which can't be decoded are left out.
+
+        As with :meth:`read_fields`, strings are returned as bytes unless ``use_str`` is set.
+        """
+        if sdna_index_refine is None:
+            sdna_index_refine = self.sdna_index
+        else:
+            self.file.ensure_subtype_smaller(self.sdna_index, sdna_index_refine)
+
+        data, ofs = self.read_data(sdna_index_refine=sdna_index_refine, base_index=base_index)
+        return self._as_dict_recursive(
+                self.file.structs[sdna_index_refine], data, ofs,
+                use_nil, use_str,
+                )
+
+    def _as_dict_recursive(self, dna_struct, data, ofs, use_nil, use_str):
+        header = self.file.header
+        result = {}
+        for field in dna_struct.fields:
+            dna_name = field.dna_name
+            name = dna_name.name_only
+            array_size = dna_name.array_size
+            field_ofs = ofs + field.dna_offset
+            if (not dna_name.is_pointer) and field.dna_type.fields:
+                items = [
+                    self._as_dict_recursive(
+                            field.dna_type, data, field_ofs + (field.dna_type.size * i),
+                            use_nil, use_str,
+                            )
+                    for i in range(array_size)
+                    ]
+                result[name] = items if array_size > 1 else items[0]
+                continue
+            accessor = DNAFieldAccessor(header, field, field.dna_offset, name)
+            if accessor.unpack is not None:
+                unpack_from = accessor.unpack.unpack_from
+                items = [unpack_from(data, field_ofs + (accessor.size * i))[0] for i in range(array_size)]
+                result[name] = items if array_size > 1 else items[0]
+            elif field.dna_type.dna_type_id == b'char':
+                if array_size == 1:
+                    # a single char is a number (flags... etc), not a string
+                    result[name] = data[field_ofs]
+                else:
+                    result[name] = accessor.decode(data, field_ofs, use_nil=use_nil, use_str=use_str)
+            else:
+                continue
+            if _stats is not None:
+                _stats.fields[self.code] += 1
+        return result
+
     # ----------------------
     # Python convenience API
 
@@ -458,10 +2291,10 @@ class BlendFileBlock:
         return (f.dna_name.name_only for f in self.dna_type.fields)
 
     def values(self):
-        return (self[k] for k in self.keys())
+        return self.iter_fields(tuple(self.keys()), use_str=False)
 
     def items(self):
-        return ((k, self[k]) for k in self.keys())
+        return zip(self.keys(), self.values())
 
 
 # -----------------------------------------------------------------------------
@@ -493,11 +2326,16 @@ class BlendFileHeader:
         "endian_index",
         )
 
-    def __init__(self, handle):
-        FILEHEADER = struct.Struct(b'7s1s1s3s')
+    FILEHEADER = struct.Struct(b'7s1s1s3s')
+
+    def __init__(self, handle, data=None):
+        FILEHEADER = BlendFileHeader.FILEHEADER
 
         log.debug("reading blend-file-header")
-        values = FILEHEADER.unpack(handle.read(FILEHEADER.size))
+        if data is None:
+            values = FILEHEADER.unpack(handle.read(FILEHEADER.size))
+        else:
+            values = FILEHEADER.unpack_from(data, 0)
         self.magic = values[0]
         pointer_size_id = values[1]
         if pointer_size_id == b'-':
@@ -620,12 +2458,42 @@ class DNAStruct:
         "field_from_name",
         )
 
+    # pointers in the ID header to other ID's in the main database list & runtime data,
+    # these don't reference the data they point to.
+    ID_LINK_POINTERS = frozenset((b'next', b'prev', b'newid', b'orig_id'))
+
     def __init__(self, dna_type_id):
         self.dna_type_id = dna_type_id
         self.fields = []
         self.field_from_name = {}
 
+    @staticmethod
+    def pointer_is_id_link(dna_struct, field):
+        """
+        Test if this field is one of the ``ID_LINK_POINTERS`` (see :meth:`pointer_layout`).
+        """
+        return dna_struct.dna_type_id == b'ID' and field.dna_name.name_only in DNAStruct.ID_LINK_POINTERS
+
+    @staticmethod
+    def pointer_is_reference(dna_struct, field):
+        """
+        A ``pointer_test`` for :meth:`pointer_layout`, skipping the ID list & runtime pointers.
+        """
+        return not DNAStruct.pointer_is_id_link(dna_struct, field)
+
     def field_from_path(self, header, handle, path):
+        field, offset = self.field_offset_from_path(header, path)
+        if field is not None:
+            if _stats is not None:
+                _stats.seeks += 1
+            handle.seek(offset, os.SEEK_CUR)
+            return field
+
+    def field_offset_from_path(self, header, path):
+        """
+        Return (field, offset), where the offset is relative to the start of this struct
+        (field is None when the path can't be found).
+        """
         assert(type(path) == bytes)
         # support 'id.name'
         name, _, name_tail = path.partition(b'.')
@@ -642,18 +2510,131 @@ class DNAStruct:
         field = self.field_from_name.get(name)
 
         if field is not None:
-            handle.seek(field.dna_offset, os.SEEK_CUR)
+            offset = field.dna_offset
             if index != 0:
                 if field.dna_name.is_pointer:
                     index_offset = header.pointer_size * index
                 else:
                     index_offset = field.dna_type.size * index
                 assert(index_offset < field.dna_size)
-                handle.seek(index_offset, os.SEEK_CUR)
+                offset += index_offset
             if name_tail == b'':
-                return field
+                return field, offset
+            else:
+                field, offset_tail = field.dna_type.field_offset_from_path(header, name_tail)
+                return field, offset + offset_tail
+
+        return None, 0
+
+    # numpy type codes for basic DNA types (without the byte order)
+    NUMPY_TYPES = {
+        b'char': 'i1',
+        b'uchar': 'u1',
+        b'short': 'i2',
+        b'ushort': 'u2',
+        b'int': 'i4',
+        b'uint': 'u4',
+        b'long': 'i4',
+        b'ulong': 'u4',
+        b'float': 'f4',
+        b'double': 'f8',
+        b'int64_t': 'i8',
+        b'uint64_t': 'u8',
+        }
+
+    def numpy_dtype(self, header, numpy):
+        """
+        Return a NumPy structured dtype matching this struct,
+        char arrays are bytes, pointers are unsigned integers.
+
+        Fields of unknown types are left out (their bytes are skipped).
+        """
+        names = []
+        formats = []
+        offsets = []
+        pointer_format = header.endian_str.decode('ascii') + ('u8' if header.pointer_size == 8 else 'u4')
+        for field in self.fields:
+            dna_name = field.dna_name
+            dna_type = field.dna_type
+            array_size = dna_name.array_size
+            if dna_name.is_pointer:
+                fmt = pointer_format
+            elif dna_type.dna_type_id == b'char' and array_size > 1:
+                # string
+                fmt = 'S%d' % array_size
+                array_size = 1
+            elif dna_type.fields:
+                fmt = dna_type.numpy_dtype(header, numpy)
             else:
-                return field.dna_type.field_from_path(header, handle, name_tail)
+                fmt = DNAStruct.NUMPY_TYPES.get(dna_type.dna_type_id)
+                if fmt is None:
+                    continue
+                fmt = header.endian_str.decode('ascii') + fmt
+            if array_size > 1:
+                fmt = (fmt, (array_size,))
+
+            name = dna_name.name_only.decode('utf-8')
+            if name in names:
+                continue
+            names.append(name)
+            formats.append(fmt)
+            offsets.append(field.dna_offset)
+
+        return numpy.dtype({"names": names, "formats": formats, "offsets": offsets, "itemsize": self.size})
+
+    def pointer_layout(self, header, pointer_test=None):
+        """
+        Return a ``(struct.Struct, paths, is_pointer_array)`` tuple to read all pointers in this struct
+        (including nested structs), or None when there are no pointers.
+
+        ``is_pointer_array`` is a sequence of booleans, true for pointers to pointers.
+
+        ``pointer_test`` is an optional callback ``pointer_test(dna_struct, field) -> bool``,
+        to only include some of the pointers.
+        """
+        pointers = []
+
+        def pointers_recursive(dna_struct, offset, parent):
+            for field in dna_struct.fields:
+                dna_name = field.dna_name
+                if dna_name.is_method_pointer:
+                    continue
+                if dna_name.is_pointer:
+                    if pointer_test is not None and not pointer_test(dna_struct, field):
+                        continue
+                    item_size = header.pointer_size
+                elif field.dna_type.fields:
+                    item_size = field.dna_type.size
+                else:
+                    continue
+                for i in range(dna_name.array_size):
+                    name = dna_name.name_only
+                    if i != 0:
+                        name = b'%s[%d]' % (name, i)
+                    path = name if parent is None else parent + b'.' + name
+                    item_offset = offset + field.dna_offset + (item_size * i)
+                    if dna_name.is_pointer:
+                        pointers.append((item_offset, path, dna_name.name_full.startswith(b'**')))
+                    else:
+                        pointers_recursive(field.dna_type, item_offset, path)
+
+        pointers_recursive(self, 0, None)
+        if not pointers:
+            return None
+
+        pointer_char = b'Q' if header.pointer_size == 8 else b'I'
+        fmt = [header.endian_str]
+        offset_prev = 0
+        for offset, _path, _is_pointer_array in pointers:
+            if offset != offset_prev:
+                fmt.append(b'%dx' % (offset - offset_prev))
+            fmt.append(pointer_char)
+            offset_prev = offset + header.pointer_size
+        return (
+            struct.Struct(b''.join(fmt)),
+            tuple(path for _offset, path, _is_pointer_array in pointers),
+            tuple(is_pointer_array for _offset, _path, is_pointer_array in pointers),
+            )
 
     def field_get(self, header, handle, path,
                   default=...,
@@ -711,6 +2692,115 @@ class DNAStruct:
         else:
             raise NotImplementedError("Setting %r is not yet supported" % dna_type[0])
 
+    def field_accessor_from_path(self, header, path):
+        """
+        Resolve the path into a :class:`DNAFieldAccessor` (or None when its not found).
+        """
+        field, offset = self.field_offset_from_path(header, path)
+        if field is None:
+            return None
+        return DNAFieldAccessor(header, field, offset, path)
+
+    def field_get_offset(self, header, data, offset, path,
+                         default=...,
+                         use_nil=True, use_str=True,
+                         ):
+        """
+        Buffer version of :meth:`field_get`, where offset is the start of this struct within data.
+        """
+        assert(type(path) == bytes)
+
+        accessor = self.field_accessor_from_path(header, path)
+        if accessor is None:
+            if default is not ...:
+                return default
+            else:
+                raise KeyError("%r not found in %r (%r)" % (path, [f.dna_name.name_only for f in self.fields], self.dna_type_id))
+
+        return accessor.decode(data, offset + accessor.offset, use_nil=use_nil, use_str=use_str)
+
+
+class DNAFieldAccessor:
+    """
+    A field path resolved once for a struct,
+    so reading the value only needs an offset and an unpack.
+    """
+    __slots__ = (
+        # DNAField
+        "field",
+        # offset from the start of the struct
+        "offset",
+        # number of bytes used by the value
+        "size",
+        # struct.Struct, or None for char arrays (and unsupported types)
+        "unpack",
+        # bytes (for error reports)
+        "path",
+        )
+
+    def __init__(self, header, field, offset, path):
+        self.field = field
+        self.offset = offset
+        self.path = path
+
+        dna_type_id = field.dna_type.dna_type_id
+        if field.dna_name.is_pointer:
+            if header.pointer_size == 4:
+                self.unpack = DNA_IO.UINT[header.endian_index]
+            else:
+                self.unpack = DNA_IO.ULONG[header.endian_index]
+        elif dna_type_id == b'int':
+            self.unpack = DNA_IO.SINT[header.endian_index]
+        elif dna_type_id == b'short':
+            self.unpack = DNA_IO.SSHORT[header.endian_index]
+        elif dna_type_id == b'float':
+            self.unpack = DNA_IO.FLOAT[header.endian_index]
+        else:
+            self.unpack = None
+
+        if self.unpack is not None:
+            self.size = self.unpack.size
+        elif dna_type_id == b'char':
+            self.size = field.dna_name.array_size
+        else:
+            self.size = 0
+
+    def decode(self, data, offset, use_nil=True, use_str=True):
+        """
+        Read the value from a buffer, offset is the start of the value.
+        """
+        if self.unpack is not None:
+            return self.unpack.unpack_from(data, offset)[0]
+
+        dna_name = self.field.dna_name
+        if self.field.dna_type.dna_type_id == b'char':
+            if use_nil:
+                value = DNA_IO.read_bytes0_offset(data, offset, dna_name.array_size)
+            else:
+                value = DNA_IO.read_bytes_offset(data, offset, dna_name.array_size)
+            if use_str:
+                value = value.decode('utf-8')
+            return value
+        else:
+            raise NotImplementedError("%r exists but isn't pointer, can't resolve field %r" % (self.path, dna_name.name_only))
+
+    def encode(self, value):
+        """
+        Return the bytes to write for this value.
+        """
+        field = self.field
+        if field.dna_type.dna_type_id == b'char':
+            if type(value) is str:
+                value = value.encode('utf-8')
+            assert(isinstance(value, (bytes, bytearray)))
+            fieldlen = field.dna_name.array_size
+            if len(value) >= fieldlen:
+                return value[0:fieldlen]
+            else:
+                return value + b'\0'
+        else:
+            raise NotImplementedError("Setting %r is not yet supported" % field.dna_type.dna_type_id)
+
 
 class DNA_IO:
     """
@@ -745,12 +2835,14 @@ class DNA_IO:
 
     @staticmethod
     def read_bytes(handle, length):
+        if _stats is not None:
+            _stats.read_add(length)
         data = handle.read(length)
         return data
 
     @staticmethod
     def read_bytes0(handle, length):
-        data = handle.read(length)
+        data = DNA_IO.read_bytes(handle, length)
         return DNA_IO.read_data0(data)
 
     @staticmethod
@@ -761,10 +2853,18 @@ class DNA_IO:
     def read_string0(handle, length):
         return DNA_IO.read_bytes0(handle, length).decode('utf-8')
 
+    @staticmethod
+    def read_bytes_offset(data, offset, length):
+        return bytes(data[offset:offset + length])
+
+    @staticmethod
+    def read_bytes0_offset(data, offset, length):
+        return DNA_IO.read_data0(DNA_IO.read_bytes_offset(data, offset, length))
+
     @staticmethod
     def read_data0_offset(data, offset):
         add = data.find(b'\0', offset) - offset
-        return data[offset:offset + add]
+        return bytes(data[offset:offset + add])
 
     @staticmethod
     def read_data0(data):
@@ -776,39 +2876,42 @@ class DNA_IO:
     @staticmethod
     def read_ushort(handle, fileheader):
         st = DNA_IO.USHORT[fileheader.endian_index]
-        return st.unpack(handle.read(st.size))[0]
+        return st.unpack(DNA_IO.read_bytes(handle, st.size))[0]
 
     UINT = struct.Struct(b'<I'), struct.Struct(b'>I')
 
     @staticmethod
     def read_uint(handle, fileheader):
         st = DNA_IO.UINT[fileheader.endian_index]
-        return st.unpack(handle.read(st.size))[0]
+        return st.unpack(DNA_IO.read_bytes(handle, st.size))[0]
 
     SINT = struct.Struct(b'<i'), struct.Struct(b'>i')
 
     @staticmethod
     def read_int(handle, fileheader):
         st = DNA_IO.SINT[fileheader.endian_index]
-        return st.unpack(handle.read(st.size))[0]
+        return st.unpack(DNA_IO.read_bytes(handle, st.size))[0]
+
+    FLOAT = struct.Struct(b'<f'), struct.Struct(b'>f')
 
     @staticmethod
     def read_float(handle, fileheader):
-        return struct.unpack(fileheader.endian_str + b'f', handle.read(4))[0]
+        st = DNA_IO.FLOAT[fileheader.endian_index]
+        return st.unpack(DNA_IO.read_bytes(handle, st.size))[0]
 
     SSHORT = struct.Struct(b'<h'), struct.Struct(b'>h')
 
     @staticmethod
     def read_short(handle, fileheader):
         st = DNA_IO.SSHORT[fileheader.endian_index]
-        return st.unpack(handle.read(st.size))[0]
+        return st.unpack(DNA_IO.read_bytes(handle, st.size))[0]
 
     ULONG = struct.Struct(b'<Q'), struct.Struct(b'>Q')
 
     @staticmethod
     def read_ulong(handle, fileheader):
         st = DNA_IO.ULONG[fileheader.endian_index]
-        return st.unpack(handle.read(st.size))[0]
+        return st.unpack(DNA_IO.read_bytes(handle, st.size))[0]
 
     @staticmethod
     def read_pointer(handle, header):
@@ -818,7 +2921,34 @@ class DNA_IO:
         """
         if header.pointer_size == 4:
             st = DNA_IO.UINT[header.endian_index]
-            return st.unpack(handle.read(st.size))[0]
+            return st.unpack(DNA_IO.read_bytes(handle, st.size))[0]
         if header.pointer_size == 8:
             st = DNA_IO.ULONG[header.endian_index]
-            return st.unpack(handle.read(st.size))[0]
+            return st.unpack(DNA_IO.read_bytes(handle, st.size))[0]
+
+    # native byte order, pointer arrays in other files are swapped after reading.
+    ENDIAN_NATIVE = (sys.byteorder == 'little')
+
+    @staticmethod
+    def read_pointers(data, header):
+        """
+        reads an array of pointers from a buffer (all of it, as a single copy)
+        the pointer size is given by the header (BlendFileHeader)
+        """
+        pointers = array.array('Q' if header.pointer_size == 8 else 'I')
+        assert(pointers.itemsize == header.pointer_size)
+        pointers.frombytes(data)
+        if header.is_little_endian != DNA_IO.ENDIAN_NATIVE:
+            pointers.byteswap()
+        return pointers
+
+    @staticmethod
+    def read_pointer_offset(data, offset, header):
+        """
+        reads an pointer from a buffer at offset
+        the pointer size is given by the header (BlendFileHeader)
+        """
+        if header.pointer_size == 4:
+            return DNA_IO.UINT[header.endian_index].unpack_from(data, offset)[0]
+        if header.pointer_size == 8:
+            return DNA_IO.ULONG[header.endian_index].unpack_from(data, offset)[0]
@@ -164,6 +164,9 @@ def pack(
     path_temp_files = set()
     path_copy_files = set()
 
+    # source directories are listed once
+    dir_cache = blendfile_path_walker.DirectoryCache()
+
     # path_temp_files --> original-location
     path_temp_files_orig = {}
 
@@ -364,7 +367,7 @@ def pack(
             path_copy_files.add((path_src, path_dst))
 
             for file_list in (
-                    blendfile_path_walker.utils.find_sequence_paths(path_src) if fp.is_sequence else (),
+                    blendfile_path_walker.utils.find_sequence_paths(path_src, dir_cache=dir_cache) if fp.is_sequence else (),
                     fp.files_siblings(),
                     ):
 
@@ -429,7 +432,7 @@ def pack(
 
         for src, dst in path_copy_files:
             # reports are handled again, later on.
-            if os.path.exists(src):
+            if dir_cache.exists(src):
                 paths_uuid[os.path.relpath(dst, base_dir_dst).decode('utf-8')] = uuid_from_file(src)
         # XXX, better way to store temp target
         blendfile_dst_tmp = temp_remap_cb(blendfile_src, base_dir_src)
@@ -465,7 +468,7 @@ def pack(
             assert(b'.blend' not in dst)
 
             # in rare cases a filepath could point to a directory
-            if (not os.path.exists(src)) or os.path.isdir(src):
+            if (not dir_cache.exists(src)) or dir_cache.isdir(src):
                 yield report("  %s: %r\n" % (colorize("source missing", color='red'), src))
             else:
                 yield report("  %s: %r -> %r\n" % (colorize("copying", color='blue'), src, dst))
@@ -503,7 +506,7 @@ def pack(
                 assert(not dst.endswith(b'.blend'))
 
                 # in rare cases a filepath could point to a directory
-                if (not os.path.exists(src)) or os.path.isdir(src):
+                if (not dir_cache.exists(src)) or dir_cache.isdir(src):
                     yield report("  %s: %r\n" % (colorize("source missing", color='red'), src))
                 else:
                     yield report("  %s: %r -> <archive>\n" % (colorize("copying", color='blue'), src))
@@ -122,6 +122,8 @@ def start(
     # First walk over all blends
     from bam.blend import blendfile_path_walker
 
+    dir_cache = blendfile_path_walker.DirectoryCache()
+
     for blendfile_src in _iter_files(paths, check_ext=_is_blend):
         if not is_quiet:
             info("blend read: %r" % blendfile_src)
@@ -138,7 +140,7 @@ def start(
             # so we can update the reference
             f_abs = fp.filepath_absolute
             f_abs = os.path.normpath(f_abs)
-            if os.path.exists(f_abs):
+            if dir_cache.exists(f_abs):
                 files_to_map.add(f_abs)
             else:
                 if not is_quiet:
@@ -21,7 +21,6 @@
 import os
 # gives problems with scripts that use stdout, for testing 'bam deps' for eg.
 VERBOSE = False  # os.environ.get('BAM_VERBOSE', False)
-TIMEIT = False
 
 
 class C_defs:
@@ -123,10 +122,14 @@ class FPElem:
         this lets us replay the edits later.
         (so we can replay them onto the clients local cache without a file transfer).
         """
-        import struct
         assert(type(filepath) is bytes)
         assert(type(path) is bytes)
         ofs, size = block.get_file_offset(path)
+        FPElem._filepath_assign_edits_offset(ofs, size, filepath, binary_edits)
+
+    @staticmethod
+    def _filepath_assign_edits_offset(ofs, size, filepath, binary_edits):
+        assert(type(filepath) is bytes)
         # ensure we dont write past the field size & allow for \0
         filepath = filepath[:size - 1]
         binary_edits.append((ofs, filepath + b'\0'))
@@ -201,10 +204,63 @@ class FPElem_sequence_image_seq(FPElem_sequence_single):
         block, path, sub_block, sub_path = self.userdata
 
         array = block.get_pointer(b'stripdata')
-        files = [array.get(b'name', use_str=False, base_index=i) for i in range(array.count)]
+        files = array.get_all(b'name', use_str=False)
         return files
 
 
+class FPElem_index(FPElem):
+    """
+    Path read from a :class:`BlendFileIndex` (the blend file isn't open),
+    paths can't be assigned, only written as binary edits.
+        userdata = (filepath, ((offset, size), ...), files_siblings)
+
+    Where there are 2 fields, the path is split into directory and file name
+    (as with :class:`FPElem_sequence_single`).
+    """
+    __slots__ = ()
+
+    def files_siblings(self):
+        return self.userdata[2]
+
+    @staticmethod
+    def userdata_from_fp(fp):
+        """
+        Return the userdata for any path (its blend file must be open).
+        """
+        if type(fp) is FPElem_index:
+            return fp.userdata
+        userdata = fp.userdata
+        # pairs of (block, path)
+        fields = tuple(
+                userdata[i].get_file_offset(userdata[i + 1])
+                for i in range(0, len(userdata), 2))
+        return (fp.filepath, fields, fp.files_siblings())
+
+    @staticmethod
+    def from_fp(fp):
+        """
+        Return a copy of a path which doesn't need the blend file to be open.
+        """
+        fp_index = FPElem_index(fp.basedir, fp.level, FPElem_index.userdata_from_fp(fp))
+        fp_index.is_sequence = fp.is_sequence
+        return fp_index
+
+    def _get_cb(self):
+        return self.userdata[0]
+
+    def _set_cb(self, filepath):
+        raise RuntimeError("paths read from an index are read-only")
+
+    def _set_cb_edits(self, filepath, binary_edits):
+        fields = self.userdata[1]
+        if len(fields) == 1:
+            self._filepath_assign_edits_offset(*fields[0], filepath, binary_edits)
+        else:
+            head, sep, tail = utils.splitpath(filepath)
+            self._filepath_assign_edits_offset(*fields[0], head + sep, binary_edits)
+            self._filepath_assign_edits_offset(*fields[1], tail, binary_edits)
+
+
 class FilePath:
     __slots__ = ()
 
@@ -241,12 +297,186 @@ class FilePath:
             # These callbacks run on enter-exit blend files
             # so you can keep track of what file and level you're at.
             blendfile_level_cb=(None, None),
+
+            # optional BlendFile to use instead of opening 'filepath'
+            # (eg: from BlendFile.from_buffer), the caller closes it.
+            blend=None,
+
+            # optional 'concurrent.futures.Executor' (read-only),
+            # each library linked from this file is walked as a separate task.
+            # paths from libraries don't reference open blend files (see 'FPElem_index')
+            # and 'blendfile_level_cb' isn't called for them.
+            executor=None,
+            # with an executor, output libraries in the same order as walking them one at a time
+            # (otherwise as each library completes).
+            ordered=False,
+
+            # optional callback, run before reading each blend file, takes arguments:
+            # (filepath, level, files_visited, files_queued)
+            # to cancel, close the generator (the open blend file is closed too).
+            progress_cb=None,
             ):
+        """
+        Visit the paths used by a blend file (and its libraries when ``recursive`` is set),
+        yielding ``(FPElem, extra_info)`` items.
+
+        Libraries are walked depth first using a work queue of blend files (rather than recursion),
+        so the cost for each item doesn't depend on the library depth.
+        """
         # print(level, block_codes)
         import os
 
+        if (executor is not None) and (not readonly):
+            raise RuntimeError("walking libraries using an executor is only supported when read-only")
+
         filepath = os.path.abspath(filepath)
 
+        if rootdir is None:
+            rootdir = os.path.dirname(filepath)
+
+        if lib_visit is None:
+            lib_visit = {}
+
+        blendfile_level_cb_enter, blendfile_level_cb_exit = blendfile_level_cb
+
+        # Work queue, used as a stack so libraries are walked in the same order as recursion would.
+        # [(filepath, block_codes, level, filepath_parent), ...]
+        # where 'block_codes' is '...' once the file (and its libraries) have been walked.
+        queue = [(filepath, block_codes, level, None)]
+        files_visited = 0
+
+        while queue:
+            filepath_item, block_codes_item, level_item, filepath_parent = queue.pop()
+
+            if block_codes_item is ...:
+                if blendfile_level_cb_exit is not None:
+                    blendfile_level_cb_exit(filepath_item)
+                continue
+
+            # libraries are checked when they're reached,
+            # since walking previous libraries may have visited their ID's.
+            if filepath_parent is not None:
+                if not FilePath._visit_lib_test(
+                        filepath_item, block_codes_item, level_item, filepath_parent, lib_visit):
+                    continue
+
+            if progress_cb is not None:
+                progress_cb(filepath_item, level_item, files_visited, len(queue))
+
+            if blendfile_level_cb_enter is not None:
+                blendfile_level_cb_enter(filepath_item)
+
+            blend_item = blend if filepath_parent is None else None
+
+            # libraries are walked the same way for every file linking them,
+            # so their results can be reused (paths can't be modified though).
+            if (level_item > 0) and readonly and (temp_remap_cb is None) and (blend_item is None):
+                visit_blend_file = LibraryExpandCache.visit_blend_file
+            else:
+                visit_blend_file = FilePath._visit_blend_file
+
+            lib_all = yield from visit_blend_file(
+                    filepath_item,
+                    readonly=readonly,
+                    temp_remap_cb=temp_remap_cb,
+                    recursive=recursive,
+                    # libraries only expand the ID's linked from them.
+                    recursive_all=recursive_all if filepath_parent is None else False,
+                    block_codes=block_codes_item,
+                    rootdir=rootdir,
+                    level=level_item,
+                    lib_visit=lib_visit,
+                    blend=blend_item,
+                    )
+            files_visited += 1
+
+            queue.append((filepath_item, ..., level_item, None))
+
+            if not lib_all:
+                continue
+
+            basedir = os.path.dirname(filepath_item)
+            lib_all = [
+                (os.path.normpath(utils.compatpath(utils.abspath(lib_path, basedir))), lib_block_codes)
+                for lib_path, lib_block_codes in lib_all
+                ]
+
+            if (executor is not None) and (filepath_parent is None):
+                lib_tasks = [
+                    (lib_path_abs, lib_block_codes)
+                    for lib_path_abs, lib_block_codes in lib_all
+                    if FilePath._visit_lib_test(lib_path_abs, lib_block_codes, level_item + 1, filepath_item, lib_visit)
+                    ]
+                if lib_tasks:
+                    yield from FilePath._visit_from_blend_executor(
+                            executor, ordered, lib_tasks, lib_visit,
+                            temp_remap_cb=temp_remap_cb,
+                            recursive_all=False,
+                            rootdir=rootdir,
+                            level=level_item + 1,
+                            )
+            else:
+                # note, sorting - isn't needed, it just gives predictable load-order.
+                for lib_path_abs, lib_block_codes in reversed(lib_all):
+                    queue.append((lib_path_abs, lib_block_codes, level_item + 1, filepath_item))
+
+    @staticmethod
+    def _visit_lib_test(lib_path_abs, lib_block_codes, level, filepath_parent, lib_visit):
+        """
+        Return True when the library should be walked,
+        removes ID names which have been visited from 'lib_block_codes'.
+        """
+        import os
+
+        if VERBOSE:
+            indent_str = "  " * level
+
+        # if we visited this before,
+        # check we don't follow the same links more than once
+        lib_block_codes_existing = lib_visit.setdefault(lib_path_abs, set())
+        lib_block_codes -= lib_block_codes_existing
+
+        # don't touch them again
+        # XXX, this is now maintained in "_expand_generic_material"
+        # lib_block_codes_existing.update(lib_block_codes)
+
+        # print("looking for", lib_block_codes)
+
+        if not lib_block_codes:
+            if VERBOSE:
+                print(indent_str, "Library Skipped (visited): ", filepath_parent, " -> ", lib_path_abs, sep="")
+            return False
+
+        if not os.path.exists(lib_path_abs):
+            if VERBOSE:
+                print(indent_str, "Library Missing: ", filepath_parent, " -> ", lib_path_abs, sep="")
+            return False
+
+        # import IPython; IPython.embed()
+        if VERBOSE:
+            print(indent_str, "Library: ", filepath_parent, " -> ", lib_path_abs, sep="")
+            # print(indent_str, lib_block_codes)
+        return True
+
+    @staticmethod
+    def _visit_blend_file(
+            filepath,
+            readonly,
+            temp_remap_cb,
+            recursive,
+            recursive_all,
+            block_codes,
+            rootdir,
+            level,
+            lib_visit,
+            blend,
+            ):
+        """
+        Yield the paths of a single blend file (see :meth:`visit_from_blend`),
+        returns a list of libraries to walk ``[(lib_path, lib_block_codes), ...]`` when recursive.
+        """
+        import os
+
         if VERBOSE:
             indent_str = "  " * level
             # print(indent_str + "Opening:", filepath)
@@ -256,19 +486,7 @@ class FilePath:
             log_deps.info("%s%s" % (indent_str, filepath.decode('utf-8')))
             log_deps.info("%s%s" % (indent_str, set_as_str(block_codes)))
 
-        blendfile_level_cb_enter, blendfile_level_cb_exit = blendfile_level_cb
-
-        if blendfile_level_cb_enter is not None:
-            blendfile_level_cb_enter(filepath)
-
         basedir = os.path.dirname(filepath)
-        if rootdir is None:
-            rootdir = basedir
-
-        if lib_visit is None:
-            lib_visit = {}
-
-
 
         if recursive and (level > 0) and (block_codes is not None) and (recursive_all is False):
             # prevent from expanding the
@@ -287,7 +505,7 @@ class FilePath:
             lib_block_codes_existing = lib_visit.setdefault(filepath, set())
 
             # only for this block
-            def _expand_codes_add_test(block, code):
+            def _expand_codes_add_test(block, code, id_name):
                 # return True, if the ID should be searched further
                 #
                 # we could investigate a better way...
@@ -298,7 +516,8 @@ class FilePath:
                         expand_codes_idlib.setdefault(block[b'lib'], set()).add(block[b'name'])
                     return False
                 else:
-                    id_name = block[b'id.name']
+                    if id_name is None:
+                        id_name = block[b'id.name']
 
                     # if we touched this already, don't touch again
                     # (else we may modify the same path multiple times)
@@ -324,20 +543,22 @@ class FilePath:
                     expand_addr_visit.add(block.addr_old)
                     return (len_prev != len(expand_addr_visit))
 
-            def block_expand(block, code):
-                assert(block.code == code)
-                if _expand_codes_add_test(block, code):
-                    yield block
-
+            def block_expand(block, code, id_name=None):
+                # depth first, using a stack
+                stack = [(block, code, id_name)]
+                while stack:
+                    block, code, id_name = stack.pop()
                     assert(block.code == code)
-                    fn = ExpandID.expand_funcs.get(code)
-                    if fn is not None:
-                        for sub_block in fn(block):
-                            if sub_block is not None:
-                                yield from block_expand(sub_block, sub_block.code)
-                else:
-                    if code == b'ID':
+                    if _expand_codes_add_test(block, code, id_name):
                         yield block
+
+                        sub_blocks = [
+                            sub_block for sub_block in ExpandID.expand_block(block)
+                            if sub_block is not None]
+                        stack.extend((sub_block, sub_block.code, None) for sub_block in reversed(sub_blocks))
+                    else:
+                        if code == b'ID':
+                            yield block
         else:
             expand_addr_visit = None
 
@@ -347,7 +568,7 @@ class FilePath:
             # never set
             block_codes_idlib = None
 
-            def block_expand(block, code):
+            def block_expand(block, code, id_name=None):
                 assert(block.code == code)
                 yield block
 
@@ -364,9 +585,12 @@ class FilePath:
                 return blend.find_blocks_from_code(b'LI')
         else:
             def iter_blocks_id(code):
-                for block in blend.find_blocks_from_code(code):
-                    if block[b'id.name'] in block_codes:
-                        yield from block_expand(block, code)
+                id_name_index = blend.id_name_index(code)
+                # keep the file order
+                for id_name, block in sorted(
+                        ((id_name, id_name_index[id_name]) for id_name in block_codes.intersection(id_name_index)),
+                        key=lambda item: item[1].file_offset):
+                    yield from block_expand(block, code, id_name)
 
             if block_codes_idlib is not None:
                 def iter_blocks_idlib():
@@ -378,120 +602,118 @@ class FilePath:
                 def iter_blocks_idlib():
                     return blend.find_blocks_from_code(b'LI')
 
-        if temp_remap_cb is not None:
-            filepath_tmp = temp_remap_cb(filepath, rootdir)
-        else:
-            filepath_tmp = filepath
-
         # store info to pass along with each iteration
         extra_info = rootdir, os.path.basename(filepath)
 
-        from bam.blend import blendfile
-        blend = blendfile.open_blend(filepath_tmp, "rb" if readonly else "r+b")
-
-        for code in blend.code_index.keys():
-            # handle library blocks as special case
-            if ((len(code) != 2) or
-                (code in {
-                    # libraries handled below
-                    b'LI',
-                    b'ID',
-                    # unneeded
-                    b'WM',
-                    b'SN',  # bScreen
-                    })):
-
-                continue
-
-            # if VERBOSE:
-            #     print("  Scanning", code)
-
-            for block in iter_blocks_id(code):
-                yield from FilePath.from_block(block, basedir, extra_info, level)
-
-        # print("A:", expand_addr_visit)
-        # print("B:", block_codes)
-        if VERBOSE:
-            log_deps.info("%s%s" % (indent_str, set_as_str(expand_addr_visit)))
-
-        if recursive:
+        if blend is None:
+            if temp_remap_cb is not None:
+                filepath_tmp = temp_remap_cb(filepath, rootdir)
+            else:
+                filepath_tmp = filepath
 
-            if expand_codes_idlib is None:
-                expand_codes_idlib = {}
-                for block in blend.find_blocks_from_code(b'ID'):
-                    expand_codes_idlib.setdefault(block[b'lib'], set()).add(block[b'name'])
+            if readonly and (temp_remap_cb is None) and (BlendFileIndex.cache_dir is not None):
+                blend = BlendFileIndex.from_cache(filepath)
+            else:
+                from bam.blend import blendfile
+                blend = blendfile.open_blend(
+                        filepath_tmp, "rb" if readonly else "r+b",
+                        use_mmap=readonly,
+                        use_journal=not readonly,
+                        )
+            use_close = True
+        else:
+            use_close = False
+
+        lib_all = None
+
+        try:
+            for code in blend.code_index.keys():
+                # handle library blocks as special case
+                if ((len(code) != 2) or
+                    (code in {
+                        # libraries handled below
+                        b'LI',
+                        b'ID',
+                        # unneeded
+                        b'WM',
+                        b'SN',  # bScreen
+                        })):
 
-            # look into libraries
-            lib_all = []
+                    continue
 
-            for lib_id, lib_block_codes in sorted(expand_codes_idlib.items()):
-                lib = blend.find_block_from_offset(lib_id)
-                lib_path = lib[b'name']
+                # if VERBOSE:
+                #     print("  Scanning", code)
 
-                # get all data needed to read the blend files here (it will be freed!)
-                # lib is an address at the moment, we only use as a way to group
+                for block in iter_blocks_id(code):
+                    yield from FilePath.from_block(block, basedir, extra_info, level)
 
-                lib_all.append((lib_path, lib_block_codes))
-                # import IPython; IPython.embed()
+            # print("A:", expand_addr_visit)
+            # print("B:", block_codes)
+            if VERBOSE:
+                log_deps.info("%s%s" % (indent_str, set_as_str(expand_addr_visit)))
 
-                # ensure we expand indirect linked libs
-                if block_codes_idlib is not None:
-                    block_codes_idlib.add(lib_path)
+            if recursive:
 
-        # do this after, incase we mangle names above
-        for block in iter_blocks_idlib():
-            yield from FilePath.from_block(block, basedir, extra_info, level)
+                if expand_codes_idlib is None:
+                    expand_codes_idlib = {}
+                    for block in blend.find_blocks_from_code(b'ID'):
+                        expand_codes_idlib.setdefault(block[b'lib'], set()).add(block[b'name'])
 
-        blend.close()
+                # look into libraries
+                lib_all = []
 
-        # ----------------
-        # Handle Recursive
-        if recursive:
-            # now we've closed the file, loop on other files
+                for lib_id, lib_block_codes in sorted(expand_codes_idlib.items()):
+                    lib = blend.find_block_from_offset(lib_id)
+                    lib_path = lib[b'name']
 
-            # note, sorting - isn't needed, it just gives predictable load-order.
-            for lib_path, lib_block_codes in lib_all:
-                lib_path_abs = os.path.normpath(utils.compatpath(utils.abspath(lib_path, basedir)))
+                    # get all data needed to read the blend files here (it will be freed!)
+                    # lib is an address at the moment, we only use as a way to group
 
-                # if we visited this before,
-                # check we don't follow the same links more than once
-                lib_block_codes_existing = lib_visit.setdefault(lib_path_abs, set())
-                lib_block_codes -= lib_block_codes_existing
+                    lib_all.append((lib_path, lib_block_codes))
+                    # import IPython; IPython.embed()
 
-                # don't touch them again
-                # XXX, this is now maintained in "_expand_generic_material"
-                # lib_block_codes_existing.update(lib_block_codes)
+                    # ensure we expand indirect linked libs
+                    if block_codes_idlib is not None:
+                        block_codes_idlib.add(lib_path)
 
-                # print("looking for", lib_block_codes)
+            # do this after, incase we mangle names above
+            for block in iter_blocks_idlib():
+                yield from FilePath.from_block(block, basedir, extra_info, level)
+        finally:
+            if use_close:
+                blend.close()
 
-                if not lib_block_codes:
-                    if VERBOSE:
-                        print((indent_str + "  "), "Library Skipped (visited): ", filepath, " -> ", lib_path_abs, sep="")
-                    continue
+        return lib_all
 
-                if not os.path.exists(lib_path_abs):
-                    if VERBOSE:
-                        print((indent_str + "  "), "Library Missing: ", filepath, " -> ", lib_path_abs, sep="")
-                    continue
+    @staticmethod
+    def _visit_from_blend_executor(executor, ordered, lib_tasks, lib_visit, **kwargs):
+        """
+        Walk libraries as executor tasks, each with a copy of 'lib_visit' (merged back as tasks complete).
 
-                # import IPython; IPython.embed()
-                if VERBOSE:
-                    print((indent_str + "  "), "Library: ", filepath, " -> ", lib_path_abs, sep="")
-                    # print((indent_str + "  "), lib_block_codes)
-                yield from FilePath.visit_from_blend(
-                        lib_path_abs,
-                        readonly=readonly,
-                        temp_remap_cb=temp_remap_cb,
-                        recursive=True,
-                        block_codes=lib_block_codes,
-                        rootdir=rootdir,
-                        level=level + 1,
-                        lib_visit=lib_visit,
-                        blendfile_level_cb=blendfile_level_cb,
-                        )
+        Since tasks don't share 'lib_visit', data linked from multiple libraries may be found more than once,
+        these duplicates are skipped.
+        """
+        import concurrent.futures
+
+        futures = [
+            executor.submit(
+                    _visit_from_blend_task, lib_path_abs,
+                    dict(kwargs, block_codes=lib_block_codes, lib_visit={k: v.copy() for k, v in lib_visit.items()}),
+                    )
+            for lib_path_abs, lib_block_codes in lib_tasks
+            ]
 
-        if blendfile_level_cb_exit is not None:
-            blendfile_level_cb_exit(filepath)
+        # {(basedir, blend basename, fields), ...}
+        paths_visit = set()
+        for future in (futures if ordered else concurrent.futures.as_completed(futures)):
+            result, task_lib_visit = future.result()
+            for lib_path_abs, lib_block_codes in task_lib_visit.items():
+                lib_visit.setdefault(lib_path_abs, set()).update(lib_block_codes)
+            for fp, extra_info in result:
+                key = (fp.basedir, extra_info[1], fp.userdata[1])
+                if key not in paths_visit:
+                    paths_visit.add(key)
+                    yield fp, extra_info
 
     # ------------------------------------------------------------------------
     # Direct filepaths from Blocks
@@ -501,6 +723,12 @@ class FilePath:
     @staticmethod
     def from_block(block, basedir, extra_info, level):
         assert(block.code != b'DATA')
+        if type(block) is BlendFileIndexBlock:
+            for is_sequence, userdata in block.paths:
+                fp = FPElem_index(basedir, level, userdata)
+                fp.is_sequence = is_sequence
+                yield fp, extra_info
+            return
         fn = FilePath._from_block_dict.get(block.code)
         if fn is not None:
             yield from fn(block, basedir, extra_info, level)
@@ -522,11 +750,13 @@ class FilePath:
 
     @staticmethod
     def _from_block_IM(block, basedir, extra_info, level):
+        image_source, packedfile = block.read_fields((b'source', b'packedfile'), default=None)
         # old files miss this
-        image_source = block.get(b'source', C_defs.IMA_SRC_FILE)
+        if image_source is None:
+            image_source = C_defs.IMA_SRC_FILE
         if image_source not in {C_defs.IMA_SRC_FILE, C_defs.IMA_SRC_SEQUENCE, C_defs.IMA_SRC_MOVIE}:
             return
-        if block[b'packedfile']:
+        if packedfile:
             return
 
         fp = FPElem_block_path(basedir, level, (block, b'name'))
@@ -536,9 +766,10 @@ class FilePath:
 
     @staticmethod
     def _from_block_VF(block, basedir, extra_info, level):
-        if block[b'packedfile']:
+        packedfile, name = block.read_fields((b'packedfile', b'name'))
+        if packedfile:
             return
-        if block[b'name'] != b'<builtin>':  # builtin font
+        if name != b'<builtin>':  # builtin font
             yield FPElem_block_path(basedir, level, (block, b'name')), extra_info
 
     @staticmethod
@@ -563,13 +794,20 @@ class FilePath:
             sdna_index_Sequence = block.file.sdna_index_from_id[b'Sequence']
 
             def seqbase(someseq):
-                for item in someseq:
+                # meta strips nest, walk them using a stack of lists
+                stack = [someseq]
+                while stack:
+                    item = next(stack[-1], None)
+                    if item is None:
+                        stack.pop()
+                        continue
+
                     item_type = item.get(b'type', sdna_index_refine=sdna_index_Sequence)
 
                     if item_type >= C_defs.SEQ_TYPE_EFFECT:
                         pass
                     elif item_type == C_defs.SEQ_TYPE_META:
-                        yield from seqbase(bf_utils.iter_ListBase(
+                        stack.append(bf_utils.iter_ListBase(
                                 item.get_pointer(b'seqbase.first', sdna_index_refine=sdna_index_Sequence)))
                     else:
                         item_strip = item.get_pointer(b'strip', sdna_index_refine=sdna_index_Sequence)
@@ -601,25 +839,47 @@ class FilePath:
         }
 
 
+def _visit_from_blend_task(filepath, kwargs):
+    """
+    Executor task for :meth:`FilePath.visit_from_blend`,
+    (module level so it can be used by process pools).
+
+    Returns a list of the paths (as :class:`FPElem_index`) and the updated 'lib_visit'.
+    """
+    lib_visit = kwargs["lib_visit"]
+    result = [
+        (FPElem_index.from_fp(fp), extra_info)
+        for fp, extra_info in FilePath.visit_from_blend(filepath, readonly=True, recursive=True, **kwargs)
+        ]
+    return result, lib_visit
+
+
 class bf_utils:
     @staticmethod
     def iter_ListBase(block, next_item=b'next'):
-        while block:
+        if block is None:
+            return
+        bf = block.file
+        # the offset of 'next_item' for each struct type in the list
+        next_offsets = {}
+        while block is not None:
             yield block
-            block = block.file.find_block_from_offset(block[next_item])
+            sdna_index = block.sdna_index
+            next_offset = next_offsets.get(sdna_index)
+            if next_offset is None:
+                accessor = bf.field_accessor(sdna_index, next_item)
+                if accessor is None:
+                    raise KeyError("%r not found in %r" % (next_item, bf.structs[sdna_index].dna_type_id))
+                next_offset = next_offsets[sdna_index] = accessor.offset
+            block = bf.find_block_from_offset(bf.read_pointers(block.file_offset + next_offset, 1)[0])
 
+    @staticmethod
     def iter_array(block, length=-1):
         assert(block.code == b'DATA')
-        from bam.blend import blendfile
-        import os
-        handle = block.file.handle
-        header = block.file.header
-
-        for i in range(length):
-            block.file.handle.seek(block.file_offset + (header.pointer_size * i), os.SEEK_SET)
-            offset = blendfile.DNA_IO.read_pointer(handle, header)
-            sub_block = block.file.find_block_from_offset(offset)
-            yield sub_block
+        bf = block.file
+        if length == -1:
+            length = block.size // bf.header.pointer_size
+        yield from bf.find_blocks_from_offsets(bf.read_pointers(block.file_offset, length))
 
 
 # -----------------------------------------------------------------------------
@@ -800,13 +1060,21 @@ class ExpandID:
             sdna_index_Sequence = block.file.sdna_index_from_id[b'Sequence']
 
             def seqbase(someseq):
-                for item in someseq:
+                # meta strips nest, walk them using a stack of lists
+                stack = [someseq]
+                while stack:
+                    item = next(stack[-1], None)
+                    if item is None:
+                        stack.pop()
+                        continue
+
                     item_type = item.get(b'type', sdna_index_refine=sdna_index_Sequence)
 
                     if item_type >= C_defs.SEQ_TYPE_EFFECT:
                         pass
                     elif item_type == C_defs.SEQ_TYPE_META:
-                        yield from seqbase(bf_utils.iter_ListBase(item.get_pointer(b'seqbase.first', sdna_index_refine=sdna_index_Sequence)))
+                        stack.append(bf_utils.iter_ListBase(
+                                item.get_pointer(b'seqbase.first', sdna_index_refine=sdna_index_Sequence)))
                     else:
                         if item_type == C_defs.SEQ_TYPE_SCENE:
                             yield item.get_pointer(b'scene')
@@ -832,6 +1100,381 @@ class ExpandID:
         if k.startswith("expand_")
         }
 
+    @staticmethod
+    def _dna_exclude_node_id(block, base_index):
+        return block.get(b'type', base_index=base_index) == 221  # CMP_NODE_R_LAYERS
+
+    @staticmethod
+    def _dna_exclude_particle_dup_ob(block, base_index):
+        return block.get(b'ren_as', base_index=base_index) != C_defs.PART_DRAW_OB
+
+    @staticmethod
+    def _dna_exclude_particle_dup_group(block, base_index):
+        return block.get(b'ren_as', base_index=base_index) != C_defs.PART_DRAW_GR
+
+    # pointers the 'expand_funcs' above don't follow,
+    # see 'BlendFile.find_id_references' for details.
+    dna_pointer_exclude = {
+        (b'bNode', b'id'): _dna_exclude_node_id.__func__,
+        (b'ParticleSettings', b'dup_ob'): _dna_exclude_particle_dup_ob.__func__,
+        (b'ParticleSettings', b'dup_group'): _dna_exclude_particle_dup_group.__func__,
+        (b'Scene', b'toolsettings'): None,
+        (b'FreestyleLineSet', b'linestyle'): None,
+        }
+
+    # when enabled, follow all pointers which may lead to an ID using the DNA
+    # (see 'BlendFile.find_id_references'), otherwise use the 'expand_funcs' above.
+    # Off by default, since the DNA finds references these functions don't follow
+    # (object parents, modifiers & constraints for example), see 'bam deps --dna'.
+    use_dna = False
+
+    @staticmethod
+    def expand_block(block):
+        """
+        Return the ID blocks referenced by this block (may include None).
+        """
+        if type(block) is BlendFileIndexBlock:
+            find_block_from_offset = block.file.find_block_from_offset
+            return [find_block_from_offset(addr) for addr in block.expand]
+        if ExpandID.use_dna:
+            if len(block.code) == 2 and block.code != b'ID':
+                return block.file.find_id_references(block, ExpandID.dna_pointer_exclude)
+            return ()
+        fn = ExpandID.expand_funcs.get(block.code)
+        if fn is not None:
+            return fn(block)
+        return ()
+
+
+# -----------------------------------------------------------------------------
+# Library Expand Cache
+
+class LibraryExpandCache:
+    """
+    Module like class, a process-wide LRU cache of the results of walking libraries.
+
+    When many blend files link the same libraries, each library is walked once for the ID's requested from it,
+    storing the paths found (as :class:`FPElem_index` data), the ID names visited and the libraries it links to,
+    so walking the same library again (from this or another blend file) doesn't read it.
+
+    Entries are keyed by the library path, modification time, size and inode, the ExpandID mode,
+    the ID names requested and those already visited (since these are skipped when expanding).
+    Only used when walking read-only, without remapping files.
+
+    The (approximate) size of all entries is kept under ``entries_size_max``.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, *args, **kwargs):
+        raise RuntimeError("%s should not be instantiated" % cls)
+
+    # {key: (paths, lib_all, lib_block_codes_visit, size)}, least recently used first
+    # where 'paths' is a tuple of (is_sequence, FPElem_index.userdata) items.
+    import collections
+    import threading
+    entries = collections.OrderedDict()
+    entries_size = 0
+    lock = threading.Lock()
+    del collections, threading
+    # the maximum size of all entries in bytes (0 to disable)
+    entries_size_max = 64 * 1024 * 1024
+
+    @staticmethod
+    def size_from_value(value):
+        """
+        Return the approximate memory used by a value made of tuples, sets, bytes & numbers
+        (items shared between values are counted each time).
+        """
+        import sys
+        size = 0
+        stack = [value]
+        while stack:
+            value = stack.pop()
+            size += sys.getsizeof(value)
+            if isinstance(value, (tuple, list, set, frozenset)):
+                stack.extend(value)
+        return size
+
+    @staticmethod
+    def visit_blend_file(filepath, **kwargs):
+        """
+        Cached version of :meth:`FilePath._visit_blend_file`.
+        """
+        import os
+        cls = LibraryExpandCache
+
+        block_codes = kwargs["block_codes"]
+        lib_visit = kwargs["lib_visit"]
+
+        try:
+            st = os.stat(filepath)
+        except OSError:
+            st = None
+        if (st is None) or (cls.entries_size_max == 0):
+            return (yield from FilePath._visit_blend_file(filepath, **kwargs))
+
+        lib_block_codes_existing = lib_visit.setdefault(filepath, set())
+        key = (
+            filepath, st.st_mtime_ns, st.st_size, st.st_ino,
+            kwargs["recursive"], kwargs["recursive_all"], ExpandID.use_dna,
+            frozenset(block_codes) if block_codes is not None else None,
+            frozenset(lib_block_codes_existing),
+            )
+
+        with cls.lock:
+            entry = cls.entries.get(key)
+            if entry is not None:
+                cls.entries.move_to_end(key)
+        if entry is not None:
+            paths, lib_all, lib_block_codes_visit, _size = entry
+            basedir = os.path.dirname(filepath)
+            level = kwargs["level"]
+            extra_info = kwargs["rootdir"], os.path.basename(filepath)
+            for is_sequence, userdata in paths:
+                fp = FPElem_index(basedir, level, userdata)
+                fp.is_sequence = is_sequence
+                yield fp, extra_info
+            lib_block_codes_existing.update(lib_block_codes_visit)
+            if lib_all is None:
+                return None
+            # callers may modify the ID names
+            return [(lib_path, set(lib_block_codes)) for lib_path, lib_block_codes in lib_all]
+
+        lib_block_codes_existing_prev = frozenset(lib_block_codes_existing)
+        paths = []
+        visit_iter = FilePath._visit_blend_file(filepath, **kwargs)
+        # can't use 'yield from', the path data is read while the file is open
+        try:
+            while True:
+                try:
+                    fp, extra_info = next(visit_iter)
+                except StopIteration as ex:
+                    lib_all = ex.value
+                    break
+                paths.append((fp.is_sequence, FPElem_index.userdata_from_fp(fp)))
+                yield fp, extra_info
+        finally:
+            # closes the blend file when the caller stops early
+            visit_iter.close()
+
+        entry = (
+            tuple(paths),
+            None if lib_all is None else
+            tuple((lib_path, frozenset(lib_block_codes)) for lib_path, lib_block_codes in lib_all),
+            frozenset(lib_block_codes_existing - lib_block_codes_existing_prev),
+            )
+        size = cls.size_from_value((key, entry))
+        if size > cls.entries_size_max:
+            return lib_all
+        with cls.lock:
+            entry_prev = cls.entries.pop(key, None)
+            if entry_prev is not None:
+                cls.entries_size -= entry_prev[3]
+            cls.entries[key] = entry + (size,)
+            cls.entries_size += size
+            while cls.entries_size > cls.entries_size_max:
+                _key, entry_prev = cls.entries.popitem(last=False)
+                cls.entries_size -= entry_prev[3]
+        return lib_all
+
+    @staticmethod
+    def clear():
+        cls = LibraryExpandCache
+        with cls.lock:
+            cls.entries.clear()
+            cls.entries_size = 0
+
+
+# -----------------------------------------------------------------------------
+# Blend File Index
+
+class BlendFileIndexBlock:
+    """
+    Stores the data of an ID block which the path walker uses.
+    """
+    __slots__ = (
+        # the BlendFileIndex
+        "file",
+        "code",
+        "addr_old",
+        # offset in the blend file (only used for ordering)
+        "file_offset",
+        # {path: value} for the ID names & library pointer
+        "values",
+        # [(is_sequence, FPElem_index.userdata), ...]
+        "paths",
+        # addresses of the ID blocks from ExpandID
+        "expand",
+        )
+
+    def __init__(self, file, code, addr_old, file_offset, values, paths, expand):
+        self.file = file
+        self.code = code
+        self.addr_old = addr_old
+        self.file_offset = file_offset
+        self.values = values
+        self.paths = paths
+        self.expand = expand
+
+    def __getitem__(self, path):
+        return self.values[path]
+
+    def __repr__(self):
+        return ("<%s.%s (%s), addr=%x>" %
+                (self.__class__.__name__, self.code.decode(), self.values.get(b'id.name'), self.addr_old))
+
+
+class BlendFileIndex:
+    """
+    A summary of a blend file, stored on disk so unchanged files don't need to be read again.
+
+    This has the same API as :class:`bam.blend.blendfile.BlendFile` used by :meth:`FilePath.visit_from_blend`,
+    only holding ID blocks (the ones with 2 letter codes), their names, paths and ID references.
+
+    Index files are keyed by the absolute path, checking the files size & modification time
+    (and the version & ExpandID mode they're written with).
+    They're stored using 'marshal' (data only, unlike 'pickle' loading them can't run code).
+    """
+    __slots__ = (
+        # blend file path (absolute, bytes)
+        "filepath",
+        # {code: [BlendFileIndexBlock, ...]} in the blend files order
+        "code_index",
+        # {addr_old: BlendFileIndexBlock}
+        "block_from_addr",
+        # {code: {id_name: BlendFileIndexBlock}} (created on demand)
+        "id_name_indices",
+        )
+
+    # optional directory to store indices on disk (eg: 'my_project/.bam/index')
+    # when None, blend files are always read
+    cache_dir = None
+
+    # increment when the data stored changes
+    VERSION = 5
+
+    # values stored for each code (for other codes only 'id.name')
+    VALUES_FROM_CODE = {
+        b'ID': (b'name', b'lib'),
+        b'LI': (b'id.name', b'name'),
+        }
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.code_index = {}
+        self.block_from_addr = {}
+        self.id_name_indices = {}
+
+    def __getstate__(self):
+        return (self.filepath, [
+            (code, [(block.addr_old, block.file_offset, block.values, block.paths, block.expand) for block in blocks])
+            for code, blocks in self.code_index.items()])
+
+    def __setstate__(self, state):
+        filepath, code_blocks = state
+        self.__init__(filepath)
+        for code, blocks in code_blocks:
+            for block_args in blocks:
+                self._block_add(code, *block_args)
+
+    def _block_add(self, code, addr_old, file_offset, values, paths, expand):
+        block = BlendFileIndexBlock(self, code, addr_old, file_offset, values, paths, expand)
+        self.code_index.setdefault(code, []).append(block)
+        self.block_from_addr[addr_old] = block
+
+    def find_blocks_from_code(self, code):
+        return self.code_index.get(code, [])
+
+    def find_block_from_offset(self, offset):
+        return self.block_from_addr.get(offset)
+
+    def id_name_index(self, code):
+        index = self.id_name_indices.get(code)
+        if index is None:
+            index = self.id_name_indices[code] = {
+                block.values[b'id.name']: block for block in self.find_blocks_from_code(code)}
+        return index
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def from_blend(blend, filepath):
+        """
+        Create an index from an open blend file.
+        """
+        index = BlendFileIndex(filepath)
+        for code, blocks in blend.code_index.items():
+            if len(code) != 2:
+                continue
+            value_paths = BlendFileIndex.VALUES_FROM_CODE.get(code, (b'id.name',))
+            for block in blocks:
+                paths = [
+                    (fp.is_sequence, FPElem_index.userdata_from_fp(fp))
+                    for fp, _extra_info in FilePath.from_block(block, b'', None, 0)]
+                # ExpandID only references ID blocks, which are all in the index
+                expand = [sub_block.addr_old for sub_block in ExpandID.expand_block(block) if sub_block is not None]
+                index._block_add(
+                        code, block.addr_old, block.file_offset,
+                        {path: block[path] for path in value_paths},
+                        paths, expand)
+        return index
+
+    @staticmethod
+    def _key(filepath):
+        import hashlib
+        return hashlib.sha1(filepath).hexdigest()
+
+    @staticmethod
+    def from_cache(filepath):
+        """
+        Return the index for the blend file, reading the blend file & writing the index when it's out of date.
+        """
+        import marshal
+        import tempfile
+        from bam.blend import blendfile
+
+        st = os.stat(filepath)
+        stat_key = (BlendFileIndex.VERSION, ExpandID.use_dna, filepath, st.st_size, st.st_mtime_ns)
+        filepath_index = os.path.join(BlendFileIndex.cache_dir, BlendFileIndex._key(filepath) + ".index")
+        try:
+            with open(filepath_index, 'rb') as fh:
+                data = marshal.load(fh)
+            if type(data) is tuple and len(data) == 2 and data[0] == stat_key:
+                index = BlendFileIndex.__new__(BlendFileIndex)
+                index.__setstate__(data[1])
+                return index
+        except FileNotFoundError:
+            pass
+        except Exception:
+            # corrupt or written by an incompatible version, read the blend again
+            blendfile.log.debug("failed to load blend file index %r" % filepath_index)
+
+        blend = blendfile.open_blend(filepath, "rb", use_mmap=True)
+        try:
+            index = BlendFileIndex.from_blend(blend, filepath)
+        finally:
+            blend.close()
+
+        # write to a unique temp name first (other threads & processes may write the same index),
+        # so a partially written file is never read.
+        filepath_index_tmp = None
+        try:
+            os.makedirs(BlendFileIndex.cache_dir, exist_ok=True)
+            fd, filepath_index_tmp = tempfile.mkstemp(dir=BlendFileIndex.cache_dir, suffix=".tmp")
+            with open(fd, 'wb') as fh:
+                marshal.dump((stat_key, index.__getstate__()), fh)
+            os.replace(filepath_index_tmp, filepath_index)
+        except (OSError, ValueError):
+            blendfile.log.debug("failed to write blend file index %r" % filepath_index)
+            if filepath_index_tmp is not None:
+                try:
+                    os.remove(filepath_index_tmp)
+                except OSError:
+                    pass
+        return index
+
 
 # -----------------------------------------------------------------------------
 # Packing Utility
@@ -875,10 +1518,13 @@ class utils:
         else:
             return split2
 
-    def find_sequence_paths(filepath, use_fullpath=True):
+    def find_sequence_paths(filepath, use_fullpath=True, dir_cache=None):
         # supports str, byte paths
+        # 'dir_cache' is an optional DirectoryCache, to avoid listing the same directory again.
         basedir, filename = os.path.split(filepath)
-        if not os.path.exists(basedir):
+        if dir_cache is None:
+            dir_cache = DirectoryCache()
+        if dir_cache.listing(basedir) is None:
             return []
 
         filename_noext, ext = os.path.splitext(filename)
@@ -892,16 +1538,109 @@ class utils:
             # input isn't from a sequence
             return []
 
-        files = os.listdir(basedir)
-        files[:] = [
-            f for f in files
-            if f.startswith(filename_nodigits) and
-            f.endswith(ext) and
-            f[len(filename_nodigits):-len(ext) if ext else -1].isdigit()
-            ]
+        files = dir_cache.sequence_index(basedir).get((filename_nodigits, ext), [])
         if use_fullpath:
-            files[:] = [
+            files = [
                 os.path.join(basedir, f) for f in files
                 ]
+        else:
+            files = files[:]
 
         return files
+
+
+class DirectoryCache:
+    """
+    Cache of directory listings (using ``os.scandir``), for the duration of one operation
+    (packing, listing dependencies, remapping... etc), to check files exist
+    and find image sequences without reading the same directory many times.
+
+    Directories are read once, so this shouldn't be kept while files are added or removed.
+    """
+    __slots__ = (
+        # {dirpath: {name: os.DirEntry} or None} (None for missing directories)
+        "listings",
+        # {dirpath: {(prefix, ext): [name, ...]}} (created on demand, see 'sequence_index')
+        "sequence_indices",
+        )
+
+    # file names may not match the case of the path on these systems
+    import sys
+    use_case_fallback = sys.platform in {'win32', 'darwin'}
+    del sys
+
+    def __init__(self):
+        self.listings = {}
+        self.sequence_indices = {}
+
+    def listing(self, dirpath):
+        """
+        Return a dict ``{name: os.DirEntry}`` for the directory, or None when it can't be read.
+        """
+        try:
+            return self.listings[dirpath]
+        except KeyError:
+            pass
+        try:
+            with os.scandir(dirpath) as it:
+                entries = {entry.name: entry for entry in it}
+        except OSError:
+            entries = None
+        self.listings[dirpath] = entries
+        return entries
+
+    def _entry(self, path):
+        dirpath, name = os.path.split(path)
+        if not (dirpath and name):
+            return ...
+        entries = self.listing(dirpath)
+        if entries is None:
+            return None
+        entry = entries.get(name)
+        if entry is None:
+            return ... if self.use_case_fallback else None
+        if entry.is_symlink():
+            return ...
+        return entry
+
+    def exists(self, path):
+        """
+        Cached version of ``os.path.exists``.
+        """
+        entry = self._entry(path)
+        if entry is ...:
+            # unusual paths & symbolic links
+            return os.path.exists(path)
+        return entry is not None
+
+    def isdir(self, path):
+        """
+        Cached version of ``os.path.isdir``.
+        """
+        entry = self._entry(path)
+        if entry is ...:
+            return os.path.isdir(path)
+        return (entry is not None) and entry.is_dir()
+
+    def sequence_index(self, dirpath):
+        """
+        Return a dict ``{(prefix, ext): [name, ...]}`` of the numbered files in a directory
+        (``render_0001.png`` is stored as ``(b'render_', b'.png')``), in listing order.
+        """
+        try:
+            return self.sequence_indices[dirpath]
+        except KeyError:
+            pass
+        index = {}
+        entries = self.listing(dirpath)
+        if entries:
+            from string import digits
+            if isinstance(dirpath, bytes):
+                digits = digits.encode()
+            for name in entries:
+                name_noext, ext = os.path.splitext(name)
+                name_nodigits = name_noext.rstrip(digits)
+                if len(name_nodigits) != len(name_noext):
+                    index.setdefault((name_nodigits, ext), []).append(name)
+        self.sequence_indices[dirpath] = index
+        return index
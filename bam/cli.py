@@ -154,6 +154,26 @@ class bam_config:
         from bam.utils.system import write_json_to_file
         write_json_to_file(filepath, data)
 
+    @staticmethod
+    def blendfile_cache_init(cwd=None):
+        """
+        When operating within a project,
+        store blend-file indices in '.bam/' so they're reused between runs.
+        """
+        basedir = bam_config.find_basedir(cwd=cwd)
+        if basedir is not None:
+            from bam.blend import blendfile_path_walker
+            blendfile_path_walker.BlendFileIndex.cache_dir = os.path.join(basedir, "index")
+
+    @staticmethod
+    def blendfile_expand_init(use_dna=False):
+        """
+        Select how ID dependencies are found,
+        using the DNA or the built-in rules (see 'ExpandID.use_dna').
+        """
+        from bam.blend import blendfile_path_walker
+        blendfile_path_walker.ExpandID.use_dna = use_dna
+
     @staticmethod
     def write_bamignore(cwd=None):
         path = bam_config.find_rootdir(cwd=cwd)
@@ -1252,6 +1272,9 @@ class bam_commands:
 
         items.sort()
 
+        # {name_full: summary}, for blend files (older servers don't include this)
+        blend_info = r_json.get("blend_info", {})
+
         if use_json:
             ret = []
             for (name_short, name_full, file_type) in items:
@@ -1267,22 +1290,49 @@ class bam_commands:
                     print("  %s/" % (strip_dot_slash(name_full) if use_full else name_short))
             for (name_short, name_full, file_type) in items:
                 if file_type != "dir":
-                    print("  %s" % (strip_dot_slash(name_full) if use_full else name_short))
+                    info = blend_info.get(name_full)
+                    if info is not None:
+                        print("  %s  (%d dependencies)" % (
+                                strip_dot_slash(name_full) if use_full else name_short,
+                                info["dependencies_count"]))
+                    else:
+                        print("  %s" % (strip_dot_slash(name_full) if use_full else name_short))
 
     @staticmethod
-    def deps(paths, recursive=False, use_json=False):
+    def deps(paths, recursive=False, use_json=False, use_stats=False, jobs=1, use_dna=False):
+
+        bam_config.blendfile_cache_init(cwd=os.path.dirname(os.path.abspath(paths[0])))
+        bam_config.blendfile_expand_init(use_dna)
+
+        if use_stats:
+            from bam.blend import blendfile
+            stats = blendfile.stats_enable()
 
         def deps_path_walker():
             from bam.blend import blendfile_path_walker
-            for blendfile_src in paths:
-                blendfile_src = blendfile_src.encode('utf-8')
-                yield from blendfile_path_walker.FilePath.visit_from_blend(
-                        blendfile_src,
-                        readonly=True,
-                        recursive=recursive,
-                        )
+            if recursive and jobs > 1:
+                import concurrent.futures
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+            else:
+                executor = None
+            try:
+                for blendfile_src in paths:
+                    blendfile_src = blendfile_src.encode('utf-8')
+                    yield from blendfile_path_walker.FilePath.visit_from_blend(
+                            blendfile_src,
+                            readonly=True,
+                            recursive=recursive,
+                            executor=executor,
+                            # keep the output predictable
+                            ordered=True,
+                            )
+            finally:
+                if executor is not None:
+                    executor.shutdown()
 
         def status_walker():
+            from bam.blend import blendfile_path_walker
+            dir_cache = blendfile_path_walker.DirectoryCache()
             for fp, (rootdir, fp_blend_basename) in deps_path_walker():
                 f_rel = fp.filepath
                 f_abs = fp.filepath_absolute
@@ -1294,7 +1344,7 @@ class bam_commands:
                     f_rel.decode('utf-8'),
                     f_abs.decode('utf-8'),
                     # filepath-status
-                    "OK" if os.path.exists(f_abs) else "MISSING FILE",
+                    "OK" if dir_cache.exists(f_abs) else "MISSING FILE",
                     )
 
         if use_json:
@@ -1313,6 +1363,11 @@ class bam_commands:
             for f_src, f_dst, f_dst_abs, f_status in status_walker():
                 print("  %r -> (%r = %r) %s" % (f_src, f_dst, f_dst_abs, f_status))
 
+        if use_stats:
+            blendfile.stats_disable()
+            # stderr, so JSON output can still be parsed
+            sys.stderr.write(stats.report() + "\n")
+
     @staticmethod
     def pack(
             paths,
@@ -1320,6 +1375,7 @@ class bam_commands:
             all_deps=False,
             use_quiet=False,
             compress_level=-1,
+            use_dna=False,
             ):
         # Local packing (don't use any project/session stuff)
         from .blend import blendfile_pack
@@ -1328,6 +1384,9 @@ class bam_commands:
         path = paths[0]
         del paths
 
+        bam_config.blendfile_cache_init(cwd=os.path.dirname(os.path.abspath(path)))
+        bam_config.blendfile_expand_init(use_dna)
+
         if use_quiet:
             report = lambda msg: None
         else:
@@ -1358,6 +1417,8 @@ class bam_commands:
         if os.path.exists(filepath_remap):
             fatal("Remap in progress, run with 'finish' or remove %r" % filepath_remap)
 
+        bam_config.blendfile_cache_init()
+
         from bam.blend import blendfile_path_remap
         remap_data = blendfile_path_remap.start(
                 paths,
@@ -1392,6 +1453,8 @@ class bam_commands:
             remap_data = pickle.load(fh)
             del pickle
 
+        bam_config.blendfile_cache_init()
+
         from bam.blend import blendfile_path_remap
         blendfile_path_remap.finish(
                 paths, remap_data,
@@ -1423,6 +1486,7 @@ def init_argparse_common(
         use_all_deps=False,
         use_quiet=False,
         use_compress_level=False,
+        use_dna=False,
         ):
     import argparse
 
@@ -1452,6 +1516,12 @@ def init_argparse_common(
                 choices=('default', 'fast', 'best', 'store'),
                 help="Compression level for resulting archive",
                 )
+    if use_dna:
+        subparse.add_argument(
+                "--dna", dest="use_dna", action='store_true',
+                help="Find ID dependencies by following all pointers in the file's DNA "
+                     "(finds references the built-in rules miss, animation & modifiers for example)",
+                )
 
 
 def create_argparse_init(subparsers):
@@ -1615,14 +1685,25 @@ def create_argparse_deps(subparsers):
             "-r", "--recursive", dest="recursive", action='store_true',
             help="Scan dependencies recursively",
             )
+    subparse.add_argument(
+            "--stats", dest="use_stats", action='store_true',
+            help="Print file access statistics (to stderr), for profiling",
+            )
+    subparse.add_argument(
+            "--jobs", dest="jobs", type=int, default=1,
+            help="Number of libraries to scan at once (when recursive)",
+            )
 
-    init_argparse_common(subparse, use_json=True)
+    init_argparse_common(subparse, use_json=True, use_dna=True)
 
     subparse.set_defaults(
             func=lambda args:
             bam_commands.deps(
                     args.paths, args.recursive,
-                    use_json=args.json),
+                    use_json=args.json,
+                    use_stats=args.use_stats,
+                    jobs=args.jobs,
+                    use_dna=args.use_dna),
                     )
 
 
@@ -1659,7 +1740,7 @@ def create_argparse_pack(subparsers):
             help="Output file or a directory when multiple inputs are passed",
             )
 
-    init_argparse_common(subparse, use_all_deps=True, use_quiet=True, use_compress_level=True)
+    init_argparse_common(subparse, use_all_deps=True, use_quiet=True, use_compress_level=True, use_dna=True)
 
     subparse.set_defaults(
             func=lambda args:
@@ -1668,7 +1749,8 @@ def create_argparse_pack(subparsers):
                     args.output or (os.path.splitext(args.paths[0])[0] + ".zip"),
                     all_deps=args.all_deps,
                     use_quiet=args.use_quiet,
-                    compress_level=args.compress_level),
+                    compress_level=args.compress_level,
+                    use_dna=args.use_dna),
                     )
 
 
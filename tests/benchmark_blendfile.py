@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# Apache License, Version 2.0
+
+"""
+Benchmark blend file reading, using synthetic blend files (doesn't need Blender).
+
+Run with the default project size:
+
+   python3 benchmark_blendfile.py
+
+Larger project, compressed, writing the results:
+
+   python3 benchmark_blendfile.py --objects 10000 --images 10000 --libraries 8 --gzip --output results.json
+
+Use ``--warm`` to keep the DNA, decompression & library caches between runs
+(by default they're cleared, to time opening files for the first time).
+"""
+
+
+# ------------------
+# Ensure module path
+import os
+import sys
+path = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+if path not in sys.path:
+    sys.path.append(path)
+del os, sys, path
+# --------
+
+import os
+import time
+
+
+def _caches_clear():
+    from bam.blend import blendfile
+    from bam.blend import blendfile_path_walker
+    blendfile.DNACache.clear()
+    blendfile.DecompressCache.clear()
+    blendfile_path_walker.LibraryExpandCache.clear()
+
+
+def _time_best(fn, repeat, use_warm):
+    """
+    Return the fastest time of ``repeat`` calls and the result of the last call.
+    """
+    time_best = None
+    for _ in range(repeat):
+        if not use_warm:
+            _caches_clear()
+        time_start = time.perf_counter()
+        result = fn()
+        time_delta = time.perf_counter() - time_start
+        if time_best is None or time_delta < time_best:
+            time_best = time_delta
+    return time_best, result
+
+
+def _blend_files(dirpath):
+    return sorted(
+            os.path.join(dirpath, filename)
+            for dirpath, _dirnames, filenames in os.walk(dirpath)
+            for filename in filenames
+            if filename.endswith(b'.blend'))
+
+
+def bench_open_blend(filepaths, repeat, use_warm):
+    from bam.blend import blendfile
+
+    def fn():
+        blocks = 0
+        for filepath in filepaths:
+            bf = blendfile.open_blend(filepath)
+            blocks += len(bf.blocks)
+            bf.close()
+        return blocks
+
+    time_best, blocks = _time_best(fn, repeat, use_warm)
+    size = sum(os.path.getsize(filepath) for filepath in filepaths)
+    return {
+        "time": time_best,
+        "files": len(filepaths),
+        "blocks_per_second": blocks / time_best,
+        "mb_per_second": (size / (1024 * 1024)) / time_best,
+        }
+
+
+def bench_decode_structs(filepath, repeat, use_warm):
+    from bam.blend import blendfile
+
+    bf = blendfile.open_blend(filepath)
+    block = bf.find_blocks_from_code(b'DNA1')[0]
+    header = bf.header
+    data = bf.read_at(block.file_offset, block.size)
+    bf.close()
+
+    # always decode (don't use the catalog cache).
+    time_best, (structs, _sdna_index_from_id) = _time_best(
+            lambda: blendfile.BlendFile.decode_structs_from_buffer(header, data, 0),
+            repeat, use_warm)
+    return {
+        "time": time_best,
+        "structs": len(structs),
+        "decode_per_second": 1.0 / time_best,
+        }
+
+
+def bench_field_access(filepath, repeat, use_warm):
+    from bam.blend import blendfile
+
+    paths = {
+        b'IM': (b'id.name', b'name', b'source', b'packedfile'),
+        b'OB': (b'id.name', b'data', b'mat', b'totcol'),
+        b'ME': (b'id.name', b'mat', b'totcol'),
+        }
+
+    bf = blendfile.open_blend(filepath)
+
+    def fn():
+        fields = 0
+        for code, code_paths in paths.items():
+            for block in bf.find_blocks_from_code(code):
+                for path in code_paths:
+                    block.get(path)
+                fields += len(code_paths)
+        return fields
+
+    time_best, fields = _time_best(fn, repeat, use_warm)
+    bf.close()
+    return {
+        "time": time_best,
+        "fields": fields,
+        "fields_per_second": fields / time_best,
+        }
+
+
+def bench_visit_from_blend(filepath, repeat, use_warm):
+    from bam.blend.blendfile_path_walker import FilePath
+
+    def fn():
+        return sum(1 for _ in FilePath.visit_from_blend(filepath, readonly=True, recursive=True))
+
+    time_best, paths = _time_best(fn, repeat, use_warm)
+    return {
+        "time": time_best,
+        "paths": paths,
+        "paths_per_second": paths / time_best,
+        }
+
+
+def main():
+    import argparse
+    import tempfile
+    import shutil
+    import blendfile_synthetic
+
+    parser = argparse.ArgumentParser(description="Benchmark blend file reading")
+    parser.add_argument("--objects", type=int, default=1000)
+    parser.add_argument("--images", type=int, default=1000)
+    parser.add_argument("--libraries", type=int, default=4)
+    parser.add_argument("--gzip", dest="use_gzip", action="store_true")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--warm", dest="use_warm", action="store_true")
+    parser.add_argument("--output", help="Write the results to a JSON file")
+    args = parser.parse_args()
+
+    dirpath = tempfile.mkdtemp(prefix="bam_benchmark_")
+    try:
+        filepath = blendfile_synthetic.write_project(
+                dirpath,
+                objects=args.objects,
+                images=args.images,
+                libraries=args.libraries,
+                use_gzip=args.use_gzip,
+                )
+
+        results = {
+            "open_blend": bench_open_blend(_blend_files(os.fsencode(dirpath)), args.repeat, args.use_warm),
+            "decode_structs": bench_decode_structs(filepath, args.repeat, args.use_warm),
+            "field_access": bench_field_access(filepath, args.repeat, args.use_warm),
+            "visit_from_blend": bench_visit_from_blend(filepath, args.repeat, args.use_warm),
+            }
+    finally:
+        shutil.rmtree(dirpath)
+
+    for name, result in results.items():
+        print("%s:" % name)
+        for key, value in result.items():
+            print("    %s: %s" % (key, ("%.6f" % value) if isinstance(value, float) else value))
+
+    if args.output:
+        import json
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(
+                    {"args": vars(args), "results": results}, f,
+                    sort_keys=True, indent=4, separators=(',', ': '),
+                    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,639 @@
+# Apache License, Version 2.0
+
+"""
+Write synthetic blend files (without Blender).
+
+The files contain a small DNA1 catalog (enough for the structs bam reads),
+ID blocks, DATA blocks, ListBases and linked libraries,
+so tests and benchmarks can create projects of any size on systems without Blender.
+
+Create a project from the command line:
+
+   python3 blendfile_synthetic.py /path/to/dir --objects 1000 --images 1000 --libraries 4 --gzip
+"""
+
+import os
+import struct
+
+
+# ----------------------------------------------------------------------------
+# DNA Catalog
+#
+# (struct_name, ((type_name, field_name), ...))
+# padding is added when the catalog is created (depends on the pointer size).
+
+DNA_BASIC_TYPES = (
+    (b'char', 1),
+    (b'uchar', 1),
+    (b'short', 2),
+    (b'int', 4),
+    (b'float', 4),
+    (b'void', 0),
+    )
+
+DNA_STRUCTS = (
+    # pointer arrays are written as DATA blocks using the first struct (as Blender does)
+    (b'Link', (
+        (b'Link', b'*next'),
+        (b'Link', b'*prev'),
+        )),
+    (b'ListBase', (
+        (b'void', b'*first'),
+        (b'void', b'*last'),
+        )),
+    (b'ID', (
+        (b'void', b'*next'),
+        (b'void', b'*prev'),
+        (b'ID', b'*newid'),
+        (b'Library', b'*lib'),
+        (b'char', b'name[66]'),
+        (b'short', b'flag'),
+        (b'int', b'us'),
+        (b'int', b'icon_id'),
+        )),
+    (b'PackedFile', (
+        (b'int', b'size'),
+        (b'int', b'seek'),
+        (b'void', b'*data'),
+        )),
+    (b'Library', (
+        (b'ID', b'id'),
+        (b'char', b'name[1024]'),
+        (b'char', b'filepath[1024]'),
+        (b'PackedFile', b'*packedfile'),
+        )),
+    (b'Image', (
+        (b'ID', b'id'),
+        (b'char', b'name[1024]'),
+        (b'PackedFile', b'*packedfile'),
+        (b'short', b'source'),
+        (b'short', b'type'),
+        (b'float', b'gen_color[4]'),
+        )),
+    (b'Material', (
+        (b'ID', b'id'),
+        (b'AnimData', b'*adt'),
+        (b'float', b'r'),
+        (b'float', b'g'),
+        (b'float', b'b'),
+        (b'MTex', b'*mtex[18]'),
+        (b'bNodeTree', b'*nodetree'),
+        (b'Group', b'*group'),
+        )),
+    (b'Mesh', (
+        (b'ID', b'id'),
+        (b'AnimData', b'*adt'),
+        (b'Material', b'**mat'),
+        (b'Mesh', b'*texcomesh'),
+        (b'int', b'totvert'),
+        (b'short', b'totcol'),
+        )),
+    (b'Object', (
+        (b'ID', b'id'),
+        (b'AnimData', b'*adt'),
+        (b'short', b'type'),
+        (b'short', b'totcol'),
+        (b'void', b'*data'),
+        (b'Material', b'**mat'),
+        (b'bPose', b'*pose'),
+        (b'Object', b'*proxy'),
+        (b'Object', b'*proxy_group'),
+        (b'Group', b'*dup_group'),
+        (b'ListBase', b'modifiers'),
+        (b'ListBase', b'particlesystem'),
+        (b'float', b'loc[3]'),
+        )),
+    (b'Base', (
+        (b'Base', b'*next'),
+        (b'Base', b'*prev'),
+        (b'int', b'lay'),
+        (b'int', b'flag'),
+        (b'Object', b'*object'),
+        )),
+    (b'Scene', (
+        (b'ID', b'id'),
+        (b'AnimData', b'*adt'),
+        (b'Object', b'*camera'),
+        (b'World', b'*world'),
+        (b'Scene', b'*set'),
+        (b'ListBase', b'base'),
+        (b'Editing', b'*ed'),
+        (b'bNodeTree', b'*nodetree'),
+        (b'MovieClip', b'*clip'),
+        )),
+    (b'bNodeTree', (
+        (b'ID', b'id'),
+        (b'AnimData', b'*adt'),
+        (b'ListBase', b'nodes'),
+        )),
+    (b'bNode', (
+        (b'bNode', b'*next'),
+        (b'bNode', b'*prev'),
+        (b'ID', b'*id'),
+        (b'short', b'type'),
+        )),
+    (b'ParticleSettings', (
+        (b'ID', b'id'),
+        (b'AnimData', b'*adt'),
+        (b'short', b'ren_as'),
+        (b'Object', b'*dup_ob'),
+        (b'Group', b'*dup_group'),
+        )),
+    (b'ParticleSystem', (
+        (b'ParticleSystem', b'*next'),
+        (b'ParticleSystem', b'*prev'),
+        (b'ParticleSettings', b'*part'),
+        )),
+    (b'Group', (
+        (b'ID', b'id'),
+        (b'ListBase', b'gobject'),
+        )),
+    (b'GroupObject', (
+        (b'GroupObject', b'*next'),
+        (b'GroupObject', b'*prev'),
+        (b'Object', b'*ob'),
+        )),
+    (b'Editing', (
+        (b'ListBase', b'seqbase'),
+        )),
+    (b'Sequence', (
+        (b'Sequence', b'*next'),
+        (b'Sequence', b'*prev'),
+        (b'int', b'type'),
+        (b'Strip', b'*strip'),
+        (b'Scene', b'*scene'),
+        (b'ListBase', b'seqbase'),
+        )),
+    (b'Strip', (
+        (b'char', b'dir[768]'),
+        (b'StripElem', b'*stripdata'),
+        )),
+    (b'StripElem', (
+        (b'char', b'name[256]'),
+        )),
+    )
+
+# Image.source
+IMA_SRC_FILE = 1
+
+
+class DNAStructDef:
+    """
+    Layout of a struct in the catalog.
+    """
+    __slots__ = (
+        "name",
+        "sdna_index",
+        # [(type_name, field_name, offset), ...]
+        "fields",
+        # {name_only: (type_name, field_name, offset)}
+        "field_from_name",
+        "size",
+        )
+
+    def __init__(self, name, sdna_index):
+        self.name = name
+        self.sdna_index = sdna_index
+        self.fields = []
+        self.field_from_name = {}
+        self.size = 0
+
+
+class DNACatalog:
+    """
+    Struct layouts for a pointer size and endianness, written as the DNA1 block.
+    """
+    __slots__ = (
+        "pointer_size",
+        "endian_str",
+        # [name, ...]
+        "names",
+        # [type_name, ...]
+        "types",
+        # [size, ...] (matching types)
+        "type_sizes",
+        # {struct_name: DNAStructDef}
+        "structs",
+        )
+
+    def __init__(self, pointer_size, endian_str):
+        self.pointer_size = pointer_size
+        self.endian_str = endian_str
+        self.names = []
+        self.types = []
+        self.type_sizes = []
+        self.structs = {}
+
+        type_size = dict(DNA_BASIC_TYPES)
+        type_align = {name: max(size, 1) for name, size in DNA_BASIC_TYPES}
+
+        for sdna_index, (struct_name, fields) in enumerate(DNA_STRUCTS):
+            dna_struct = DNAStructDef(struct_name, sdna_index)
+            offset = 0
+            align_max = 1
+            pad_index = 0
+            for type_name, field_name in fields:
+                name_only, array_size = self.field_name_split(field_name)
+                if b'*' in field_name:
+                    size = align = pointer_size
+                else:
+                    size = type_size[type_name]
+                    align = type_align[type_name]
+                size *= array_size
+                align_max = max(align_max, align)
+
+                if offset % align:
+                    pad = align - (offset % align)
+                    self._field_add(dna_struct, b'char', b'_pad%d[%d]' % (pad_index, pad), offset)
+                    pad_index += 1
+                    offset += pad
+
+                self._field_add(dna_struct, type_name, field_name, offset)
+                offset += size
+
+            if offset % align_max:
+                pad = align_max - (offset % align_max)
+                self._field_add(dna_struct, b'char', b'_pad%d[%d]' % (pad_index, pad), offset)
+                offset += pad
+
+            dna_struct.size = offset
+            type_size[struct_name] = offset
+            type_align[struct_name] = align_max
+            self.structs[struct_name] = dna_struct
+
+        # types referenced only by pointers are written with a zero size
+        for dna_struct in self.structs.values():
+            for type_name, _field_name, _offset in dna_struct.fields:
+                type_size.setdefault(type_name, 0)
+
+        for type_name, size in type_size.items():
+            self.types.append(type_name)
+            self.type_sizes.append(size)
+
+    def _field_add(self, dna_struct, type_name, field_name, offset):
+        item = (type_name, field_name, offset)
+        dna_struct.fields.append(item)
+        dna_struct.field_from_name[self.field_name_split(field_name)[0]] = item
+        if field_name not in self.names:
+            self.names.append(field_name)
+
+    @staticmethod
+    def field_name_split(field_name):
+        """
+        Return (name_only, array_size).
+        """
+        name_only = field_name.strip(b'*()')
+        array_size = 1
+        index = name_only.find(b'[')
+        if index != -1:
+            for dim in name_only[index + 1:-1].split(b']['):
+                array_size *= int(dim)
+            name_only = name_only[:index]
+        return name_only, array_size
+
+    def field_from_path(self, struct_name, path):
+        """
+        Return (type_name, field_name, offset) for a dotted path, eg: ``b'id.name'``.
+        """
+        offset = 0
+        dna_struct = self.structs[struct_name]
+        name_first, _, path_rest = path.partition(b'.')
+        type_name, field_name, field_offset = dna_struct.field_from_name[name_first]
+        offset += field_offset
+        if path_rest:
+            type_name, field_name, field_offset = self.field_from_path(type_name, path_rest)
+            offset += field_offset
+        return type_name, field_name, offset
+
+    def pack_fields(self, struct_name, values):
+        """
+        Return the bytes for a struct, ``values`` is a dict of ``{path: value}``.
+        """
+        dna_struct = self.structs[struct_name]
+        data = bytearray(dna_struct.size)
+        endian_str = self.endian_str
+        for path, value in values.items():
+            type_name, field_name, offset = self.field_from_path(struct_name, path)
+            name_only, array_size = self.field_name_split(field_name)
+            if b'*' in field_name:
+                struct.pack_into(endian_str + (b'Q' if self.pointer_size == 8 else b'I'), data, offset, value)
+            elif type_name == b'char':
+                if len(value) >= array_size:
+                    raise ValueError("%r too long for %r" % (value, field_name))
+                data[offset:offset + len(value)] = value
+            elif type_name == b'short':
+                struct.pack_into(endian_str + b'h', data, offset, value)
+            elif type_name == b'int':
+                struct.pack_into(endian_str + b'i', data, offset, value)
+            elif type_name == b'float':
+                if array_size == 1:
+                    value = (value,)
+                struct.pack_into(endian_str + b'%df' % len(value), data, offset, *value)
+            else:
+                raise NotImplementedError("can't write %r (%r)" % (path, type_name))
+        return bytes(data)
+
+    def as_bytes(self):
+        """
+        Return the contents of the DNA1 block.
+        """
+        endian_str = self.endian_str
+
+        def align4(data):
+            data += b'\0' * (-len(data) % 4)
+
+        data = bytearray(b'SDNA')
+        data += b'NAME' + struct.pack(endian_str + b'I', len(self.names))
+        for name in self.names:
+            data += name + b'\0'
+        align4(data)
+
+        data += b'TYPE' + struct.pack(endian_str + b'I', len(self.types))
+        for type_name in self.types:
+            data += type_name + b'\0'
+        align4(data)
+
+        data += b'TLEN' + struct.pack(endian_str + b'%dH' % len(self.type_sizes), *self.type_sizes)
+        align4(data)
+
+        type_index = {type_name: i for i, type_name in enumerate(self.types)}
+        name_index = {name: i for i, name in enumerate(self.names)}
+        data += b'STRC' + struct.pack(endian_str + b'I', len(self.structs))
+        for dna_struct in sorted(self.structs.values(), key=lambda dna_struct: dna_struct.sdna_index):
+            data += struct.pack(endian_str + b'HH', type_index[dna_struct.name], len(dna_struct.fields))
+            for type_name, field_name, _offset in dna_struct.fields:
+                data += struct.pack(endian_str + b'HH', type_index[type_name], name_index[field_name])
+        return bytes(data)
+
+
+# ----------------------------------------------------------------------------
+# Blend File Writer
+
+class BlendFileWriter:
+    """
+    Collect blocks, then write them as a blend file.
+    """
+    __slots__ = (
+        "dna",
+        "version",
+        # [(code, addr_old, sdna_index, count, data), ...]
+        "blocks",
+        # next free (fake) memory address
+        "addr_next",
+        )
+
+    def __init__(self, pointer_size=8, is_little_endian=True, version=b'276'):
+        self.dna = DNACatalog(pointer_size, b'<' if is_little_endian else b'>')
+        self.version = version
+        self.blocks = []
+        self.addr_next = 0x10000
+
+    def addr_alloc(self, size):
+        """
+        Return a new address for a block of ``size`` bytes.
+        """
+        addr = self.addr_next
+        self.addr_next += (size + 0x100) & ~0xff
+        return addr
+
+    def block_add(self, code, struct_name, values_list, addr=None):
+        """
+        Add a block of ``struct_name`` structs, one for each dict in ``values_list``.
+
+        Return the address of the block (to use in pointers),
+        pass in ``addr`` when the address is needed before the block is added.
+        """
+        if isinstance(values_list, dict):
+            values_list = (values_list,)
+        data = b''.join(self.dna.pack_fields(struct_name, values) for values in values_list)
+        if addr is None:
+            addr = self.addr_alloc(len(data))
+        self.blocks.append((code, addr, self.dna.structs[struct_name].sdna_index, len(values_list), data))
+        return addr
+
+    def block_add_pointers(self, addr_list):
+        """
+        Add a DATA block containing an array of pointers (eg: ``Mesh.mat``).
+        """
+        data = struct.pack(
+                self.dna.endian_str + b'%d%s' % (len(addr_list), b'Q' if self.dna.pointer_size == 8 else b'I'),
+                *addr_list)
+        addr = self.addr_alloc(len(data))
+        self.blocks.append((b'DATA', addr, 0, 1, data))
+        return addr
+
+    def write(self, handle):
+        dna = self.dna
+        endian_str = dna.endian_str
+        header_struct = struct.Struct(endian_str + (b'4sIQII' if dna.pointer_size == 8 else b'4sIIII'))
+
+        handle.write(b'BLENDER' +
+                     (b'-' if dna.pointer_size == 8 else b'_') +
+                     (b'v' if endian_str == b'<' else b'V') +
+                     self.version)
+
+        for code, addr, sdna_index, count, data in self.blocks:
+            handle.write(header_struct.pack(code, len(data), addr, sdna_index, count))
+            handle.write(data)
+
+        data = dna.as_bytes()
+        handle.write(header_struct.pack(b'DNA1', len(data), self.addr_alloc(len(data)), 0, 1))
+        handle.write(data)
+        handle.write(header_struct.pack(b'ENDB', 0, 0, 0, 0))
+
+    def write_file(self, filepath, use_gzip=False):
+        if use_gzip:
+            import gzip
+            with gzip.open(filepath, 'wb') as handle:
+                self.write(handle)
+        else:
+            with open(filepath, 'wb') as handle:
+                self.write(handle)
+
+
+# ----------------------------------------------------------------------------
+# Projects
+
+def _id_values(name):
+    return {b'id.name': name, b'id.us': 1}
+
+
+def write_blend(
+        filepath,
+        objects=10,
+        images=10,
+        materials=4,
+        libraries=(),
+        library_objects=2,
+        library_images=2,
+        library_meshes=0,
+        name_prefix=b'',
+        use_gzip=False,
+        pointer_size=8,
+        is_little_endian=True,
+        ):
+    """
+    Write a single blend file:
+
+    - ``images`` images (``//textures/<name>.png``).
+    - ``objects`` mesh objects, each with its own mesh, using ``materials`` materials,
+      in a scene (linked via a ListBase of bases).
+    - For each path in ``libraries``, a library
+      and ``library_objects`` and ``library_images`` IDs linked from it
+      (matching the names in a file written by this function).
+    - ``library_meshes`` of the objects use a mesh linked from the first library
+      (instead of their own mesh).
+
+    Return a list of the file paths used by the blend file (as written).
+    """
+    bw = BlendFileWriter(pointer_size=pointer_size, is_little_endian=is_little_endian)
+    deps = []
+
+    for i in range(images):
+        path = b'//textures/%simage_%05d.png' % (name_prefix, i)
+        bw.block_add(b'IM', b'Image', {
+            **_id_values(b'IM%simage_%05d' % (name_prefix, i)),
+            b'name': path,
+            b'source': IMA_SRC_FILE,
+            b'gen_color': (0.5, 0.5, 0.5, 1.0),
+            })
+        deps.append(path)
+
+    materials_addr = [
+        bw.block_add(b'MA', b'Material', {
+            **_id_values(b'MA%smaterial_%03d' % (name_prefix, i)),
+            b'r': 0.8, b'g': 0.8, b'b': 0.8,
+            })
+        for i in range(materials)]
+
+    libraries_addr = [
+        bw.block_add(b'LI', b'Library', {
+            **_id_values(b'LI' + os.path.basename(lib_path)[:60]),
+            b'name': lib_path,
+            b'filepath': lib_path,
+            })
+        for lib_path in libraries]
+
+    objects_addr = []
+    for i in range(objects):
+        mat = [materials_addr[i % len(materials_addr)]] if materials_addr else []
+        mat_addr = bw.block_add_pointers(mat) if mat else 0
+        if i < library_meshes:
+            mesh_addr = bw.block_add(b'ID', b'ID', {
+                b'name': b'ME%smesh_%05d' % (library_name_prefix(libraries[0]), i),
+                b'lib': libraries_addr[0],
+                b'us': 1,
+                })
+        else:
+            mesh_addr = bw.block_add(b'ME', b'Mesh', {
+                **_id_values(b'ME%smesh_%05d' % (name_prefix, i)),
+                b'mat': mat_addr,
+                b'totcol': len(mat),
+                b'totvert': 8,
+                })
+        mat_addr = bw.block_add_pointers(mat) if mat else 0
+        objects_addr.append(bw.block_add(b'OB', b'Object', {
+            **_id_values(b'OB%sobject_%05d' % (name_prefix, i)),
+            b'type': 1,  # OB_MESH
+            b'data': mesh_addr,
+            b'mat': mat_addr,
+            b'totcol': len(mat),
+            b'loc': (float(i), 0.0, 0.0),
+            }))
+
+    # scene, with a ListBase of bases (allocate the addresses first, to link them)
+    bases_addr = [bw.addr_alloc(bw.dna.structs[b'Base'].size) for _ in objects_addr]
+    for i, (base_addr, object_addr) in enumerate(zip(bases_addr, objects_addr)):
+        bw.block_add(b'DATA', b'Base', {
+            b'next': bases_addr[i + 1] if i + 1 != len(bases_addr) else 0,
+            b'prev': bases_addr[i - 1] if i != 0 else 0,
+            b'lay': 1,
+            b'object': object_addr,
+            }, addr=base_addr)
+    bw.block_add(b'SC', b'Scene', {
+        **_id_values(b'SC%sScene' % name_prefix),
+        b'base.first': bases_addr[0] if bases_addr else 0,
+        b'base.last': bases_addr[-1] if bases_addr else 0,
+        })
+
+    for lib_path, lib_addr in zip(libraries, libraries_addr):
+        deps.append(lib_path)
+        lib_prefix = library_name_prefix(lib_path)
+        for i in range(library_objects):
+            bw.block_add(b'ID', b'ID', {b'name': b'OB%sobject_%05d' % (lib_prefix, i), b'lib': lib_addr, b'us': 1})
+        for i in range(library_images):
+            bw.block_add(b'ID', b'ID', {b'name': b'IM%simage_%05d' % (lib_prefix, i), b'lib': lib_addr, b'us': 1})
+
+    bw.write_file(filepath, use_gzip=use_gzip)
+    return deps
+
+
+def library_name_prefix(lib_path):
+    """
+    Prefix for ID names in a library (so names are unique between files).
+    """
+    return os.path.splitext(os.path.basename(lib_path))[0] + b'_'
+
+
+def write_project(
+        dirpath,
+        objects=10,
+        images=10,
+        libraries=0,
+        use_gzip=False,
+        **kwargs
+        ):
+    """
+    Write ``main.blend`` and ``libraries`` library files into ``dirpath``,
+    the library files are linked from ``main.blend`` (with the same number of objects and images).
+
+    Return the path of the main blend file.
+    """
+    if isinstance(dirpath, str):
+        dirpath = os.fsencode(dirpath)
+
+    libraries_path = [b'//lib/lib_%02d.blend' % i for i in range(libraries)]
+    if libraries:
+        os.makedirs(os.path.join(dirpath, b'lib'), exist_ok=True)
+        for lib_path in libraries_path:
+            write_blend(
+                    os.path.join(dirpath, lib_path[2:]),
+                    objects=objects,
+                    images=images,
+                    name_prefix=library_name_prefix(lib_path),
+                    use_gzip=use_gzip,
+                    **kwargs)
+
+    filepath = os.path.join(dirpath, b'main.blend')
+    write_blend(
+            filepath,
+            objects=objects,
+            images=images,
+            libraries=libraries_path,
+            use_gzip=use_gzip,
+            **kwargs)
+    return filepath
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Write a synthetic blend file project")
+    parser.add_argument("dirpath", help="Output directory")
+    parser.add_argument("--objects", type=int, default=10)
+    parser.add_argument("--images", type=int, default=10)
+    parser.add_argument("--libraries", type=int, default=0)
+    parser.add_argument("--gzip", dest="use_gzip", action="store_true")
+    args = parser.parse_args()
+
+    os.makedirs(args.dirpath, exist_ok=True)
+    print(os.fsdecode(write_project(
+            args.dirpath,
+            objects=args.objects,
+            images=args.images,
+            libraries=args.libraries,
+            use_gzip=args.use_gzip,
+            )))
+
+
+if __name__ == "__main__":
+    main()
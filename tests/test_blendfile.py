@@ -0,0 +1,1518 @@
+#!/usr/bin/env python3
+# Apache License, Version 2.0
+
+"""
+Test blend file reading (doesn't need a server)
+
+Run all tests:
+
+   python3 test_blendfile.py
+
+Run a single test:
+
+   python3 -m unittest test_blendfile.BlendFileThreadTest.test_threads_handle
+"""
+
+
+# ------------------
+# Ensure module path
+import os
+import sys
+path = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+if path not in sys.path:
+    sys.path.append(path)
+del os, sys, path
+# --------
+
+import os
+import unittest
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+BLENDFILE_DIR = os.path.join(CURRENT_DIR, "blends", "variations")
+
+THREAD_COUNT = 8
+
+
+def _module_found(name):
+    import importlib.util
+    return importlib.util.find_spec(name) is not None
+
+
+NUMPY_FOUND = _module_found("numpy")
+
+
+def blend_read_all(bf):
+    """
+    Read every block's fields into a list (for comparison).
+    """
+    result = []
+    for block in bf.blocks:
+        if block.code == b'ENDB':
+            continue
+        result.append((block.code, block.addr_old, block.as_dict()))
+        if block.code != b'DATA':
+            result.append(block.get(b'id.name', default=None))
+        link = bf.find_block_from_offset(block.addr_old)
+        result.append(link.file_offset if link is not None else None)
+    return result
+
+
+class BlendFileTempTestCase(unittest.TestCase):
+    """
+    Creates a temp directory (``self.dirpath``) for each test,
+    with a synthetic project (``self.filepath``) when ``project`` is set.
+    """
+    # arguments for 'blendfile_synthetic.write_project'
+    project = None
+
+    def setUp(self):
+        import tempfile
+        self.dirpath = tempfile.mkdtemp(prefix="bam_test_")
+        if self.project is not None:
+            import blendfile_synthetic
+            self.filepath = blendfile_synthetic.write_project(self.dirpath, **self.project)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dirpath)
+
+
+class BlendFileThreadTest(unittest.TestCase):
+
+    def _test_threads(self, **kwargs):
+        from concurrent.futures import ThreadPoolExecutor
+        from bam.blend import blendfile
+
+        filepath = os.path.join(BLENDFILE_DIR, "lib_user.blend")
+
+        bf = blendfile.open_blend(filepath, **kwargs)
+        expect = blend_read_all(bf)
+        bf.close()
+
+        # fresh file, so lazy data (block views, address index, accessors) is created from threads
+        bf = blendfile.open_blend(filepath, **kwargs)
+        try:
+            with ThreadPoolExecutor(max_workers=THREAD_COUNT) as executor:
+                futures = [executor.submit(blend_read_all, bf) for _ in range(THREAD_COUNT * 4)]
+                for f in futures:
+                    self.assertEqual(expect, f.result())
+        finally:
+            bf.close()
+
+    def test_threads_handle(self):
+        self._test_threads()
+
+    def test_threads_mmap(self):
+        self._test_threads(use_mmap=True)
+
+
+class BlendFileMmapTest(BlendFileTempTestCase):
+
+    def test_mmap_read(self):
+        import blendfile_synthetic
+        from bam.blend import blendfile
+
+        filepath_synthetic = os.path.join(self.dirpath, "synthetic.blend")
+        blendfile_synthetic.write_blend(
+                filepath_synthetic, objects=5, images=5, libraries=(b'//lib.blend',),
+                pointer_size=4, is_little_endian=False)
+
+        for filepath in (
+                os.path.join(BLENDFILE_DIR, "cone.blend"),
+                os.path.join(BLENDFILE_DIR, "lib_user.blend"),
+                filepath_synthetic,
+                ):
+            bf = blendfile.open_blend(filepath)
+            self.assertIsNone(bf.data)
+            expect = blend_read_all(bf)
+            expect_header = (bf.header.pointer_size, bf.header.endian_index, bf.header.version)
+            expect_data = [bf.read_at(block.file_offset, block.size) for block in bf.blocks]
+            bf.close()
+
+            bf = blendfile.open_blend(filepath, use_mmap=True)
+            self.assertIsNotNone(bf.data)
+            self.assertEqual(expect, blend_read_all(bf))
+            self.assertEqual(expect_header, (bf.header.pointer_size, bf.header.endian_index, bf.header.version))
+            self.assertEqual(expect_data, [bytes(bf.read_at(block.file_offset, block.size)) for block in bf.blocks])
+            bf.close()
+
+
+class BlendFileBlockTableTest(BlendFileTempTestCase):
+
+    def test_index_from_offset(self):
+        import random
+        import blendfile_synthetic
+        from bam.blend import blendfile
+
+        # blocks with duplicate addresses (the last block is used)
+        bw = blendfile_synthetic.BlendFileWriter()
+        addr_dup = bw.block_add(b'IM', b'Image', {b'id.name': b'IMFirst'})
+        for i in range(20):
+            bw.block_add(b'IM', b'Image', {b'id.name': b'IMImage_%d' % i})
+        bw.block_add(b'IM', b'Image', {b'id.name': b'IMLast'}, addr=addr_dup)
+        filepath = os.path.join(self.dirpath, "duplicates.blend")
+        bw.write_file(filepath)
+
+        bf = blendfile.open_blend(filepath)
+        try:
+            table = bf.blocks
+            # linear search, skipping the ENDB block
+            expect = {}
+            for index in range(len(table) - 1):
+                expect[table.addr_old[index]] = index
+
+            addr_all = list(expect)
+            # not found: between blocks, before the first & after the last
+            addr_missing = [addr + 1 for addr in addr_all] + [0, min(addr_all) - 1, max(addr_all) + 1]
+            for addr in addr_all + addr_missing:
+                self.assertEqual(expect.get(addr, -1), table.index_from_offset(addr))
+
+            self.assertEqual(b'IMLast', bf.find_block_from_offset(addr_dup)[b'id.name'])
+            self.assertIsNone(bf.find_block_from_offset(addr_dup + 1))
+
+            # unsorted, with repeated addresses
+            addr_list = (addr_all + addr_missing) * 2
+            random.Random(0).shuffle(addr_list)
+            self.assertEqual(
+                    [expect.get(addr, -1) for addr in addr_list],
+                    table.indices_from_offsets(addr_list))
+            self.assertEqual([], table.indices_from_offsets([]))
+        finally:
+            bf.close()
+
+
+class BlendFileTraverseTest(BlendFileTempTestCase):
+
+    def test_iter_ListBase(self):
+        from bam.blend import blendfile
+        from bam.blend.blendfile_path_walker import bf_utils
+
+        bf = blendfile.open_blend(os.path.join(BLENDFILE_DIR, "lib_user.blend"))
+        try:
+            for block in bf.find_blocks_from_code(b'SC'):
+                item = block.get_pointer(b'base.first')
+                expect = []
+                while item is not None:
+                    expect.append(item)
+                    item = item.get_pointer(b'next')
+                self.assertNotEqual([], expect)
+                self.assertEqual(expect, list(bf_utils.iter_ListBase(block.get_pointer(b'base.first'))))
+        finally:
+            bf.close()
+
+    def test_iter_array(self):
+        from bam.blend import blendfile
+        from bam.blend.blendfile_path_walker import bf_utils
+
+        bf = blendfile.open_blend(os.path.join(BLENDFILE_DIR, "cone.blend"))
+        header = bf.header
+        try:
+            blocks = bf.find_blocks_from_code(b'ME')
+            self.assertNotEqual(0, len(blocks))
+            for block in blocks:
+                array = block.get_pointer(b'mat')
+                array_len = block[b'totcol']
+                expect = [
+                    bf.find_block_from_offset(blendfile.DNA_IO.read_pointer_offset(
+                            bf.read_at(array.file_offset + (header.pointer_size * i), header.pointer_size), 0, header))
+                    for i in range(array_len)
+                    ]
+                self.assertNotIn(None, expect)
+                self.assertEqual(expect, list(bf_utils.iter_array(array, array_len)))
+        finally:
+            bf.close()
+
+    def _test_pointer_index(self, **kwargs):
+        from bam.blend import blendfile
+        from bam.blend.blendfile_path_walker import bf_utils
+
+        bf = blendfile.open_blend(os.path.join(BLENDFILE_DIR, "cone.blend"), **kwargs)
+        try:
+            index = bf.pointer_index()
+
+            # compare with reading each pointer field
+            expect = {}
+            for block in bf.blocks:
+                if block.sdna_index == 0:
+                    continue
+                layout = block.dna_type.pointer_layout(bf.header, blendfile.DNAStruct.pointer_is_reference)
+                if layout is None:
+                    continue
+                for base_index in range(block.count):
+                    for path, is_pointer_array in zip(layout[1], layout[2]):
+                        block_ref = block.get_pointer(path, base_index=base_index)
+                        if block_ref is None:
+                            continue
+                        expect.setdefault(block_ref.addr_old, []).append((block, path))
+                        if is_pointer_array and block_ref.sdna_index == 0:
+                            for block_item in bf_utils.iter_array(block_ref):
+                                if block_item is not None:
+                                    expect.setdefault(block_item.addr_old, []).append((block, path))
+            self.assertNotEqual({}, expect)
+            self.assertEqual(expect, index)
+
+            # materials are referenced through the meshes material array
+            block_mesh = bf.find_blocks_from_code(b'ME')[0]
+            block_material = bf.find_blocks_from_code(b'MA')[0]
+            self.assertIn((block_mesh, b'mat'), bf.find_blocks_referencing(block_material.addr_old))
+            block_object = bf.find_blocks_from_code(b'OB')[0]
+            self.assertIn((block_object, b'data'), bf.find_blocks_referencing(block_mesh.addr_old))
+
+            # the main database list isn't included
+            for references in index.values():
+                for _block, path in references:
+                    self.assertNotIn(path, {b'id.next', b'id.prev'})
+            # a brush nothing uses (only its neighbours in the list point to it)
+            block_brush = bf.id_name_index(b'BR')[b'BRClay Strips']
+            self.assertEqual([], bf.find_blocks_referencing(block_brush.addr_old))
+        finally:
+            bf.close()
+
+    def test_pointer_index(self):
+        self._test_pointer_index()
+
+    def test_pointer_index_mmap(self):
+        self._test_pointer_index(use_mmap=True)
+
+    def _write_blend_nodes_particles(self):
+        """
+        Write a blend file using the pointers the expand functions skip for some values.
+        """
+        import blendfile_synthetic
+
+        bw = blendfile_synthetic.BlendFileWriter()
+        image_addr = bw.block_add(b'IM', b'Image', {b'id.name': b'IMImage', b'name': b'//image.png'})
+        scene_other_addr = bw.block_add(b'SC', b'Scene', {b'id.name': b'SCOther'})
+
+        # a compositor using the other scene's render layers
+        nodes_addr = [bw.addr_alloc(bw.dna.structs[b'bNode'].size) for _ in range(2)]
+        for node_addr, node_addr_other, node_type, id_addr in (
+                (nodes_addr[0], nodes_addr[1], 221, scene_other_addr),  # CMP_NODE_R_LAYERS
+                (nodes_addr[1], nodes_addr[0], 220, image_addr),  # CMP_NODE_IMAGE
+                ):
+            bw.block_add(b'DATA', b'bNode', {
+                b'next': node_addr_other if node_addr == nodes_addr[0] else 0,
+                b'prev': node_addr_other if node_addr == nodes_addr[1] else 0,
+                b'id': id_addr,
+                b'type': node_type,
+                }, addr=node_addr)
+        nodetree_addr = bw.block_add(b'DATA', b'bNodeTree', {
+            b'nodes.first': nodes_addr[0],
+            b'nodes.last': nodes_addr[1],
+            })
+        bw.block_add(b'SC', b'Scene', {b'id.name': b'SCScene', b'nodetree': nodetree_addr})
+
+        # particles which use either the object or the group
+        object_dup_addr = bw.block_add(b'OB', b'Object', {b'id.name': b'OBDupli'})
+        group_object_addr = bw.block_add(b'DATA', b'GroupObject', {b'ob': object_dup_addr})
+        group_addr = bw.block_add(b'GR', b'Group', {
+            b'id.name': b'GRDupli',
+            b'gobject.first': group_object_addr,
+            b'gobject.last': group_object_addr,
+            })
+        psys_addr = [bw.addr_alloc(bw.dna.structs[b'ParticleSystem'].size) for _ in range(2)]
+        for i, (name, ren_as) in enumerate(((b'PAObject', 7), (b'PAGroup', 8))):  # PART_DRAW_OB, PART_DRAW_GR
+            part_addr = bw.block_add(b'PA', b'ParticleSettings', {
+                b'id.name': name,
+                b'ren_as': ren_as,
+                b'dup_ob': object_dup_addr,
+                b'dup_group': group_addr,
+                })
+            bw.block_add(b'DATA', b'ParticleSystem', {
+                b'next': psys_addr[1] if i == 0 else 0,
+                b'prev': psys_addr[0] if i == 1 else 0,
+                b'part': part_addr,
+                }, addr=psys_addr[i])
+        bw.block_add(b'OB', b'Object', {
+            b'id.name': b'OBEmitter',
+            b'particlesystem.first': psys_addr[0],
+            b'particlesystem.last': psys_addr[1],
+            })
+
+        filepath = os.path.join(self.dirpath, "nodes_particles.blend")
+        bw.write_file(filepath)
+        return filepath
+
+    def test_find_id_references(self):
+        from bam.blend import blendfile
+        from bam.blend.blendfile_path_walker import ExpandID
+
+        filepath_synthetic = self._write_blend_nodes_particles()
+        for filepath in (
+                os.path.join(BLENDFILE_DIR, "cone.blend"),
+                os.path.join(BLENDFILE_DIR, "lib_user.blend"),
+                filepath_synthetic,
+                ):
+            bf = blendfile.open_blend(filepath)
+            try:
+                for block in bf.blocks:
+                    fn = ExpandID.expand_funcs.get(block.code)
+                    if fn is None:
+                        continue
+                    references = bf.find_id_references(block, ExpandID.dna_pointer_exclude)
+                    self.assertEqual(len(references), len(set(references)))
+                    self.assertNotIn(block, references)
+                    # the same as the hand written expand functions
+                    self.assertEqual(
+                            {sub_block for sub_block in fn(block) if sub_block is not None},
+                            set(references))
+
+                for block_object in bf.find_blocks_from_code(b'OB'):
+                    block_data = block_object.get_pointer(b'data')
+                    if block_data is not None:
+                        self.assertIn(block_data, bf.find_id_references(block_object))
+            finally:
+                bf.close()
+
+        bf = blendfile.open_blend(filepath_synthetic)
+        try:
+            id_name_index = bf.id_name_index(b'SC')
+            # the render layers node isn't followed
+            block_scene = id_name_index[b'SCScene']
+            self.assertEqual(
+                    [bf.id_name_index(b'IM')[b'IMImage']],
+                    bf.find_id_references(block_scene, ExpandID.dna_pointer_exclude))
+            self.assertIn(id_name_index[b'SCOther'], bf.find_id_references(block_scene))
+            # particles only use the object or group they draw
+            for name, name_used in ((b'PAObject', b'OBDupli'), (b'PAGroup', b'GRDupli')):
+                self.assertEqual(
+                        [name_used],
+                        [sub_block[b'id.name'] for sub_block in bf.find_id_references(
+                                bf.id_name_index(b'PA')[name], ExpandID.dna_pointer_exclude)])
+        finally:
+            bf.close()
+
+    def test_get_all(self):
+        from bam.blend import blendfile
+
+        bf = blendfile.open_blend(os.path.join(BLENDFILE_DIR, "cone.blend"))
+        try:
+            block = bf.find_blocks_from_code(b'ME')[0].get_pointer(b'mvert')
+            self.assertGreater(block.count, 1)
+            for path in (b'co', b'no'):
+                self.assertEqual(
+                        [block.get(path, base_index=i) for i in range(block.count)],
+                        block.get_all(path))
+            self.assertEqual([None] * block.count, block.get_all(b'missing', None))
+        finally:
+            bf.close()
+
+    def test_as_dict_arrays(self):
+        import struct
+        from bam.blend import blendfile
+
+        bf = blendfile.open_blend(os.path.join(BLENDFILE_DIR, "cone.blend"))
+        try:
+            block = bf.find_blocks_from_code(b'ME')[0].get_pointer(b'mvert')
+            header = bf.header
+            stride = block.size // block.count
+            for base_index in range(block.count):
+                values = block.as_dict(base_index=base_index)
+                for path, fmt in ((b'co', '3f'), (b'no', '3h')):
+                    accessor = bf.field_accessor(block.sdna_index, path)
+                    data = bf.read_at(block.file_offset + (stride * base_index) + accessor.offset, 12)
+                    self.assertEqual(
+                            list(struct.unpack_from(header.endian_str.decode() + fmt, data)),
+                            values[path])
+                # single chars are numbers
+                data, ofs = block.read_data(base_index=base_index)
+                self.assertEqual(data[ofs + bf.field_accessor(block.sdna_index, b'flag').offset], values[b'flag'])
+
+            block = bf.find_blocks_from_code(b'OB')[0]
+            values = block.as_dict()
+            self.assertEqual(3, len(values[b'loc']))
+            self.assertEqual(block[b'loc'], values[b'loc'][0])
+            self.assertEqual(block[b'id.name'], values[b'id'][b'name'])
+        finally:
+            bf.close()
+
+    def test_as_array(self):
+        from bam.blend import blendfile
+
+        bf = blendfile.open_blend(os.path.join(BLENDFILE_DIR, "cone.blend"))
+        try:
+            block = bf.find_blocks_from_code(b'ME')[0].get_pointer(b'mvert')
+            array = block.as_array()
+            self.assertEqual(block.count, len(array))
+            try:
+                import numpy
+            except ImportError:
+                numpy = None
+            if numpy is None:
+                self.assertEqual((block.count, block.dna_type.size), array.shape)
+                self.assertEqual(bf.read_at(block.file_offset, block.size), array.tobytes())
+            else:
+                self.assertEqual(block.get_all(b'co'), [float(v) for v in array['co'][:, 0]])
+                self.assertEqual(block.get_all(b'no'), [int(v) for v in array['no'][:, 0]])
+        finally:
+            bf.close()
+
+    def test_get_all_empty(self):
+        import blendfile_synthetic
+        from bam.blend import blendfile
+
+        # a block without items
+        writer = blendfile_synthetic.BlendFileWriter()
+        addr = writer.block_add(b'DATA', b'Image', [])
+        filepath = os.path.join(self.dirpath, "empty.blend")
+        writer.write_file(filepath)
+
+        bf = blendfile.open_blend(filepath)
+        try:
+            block = bf.find_block_from_offset(addr)
+            self.assertEqual(0, block.count)
+            self.assertEqual([], block.get_all(b'id.name'))
+            self.assertEqual([], block.get_all(b'missing', None))
+            self.assertEqual(0, len(block.as_array()))
+        finally:
+            bf.close()
+
+    @unittest.skipUnless(NUMPY_FOUND, "NumPy not installed")
+    def test_numpy_dtype(self):
+        import numpy
+        from bam.blend import blendfile
+
+        bf = blendfile.open_blend(os.path.join(BLENDFILE_DIR, "cone.blend"))
+        try:
+            blocks = [bf.find_blocks_from_code(b'ME')[0].get_pointer(b'mvert')] + list(bf.find_blocks_from_code(b'OB'))
+            for block in blocks:
+                dna_struct = block.dna_type
+                dtype = dna_struct.numpy_dtype(bf.header, numpy)
+                self.assertEqual(dna_struct.size, dtype.itemsize)
+                array = block.as_array()
+                self.assertEqual(dtype, array.dtype)
+                self.assertEqual(block.count, len(array))
+
+                fields_found = 0
+                for field in dna_struct.fields:
+                    name = field.dna_name.name_only.decode('utf-8')
+                    if name not in dtype.names:
+                        continue
+                    self.assertEqual(field.dna_offset, dtype.fields[name][1])
+                    # types 'get_all' reads as numbers or strings
+                    is_string = field.dna_type.dna_type_id == b'char' and field.dna_name.array_size > 1
+                    if not (field.dna_name.is_pointer or is_string or
+                            field.dna_type.dna_type_id in {b'int', b'short', b'float'}):
+                        continue
+                    column = array[name]
+                    if is_string:
+                        column = [value.split(b'\0')[0] for value in column.tolist()]
+                    else:
+                        # as 'get' does, only compare the first item of arrays
+                        column = column.reshape(block.count, -1)[:, 0].tolist()
+                    self.assertEqual(block.get_all(field.dna_name.name_only), column)
+                    fields_found += 1
+                self.assertGreater(fields_found, 1)
+
+            # nested structs
+            for block in bf.find_blocks_from_code(b'OB'):
+                self.assertEqual(block[b'id.name'], block.as_array()['id']['name'][0])
+        finally:
+            bf.close()
+
+    def _test_id_name_index(self, **kwargs):
+        import shutil
+        from bam.blend import blendfile
+
+        filepath = os.path.join(self.dirpath, "cone.blend")
+        shutil.copyfile(os.path.join(BLENDFILE_DIR, "cone.blend"), filepath)
+        bf = blendfile.open_blend(filepath, "r+b", **kwargs)
+        try:
+            for code in (b'OB', b'ME', b'MA', b'SC'):
+                expect = {block[b'id.name']: block for block in bf.find_blocks_from_code(code)}
+                self.assertNotEqual({}, expect)
+                self.assertEqual(list(expect.items()), list(bf.id_name_index(code).items()))
+            self.assertEqual({}, bf.id_name_index(b'XX'))
+
+            # renaming updates the index
+            block = bf.find_blocks_from_code(b'OB')[0]
+            block[b'id.name'] = b'OBRenamed'
+            self.assertIs(block, bf.id_name_index(b'OB')[b'OBRenamed'])
+        finally:
+            bf.close()
+
+    def test_id_name_index(self):
+        self._test_id_name_index()
+
+    def test_id_name_index_journal(self):
+        self._test_id_name_index(use_journal=True)
+
+
+class BlendFileStatsTest(unittest.TestCase):
+
+    def test_stats(self):
+        from bam.blend import blendfile
+
+        stats = blendfile.stats_enable()
+        try:
+            bf = blendfile.open_blend(os.path.join(BLENDFILE_DIR, "lib_user.blend"))
+            # block headers are read in chunks (not one read each)
+            self.assertLess(stats.reads * 10, len(bf.blocks))
+            for block in bf.find_blocks_from_code(b'LI'):
+                block[b'name']
+            bf.close()
+        finally:
+            blendfile.stats_disable()
+
+        self.assertEqual(1, stats.files)
+        self.assertNotEqual(0, stats.reads)
+        self.assertNotEqual(0, stats.bytes_read)
+        self.assertEqual(1, stats.dna_decode + stats.dna_cache_hit)
+        self.assertEqual(stats.blocks[b'LI'], stats.fields[b'LI'])
+        self.assertNotEqual(0, stats.fields[b'LI'])
+        self.assertIn("fields: ", stats.report())
+
+        # disabled
+        self.assertIsNone(blendfile.stats_get())
+
+
+class BlendFileJournalTest(BlendFileTempTestCase):
+
+    def test_journal_apply(self):
+        from bam.blend.blendfile import BlendFileJournal
+
+        journal = BlendFileJournal()
+        journal.add(4, b'abcd')
+        journal.add(10, b'xyz')
+        # overlaps both (applied last)
+        journal.add(6, b'12345')
+        journal.add(20, b'w')
+
+        self.assertEqual(b'..ab12345yz.', journal.apply(2, b'............'))
+        self.assertEqual(b'12345y', journal.apply(6, b'......'))
+        self.assertEqual(b'...', journal.apply(13, b'...'))
+        self.assertEqual([(4, b'ab12345yz'), (20, b'w')], list(journal.iter_runs()))
+
+        # a shorter change at the same offset keeps the end of the previous one
+        journal = BlendFileJournal()
+        journal.add(0, b'longpath\0')
+        journal.add(4, b'XX')
+        journal.add(0, b'ab\0')
+        self.assertEqual(b'ab\0gXXth\0..', journal.apply(0, b'123456789..'))
+        self.assertEqual([(0, b'ab\0gXXth\0')], list(journal.iter_runs()))
+
+    def test_journal_file(self):
+        import shutil
+        import blendfile_synthetic
+        from bam.blend import blendfile
+
+        filepath = os.path.join(self.dirpath, "journal.blend")
+        blendfile_synthetic.write_blend(filepath, objects=2, images=20)
+        filepath_expect = os.path.join(self.dirpath, "expect.blend")
+        shutil.copy(filepath, filepath_expect)
+
+        with open(filepath, 'rb') as f:
+            data_orig = f.read()
+
+        # raw block data, before the changes are written
+        data_raw = []
+        for path, use_journal in ((filepath, True), (filepath_expect, False)):
+            bf = blendfile.open_blend(path, "r+b", use_journal=use_journal)
+            self.assertEqual(use_journal, bf.journal is not None)
+            for i, block in enumerate(bf.find_blocks_from_code(b'IM')):
+                block[b'name'] = b'//remap/%d.png' % i
+                # read back before it's written
+                self.assertEqual(b'//remap/%d.png' % i, block[b'name'])
+            # the same field written again with a shorter value
+            block = bf.find_blocks_from_code(b'IM')[0]
+            block[b'name'] = b'//a_much_longer_path/image.png'
+            block[b'name'] = b'//short.png'
+            self.assertEqual(b'//short.png', block[b'name'])
+            data_raw.append(bytes(bf.read_at(block.file_offset, block.size)))
+            bf.close()
+
+        with open(filepath, 'rb') as f:
+            data_journal = f.read()
+        with open(filepath_expect, 'rb') as f:
+            data_expect = f.read()
+        self.assertNotEqual(data_orig, data_journal)
+        self.assertEqual(data_expect, data_journal)
+        self.assertEqual(data_raw[1], data_raw[0])
+
+
+class BlendFileCompressTest(BlendFileTempTestCase):
+
+    def test_close_compressed(self):
+        import gzip
+        import blendfile_synthetic
+        from bam.blend import blendfile
+
+        chunk_size = blendfile.COMPRESS_CHUNK_SIZE
+        # ensure the file is split into many chunks
+        blendfile.COMPRESS_CHUNK_SIZE = 4096
+        try:
+            filepath = os.path.join(self.dirpath, "compress.blend")
+            blendfile_synthetic.write_blend(filepath, objects=50, images=50, use_gzip=True)
+
+            bf = blendfile.open_blend(filepath, "r+b")
+            for i, block in enumerate(bf.find_blocks_from_code(b'IM')):
+                block[b'name'] = b'//remap/%d.png' % i
+            bf.close(compress_level=6, compress_threads=4)
+
+            # a regular gzip file
+            with gzip.open(filepath, 'rb') as f:
+                self.assertEqual(b'BLENDER', f.read(7))
+
+            bf = blendfile.open_blend(filepath)
+            self.assertTrue(bf.is_compressed)
+            self.assertEqual(
+                    [b'//remap/%d.png' % i for i in range(50)],
+                    [block[b'name'] for block in bf.find_blocks_from_code(b'IM')])
+            bf.close()
+        finally:
+            blendfile.COMPRESS_CHUNK_SIZE = chunk_size
+
+    def test_decompress_memory_limit(self):
+        import gzip
+        import blendfile_synthetic
+        from bam.blend import blendfile
+
+        filepath = os.path.join(self.dirpath, "compress.blend")
+        blendfile_synthetic.write_blend(filepath, objects=50, images=50, use_gzip=True)
+        with gzip.open(filepath, 'rb') as f:
+            data_size = len(f.read())
+
+        memory_limit = blendfile.DECOMPRESS_MEMORY_LIMIT
+        try:
+            # decompressed into memory
+            blendfile.DecompressCache.clear()
+            blendfile.DECOMPRESS_MEMORY_LIMIT = data_size
+            bf = blendfile.open_blend(filepath)
+            self.assertIsNone(bf.handle)
+            self.assertEqual(data_size, len(bf.data))
+            expect = blend_read_all(bf)
+            bf.close()
+
+            # exceeds the limit, a temp file is used (and not cached)
+            blendfile.DECOMPRESS_MEMORY_LIMIT = data_size - 1
+            for use_mmap in (False, True):
+                blendfile.DecompressCache.clear()
+                bf = blendfile.open_blend(filepath, use_mmap=use_mmap)
+                self.assertIsNotNone(bf.handle)
+                self.assertEqual(use_mmap, bf.data is not None)
+                self.assertTrue(bf.is_compressed)
+                self.assertEqual(expect, blend_read_all(bf))
+                bf.close()
+                self.assertEqual(0, len(blendfile.DecompressCache.files))
+        finally:
+            blendfile.DECOMPRESS_MEMORY_LIMIT = memory_limit
+            blendfile.DecompressCache.clear()
+
+
+class BlendFileBufferTest(unittest.TestCase):
+
+    def test_from_buffer(self):
+        import gzip
+        from bam.blend import blendfile
+
+        filepath = os.path.join(BLENDFILE_DIR, "lib_user.blend")
+        bf = blendfile.open_blend(filepath)
+        expect = blend_read_all(bf)
+        bf.close()
+
+        with open(filepath, 'rb') as f:
+            data = f.read()
+
+        for data_test in (
+                data,
+                bytearray(data),
+                memoryview(b'\0' + data)[1:],
+                gzip.compress(data),
+                ):
+            bf = blendfile.BlendFile.from_buffer(data_test)
+            self.assertEqual(expect, blend_read_all(bf))
+            bf.close()
+
+    def test_from_zip(self):
+        import io
+        import zipfile
+        from bam.blend import blendfile
+        from bam.blend.blendfile_path_walker import FilePath
+
+        filepath = os.path.join(BLENDFILE_DIR, "lib_user.blend")
+        data_zip = io.BytesIO()
+        with zipfile.ZipFile(data_zip, 'w') as zip_handle:
+            zip_handle.write(filepath, "variations/lib_user.blend")
+
+        with zipfile.ZipFile(data_zip, 'r') as zip_handle:
+            bf = blendfile.BlendFile.from_zip(zip_handle, "variations/lib_user.blend")
+            paths = [
+                fp.filepath for fp, _extra_info in
+                FilePath.visit_from_blend(os.fsencode(filepath), blend=bf)]
+            bf.close()
+        self.assertEqual([b'//cone.blend'], paths)
+
+
+class DecompressCacheTest(BlendFileTempTestCase):
+
+    def setUp(self):
+        from bam.blend import blendfile
+        super().setUp()
+        blendfile.DecompressCache.clear()
+        self.cache_limit = blendfile.DECOMPRESS_CACHE_LIMIT
+
+    def tearDown(self):
+        from bam.blend import blendfile
+        blendfile.DECOMPRESS_CACHE_LIMIT = self.cache_limit
+        blendfile.DecompressCache.clear()
+        super().tearDown()
+
+    def test_decompress_cache_lru(self):
+        from bam.blend import blendfile
+        cache = blendfile.DecompressCache
+
+        blendfile.DECOMPRESS_CACHE_LIMIT = 30
+        for key in (b'a', b'b', b'c'):
+            cache.add(key, key * 10)
+        self.assertEqual([b'a', b'b', b'c'], list(cache.files))
+        self.assertEqual(30, cache.files_size)
+
+        # accessing an item makes it the most recently used
+        self.assertEqual(b'a' * 10, cache.get(b'a'))
+        self.assertIsNone(cache.get(b'x'))
+        cache.add(b'd', b'd' * 10)
+        self.assertEqual([b'c', b'a', b'd'], list(cache.files))
+        self.assertEqual(30, cache.files_size)
+
+        # replacing an item
+        cache.add(b'c', b'c' * 5)
+        self.assertEqual([b'a', b'd', b'c'], list(cache.files))
+        self.assertEqual(25, cache.files_size)
+
+        # larger than the limit, not added
+        cache.add(b'e', b'e' * 31)
+        self.assertEqual([b'a', b'd', b'c'], list(cache.files))
+
+        # several items removed to make room
+        cache.add(b'f', b'f' * 25)
+        self.assertEqual([b'c', b'f'], list(cache.files))
+        self.assertEqual(30, cache.files_size)
+
+        # disabled
+        cache.clear()
+        blendfile.DECOMPRESS_CACHE_LIMIT = 0
+        cache.add(b'a', b'a' * 10)
+        self.assertEqual(0, len(cache.files))
+
+    def test_decompress_cache_open(self):
+        import blendfile_synthetic
+        from bam.blend import blendfile
+
+        filepath = os.path.join(self.dirpath, "compress.blend")
+        blendfile_synthetic.write_blend(filepath, objects=5, images=5, use_gzip=True)
+
+        bf = blendfile.open_blend(filepath)
+        data = bf.data
+        expect = blend_read_all(bf)
+        bf.close()
+
+        # opening again uses the same data
+        bf = blendfile.open_blend(filepath)
+        self.assertIs(data, bf.data)
+        self.assertEqual(expect, blend_read_all(bf))
+        bf.close()
+
+        # modified files are decompressed again
+        os.utime(filepath, ns=(0, 0))
+        bf = blendfile.open_blend(filepath)
+        self.assertIsNot(data, bf.data)
+        self.assertEqual(data, bf.data)
+        bf.close()
+
+
+class DNACacheTest(BlendFileTempTestCase):
+
+    def setUp(self):
+        from bam.blend import blendfile
+        super().setUp()
+        blendfile.DNACache.clear()
+        blendfile.DNACache.cache_dir = os.path.join(self.dirpath, "dna")
+
+    def tearDown(self):
+        from bam.blend import blendfile
+        blendfile.DNACache.cache_dir = None
+        blendfile.DNACache.clear()
+        super().tearDown()
+
+    def _open_types(self):
+        """
+        Open a file without the in-process cache, return the struct names & number of times the DNA was decoded.
+        """
+        from bam.blend import blendfile
+        blendfile.DNACache.clear()
+        stats = blendfile.stats_enable()
+        try:
+            bf = blendfile.open_blend(os.path.join(BLENDFILE_DIR, "cone.blend"))
+            types = [dna_struct.dna_type_id for dna_struct in bf.structs]
+            bf.close()
+        finally:
+            blendfile.stats_disable()
+        return types, stats.dna_decode
+
+    def test_dna_cache(self):
+        import pickle
+        from bam.blend import blendfile
+
+        # miss (written to disk)
+        types_expect, dna_decode = self._open_types()
+        self.assertEqual(1, dna_decode)
+        filenames = os.listdir(blendfile.DNACache.cache_dir)
+        self.assertEqual(1, len(filenames))
+        self.assertTrue(filenames[0].endswith("_v%d.pickle" % blendfile.DNACache.VERSION))
+
+        # hit (loaded from disk)
+        self.assertEqual((types_expect, 0), self._open_types())
+
+        # corrupt files are decoded again (and replaced)
+        filepath = os.path.join(blendfile.DNACache.cache_dir, filenames[0])
+        for data in (b'corrupt', pickle.dumps(["not", "a", "catalog"])):
+            with open(filepath, 'wb') as f:
+                f.write(data)
+            self.assertEqual((types_expect, 1), self._open_types())
+            self.assertEqual((types_expect, 0), self._open_types())
+        self.assertEqual(filenames, os.listdir(blendfile.DNACache.cache_dir))
+
+
+class BlendFileProbeTest(BlendFileTempTestCase):
+
+    def _test_probe(self, filepath):
+        import json
+        from bam.blend import blendfile
+
+        probe = blendfile.probe(filepath)
+
+        bf = blendfile.open_blend(filepath)
+        try:
+            self.assertEqual(bf.is_compressed, probe.is_compressed)
+            self.assertEqual(bf.header.pointer_size, probe.pointer_size)
+            self.assertEqual(bf.header.is_little_endian, probe.is_little_endian)
+            self.assertEqual(bf.header.version, probe.version)
+            self.assertEqual(
+                    {code: len(blocks) for code, blocks in bf.code_index.items() if code != b'ENDB'},
+                    probe.block_counts)
+            for code, items in ((b'LI', probe.libraries), (b'IM', probe.images)):
+                self.assertEqual(
+                        [(block[b'id.name'], block[b'name'], bool(block[b'packedfile']))
+                         for block in bf.find_blocks_from_code(code)],
+                        items)
+        finally:
+            bf.close()
+
+        json.dumps(probe.as_dict())
+        return probe
+
+    def test_probe(self):
+        import gzip
+        import shutil
+
+        filepath = os.path.join(BLENDFILE_DIR, "lib_user.blend")
+        probe = self._test_probe(filepath)
+        self.assertEqual(1, probe.dependencies_count)
+
+        filepath_gzip = os.path.join(self.dirpath, "lib_user.blend")
+        with open(filepath, 'rb') as f_src, gzip.open(filepath_gzip, 'wb') as f_dst:
+            shutil.copyfileobj(f_src, f_dst)
+        self._test_probe(filepath_gzip)
+
+    def test_probe_synthetic(self):
+        import blendfile_synthetic
+
+        filepath = blendfile_synthetic.write_project(self.dirpath, objects=5, images=3, libraries=2)
+        probe = self._test_probe(filepath)
+        self.assertEqual(5, probe.dependencies_count)
+
+    def test_probe_truncated(self):
+        import blendfile_synthetic
+        from bam.blend import blendfile
+
+        filepath = os.path.join(self.dirpath, "truncated.blend")
+        blendfile_synthetic.write_blend(filepath, objects=2, images=2, libraries=(b'//lib.blend',))
+        with open(filepath, 'rb') as fh:
+            data = fh.read()
+        dna_offset = data.index(b'DNA1')
+        endb_offset = data.rindex(b'ENDB')
+
+        for data_test, message in (
+                # missing the DNA1 & ENDB blocks (with LI & IM blocks to read)
+                (data[:dna_offset], "ended before the ENDB block"),
+                (data[:dna_offset - 3], "ended before the ENDB block"),
+                (data[:dna_offset + 30], "ended before the ENDB block"),
+                (data[:endb_offset + 10], "ended before the ENDB block"),
+                # only missing the DNA1 block
+                (data[:dna_offset] + data[endb_offset:], "has no DNA1 block"),
+                ):
+            with open(filepath, 'wb') as fh:
+                fh.write(data_test)
+            with self.assertRaisesRegex(Exception, message):
+                blendfile.probe(filepath)
+            for use_mmap in (False, True):
+                with self.assertRaisesRegex(Exception, message):
+                    blendfile.open_blend(filepath, use_mmap=use_mmap)
+
+
+class BlendFileStreamTest(unittest.TestCase):
+
+    def _test_stream(self, data, chunk_size, structs=None):
+        from bam.blend import blendfile
+
+        stream = blendfile.BlendFileStream({b'LI': (b'name',), b'IM': (b'id.name', b'name')}, structs=structs)
+        headers = []
+        values = []
+        for i in range(0, len(data), chunk_size):
+            for block, block_values in stream.feed(data[i:i + chunk_size]):
+                if block_values is None:
+                    headers.append((block.code, block.addr_old, block.file_offset))
+                else:
+                    values.append((block.code, block_values))
+        stream.close()
+        return headers, values
+
+    def test_stream(self):
+        import gzip
+        from bam.blend import blendfile
+
+        filepath = os.path.join(BLENDFILE_DIR, "lib_user.blend")
+        bf = blendfile.open_blend(filepath)
+        headers_expect = [(block.code, block.addr_old, block.file_offset) for block in bf.blocks[:-1]]
+        values_expect = [
+            (block.code, {b'name': block[b'name']} if block.code == b'LI' else
+             {b'id.name': block[b'id.name'], b'name': block[b'name']})
+            for block in bf.blocks if block.code in {b'LI', b'IM'}]
+        self.assertNotEqual([], values_expect)
+        structs = bf.structs
+        bf.close()
+
+        with open(filepath, 'rb') as f:
+            data = f.read()
+
+        for data_test in (data, gzip.compress(data)):
+            for chunk_size in (1, 1000, len(data_test)):
+                self.assertEqual((headers_expect, values_expect), self._test_stream(data_test, chunk_size))
+
+        # with a known DNA catalog, values don't wait for the DNA1 block (at the end of the file)
+        self.assertEqual((headers_expect, values_expect), self._test_stream(data, 4096, structs=structs))
+
+    def test_stream_incomplete(self):
+        from bam.blend import blendfile
+
+        with open(os.path.join(BLENDFILE_DIR, "lib_user.blend"), 'rb') as f:
+            data = f.read()
+        stream = blendfile.BlendFileStream({})
+        for _ in stream.feed(data[:len(data) // 2]):
+            pass
+        self.assertRaises(Exception, stream.close)
+
+
+class BlendFileSyntheticTest(BlendFileTempTestCase):
+    """
+    Read files written by 'blendfile_synthetic'.
+    """
+
+    def _test_project(self, **kwargs):
+        import blendfile_synthetic
+        from bam.blend import blendfile
+        from bam.blend.blendfile_path_walker import FilePath, bf_utils
+
+        filepath = blendfile_synthetic.write_project(self.dirpath, objects=5, images=3, libraries=2, **kwargs)
+
+        bf = blendfile.open_blend(filepath)
+        self.assertEqual(
+                [b'OBobject_%05d' % i for i in range(5)],
+                [block[b'id.name'] for block in bf.find_blocks_from_code(b'OB')])
+        scene = bf.find_blocks_from_code(b'SC')[0]
+        self.assertEqual(
+                [block.addr_old for block in bf.find_blocks_from_code(b'OB')],
+                [base[b'object'] for base in bf_utils.iter_ListBase(scene.get_pointer(b'base.first'))])
+        bf.close()
+
+        paths = sorted(fp.filepath for fp, _extra_info in FilePath.visit_from_blend(filepath, readonly=True, recursive=True))
+        self.assertEqual(sorted(
+                [b'//textures/image_%05d.png' % i for i in range(3)] +
+                [b'//lib/lib_%02d.blend' % i for i in range(2)] +
+                # only the linked images are used from libraries
+                [b'//textures/lib_%02d_image_%05d.png' % (j, i) for j in range(2) for i in range(2)]),
+                paths)
+
+    def test_project(self):
+        self._test_project()
+
+    def test_project_gzip(self):
+        self._test_project(use_gzip=True)
+
+    def test_project_32bit_big_endian(self):
+        self._test_project(pointer_size=4, is_little_endian=False)
+
+    def test_read_pointers(self):
+        import struct
+        import blendfile_synthetic
+        from bam.blend import blendfile
+
+        for pointer_size in (4, 8):
+            for is_little_endian in (True, False):
+                writer = blendfile_synthetic.BlendFileWriter(pointer_size=pointer_size, is_little_endian=is_little_endian)
+                addr_list = [0x10000 + (i * 0x1234) for i in range(1000)]
+                addr_list[-1] = (1 << (pointer_size * 8)) - 0x100
+                addr = writer.block_add_pointers(addr_list)
+                filepath = os.path.join(self.dirpath, "pointers.blend")
+                writer.write_file(filepath)
+
+                for use_mmap in (False, True):
+                    bf = blendfile.open_blend(filepath, use_mmap=use_mmap)
+                    try:
+                        block = bf.find_block_from_offset(addr)
+                        self.assertEqual(addr_list, list(bf.read_pointers(block.file_offset, len(addr_list))))
+                        self.assertEqual(addr_list[:3], list(bf.read_pointers(block.file_offset, 3)))
+                        with self.assertRaises(struct.error):
+                            bf.read_pointers(block.file_offset, 1 << 16)
+                    finally:
+                        bf.close()
+
+
+class BlendFileVisitTest(BlendFileTempTestCase):
+
+    project = dict(objects=5, images=3, libraries=3)
+
+    def test_visit_callbacks(self):
+        from bam.blend.blendfile_path_walker import FilePath
+
+        filepath = self.filepath
+        filepaths_lib = [os.path.join(self.dirpath.encode(), b'lib', b'lib_%02d.blend' % i) for i in range(3)]
+
+        events = []
+        progress = []
+        for _ in FilePath.visit_from_blend(
+                filepath, readonly=True, recursive=True,
+                blendfile_level_cb=(
+                    lambda filepath: events.append(("enter", filepath)),
+                    lambda filepath: events.append(("exit", filepath)),
+                    ),
+                progress_cb=lambda *args: progress.append(args),
+                ):
+            pass
+
+        # libraries are walked depth first, in order
+        events_expect = [("enter", filepath)]
+        for filepath_lib in filepaths_lib:
+            events_expect += [("enter", filepath_lib), ("exit", filepath_lib)]
+        events_expect.append(("exit", filepath))
+        self.assertEqual(events_expect, events)
+
+        self.assertEqual(
+                [(filepath, 0, 0)] + [(filepath_lib, 1, i + 1) for i, filepath_lib in enumerate(filepaths_lib)],
+                [(filepath_item, level, files_visited) for filepath_item, level, files_visited, _ in progress])
+
+
+def visit_from_blend_all(filepath, **kwargs):
+    """
+    Visit all paths (recursively), returning a list of their details & the binary edits to remap them.
+    """
+    from bam.blend.blendfile_path_walker import FilePath
+
+    result = []
+    for fp, extra_info in FilePath.visit_from_blend(filepath, readonly=True, recursive=True, **kwargs):
+        binary_edits = []
+        fp.filepath_assign_edits(b'//remap/' + os.path.basename(fp.filepath), binary_edits)
+        result.append((extra_info, fp.level, fp.is_sequence, fp.filepath_absolute, binary_edits))
+    return result
+
+
+class BlendFileVisitExecutorTest(BlendFileTempTestCase):
+
+    project = dict(objects=5, images=3, libraries=4)
+
+    def test_visit_executor(self):
+        import concurrent.futures
+        from bam.blend.blendfile_path_walker import FilePath
+
+        filepath = self.filepath
+        result_expect = visit_from_blend_all(filepath)
+        self.assertEqual(4, len({extra_info for extra_info, level, *_ in result_expect if level == 1}))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=THREAD_COUNT) as executor:
+            self.assertEqual(result_expect, visit_from_blend_all(filepath, executor=executor, ordered=True))
+            self.assertEqual(sorted(result_expect), sorted(visit_from_blend_all(filepath, executor=executor)))
+
+        self.assertRaises(RuntimeError, lambda: list(FilePath.visit_from_blend(
+                filepath, readonly=False, recursive=True, executor=executor)))
+
+
+class BlendFileVisitMultiLevelTest(BlendFileTempTestCase):
+
+    def setUp(self):
+        import blendfile_synthetic
+        super().setUp()
+
+        # main.blend -> lib/lib_00.blend -> lib/lib_01.blend
+        # (an object linked from 'lib_00' uses a mesh linked from 'lib_01'),
+        # each library has more images than are linked from it.
+        dirpath = os.fsencode(self.dirpath)
+        os.makedirs(os.path.join(dirpath, b'lib'))
+        for lib_path, libraries in ((b'lib/lib_01.blend', ()), (b'lib/lib_00.blend', (b'//lib_01.blend',))):
+            blendfile_synthetic.write_blend(
+                    os.path.join(dirpath, lib_path),
+                    objects=3, images=3,
+                    libraries=libraries, library_meshes=len(libraries),
+                    name_prefix=blendfile_synthetic.library_name_prefix(lib_path))
+        self.filepath = os.path.join(dirpath, b'main.blend')
+        blendfile_synthetic.write_blend(self.filepath, objects=3, images=3, libraries=(b'//lib/lib_00.blend',))
+
+    def test_visit_recursive_all(self):
+        import concurrent.futures
+
+        filepath = self.filepath
+        filepath_lib = os.path.join(os.path.dirname(filepath), b'lib', b'lib_01.blend')
+        lib_visit = {}
+        result_expect = visit_from_blend_all(filepath, lib_visit=lib_visit)
+
+        # only the images linked from each library are used
+        self.assertEqual(
+                [(1, b'lib_00_image_00000.png'), (1, b'lib_00_image_00001.png'), (1, b'lib_01.blend')],
+                sorted((level, os.path.basename(filepath_absolute))
+                       for extra_info, level, is_sequence, filepath_absolute, binary_edits in result_expect
+                       if level > 0))
+        # only the mesh (and its material) is used from the second level library
+        self.assertEqual({b'MElib_01_mesh_00000', b'MAlib_01_material_000'}, lib_visit[filepath_lib])
+
+        # 'recursive_all' doesn't change how libraries are expanded
+        lib_visit_expect = lib_visit
+        lib_visit = {}
+        self.assertEqual(result_expect, visit_from_blend_all(filepath, recursive_all=True, lib_visit=lib_visit))
+        self.assertEqual(lib_visit_expect, lib_visit)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=THREAD_COUNT) as executor:
+            for recursive_all in (False, True):
+                lib_visit = {}
+                self.assertEqual(result_expect, visit_from_blend_all(
+                        filepath, recursive_all=recursive_all, executor=executor, ordered=True, lib_visit=lib_visit))
+                self.assertEqual(lib_visit_expect, lib_visit)
+
+
+    def test_visit_dna(self):
+        from bam.blend.blendfile_path_walker import ExpandID, LibraryExpandCache
+
+        filepath = self.filepath
+        LibraryExpandCache.clear()
+        lib_visit_expand = {}
+        result_expand = visit_from_blend_all(filepath, lib_visit=lib_visit_expand)
+        entries_len = len(LibraryExpandCache.entries)
+        self.assertNotEqual(0, entries_len)
+
+        ExpandID.use_dna = True
+        try:
+            lib_visit_dna = {}
+            result_dna = visit_from_blend_all(filepath, lib_visit=lib_visit_dna)
+            # cached separately from the built-in rules
+            self.assertEqual(entries_len * 2, len(LibraryExpandCache.entries))
+        finally:
+            ExpandID.use_dna = False
+            LibraryExpandCache.clear()
+
+        # the DNA finds (at least) the same dependencies
+        self.assertLessEqual(
+                {filepath_absolute for _, _, _, filepath_absolute, _ in result_expand},
+                {filepath_absolute for _, _, _, filepath_absolute, _ in result_dna})
+        self.assertEqual(set(lib_visit_expand), set(lib_visit_dna))
+        for lib_path, lib_block_codes in lib_visit_expand.items():
+            self.assertLessEqual(lib_block_codes, lib_visit_dna[lib_path])
+
+
+class BlendFileVisitDeepTest(BlendFileTempTestCase):
+    """
+    Nesting deeper than the recursion limit.
+    """
+
+    def setUp(self):
+        import sys
+        import blendfile_synthetic
+        super().setUp()
+
+        self.depth = sys.getrecursionlimit() + 10
+        dirpath = os.fsencode(self.dirpath)
+
+        def lib_path(i):
+            return b'//lib_%05d.blend' % i
+
+        # main.blend: a scene using nested meta strips
+        bw = blendfile_synthetic.BlendFileWriter()
+        scene_other_addr = bw.block_add(b'SC', b'Scene', {b'id.name': b'SCOther'})
+        stripdata_addr = bw.block_add(b'DATA', b'StripElem', {b'name': b'movie.avi'})
+        strip_addr = bw.block_add(b'DATA', b'Strip', {b'dir': b'//movies/', b'stripdata': stripdata_addr})
+        seq_size = bw.dna.structs[b'Sequence'].size
+        seq_scene_addr = bw.block_add(b'DATA', b'Sequence', {b'type': 2, b'scene': scene_other_addr})
+        seq_addr = bw.addr_alloc(seq_size)
+        bw.block_add(b'DATA', b'Sequence', {b'type': 3, b'strip': strip_addr, b'next': seq_scene_addr}, addr=seq_addr)
+        for _ in range(self.depth):
+            seq_addr = bw.block_add(b'DATA', b'Sequence', {
+                b'type': 1,  # SEQ_TYPE_META
+                b'seqbase.first': seq_addr,
+                b'seqbase.last': seq_addr,
+                })
+        editing_addr = bw.block_add(b'DATA', b'Editing', {b'seqbase.first': seq_addr, b'seqbase.last': seq_addr})
+        bw.block_add(b'SC', b'Scene', {b'id.name': b'SCScene', b'ed': editing_addr})
+
+        # each file uses a mesh (its 'texcomesh') from the next library
+        for i in range(self.depth + 1):
+            if i != 0:
+                bw = blendfile_synthetic.BlendFileWriter()
+            values = {b'id.name': b'MEmesh'}
+            if i != self.depth:
+                lib_addr = bw.block_add(b'LI', b'Library', {
+                    b'id.name': b'LI' + lib_path(i + 1)[2:], b'name': lib_path(i + 1), b'filepath': lib_path(i + 1)})
+                values[b'texcomesh'] = bw.block_add(b'ID', b'ID', {b'name': b'MEmesh', b'lib': lib_addr})
+            bw.block_add(b'ME', b'Mesh', values)
+            bw.write_file(os.path.join(dirpath, b'main.blend' if i == 0 else lib_path(i)[2:]))
+        self.filepath = os.path.join(dirpath, b'main.blend')
+
+    def test_visit_deep(self):
+        from bam.blend import blendfile
+        from bam.blend.blendfile_path_walker import ExpandID
+
+        lib_visit = {}
+        result = visit_from_blend_all(self.filepath, lib_visit=lib_visit)
+        self.assertEqual(
+                [b'movie.avi', b'lib_00001.blend'],
+                [os.path.basename(filepath_absolute) for _, level, _, filepath_absolute, _ in result if level == 0])
+        # each library links the next
+        self.assertEqual(
+                [(level, b'lib_%05d.blend' % (level + 1)) for level in range(1, self.depth)],
+                [(level, os.path.basename(filepath_absolute))
+                 for _, level, _, filepath_absolute, _ in result if level != 0])
+        self.assertEqual(
+                {b'MEmesh'},
+                lib_visit[os.path.join(os.path.dirname(self.filepath), b'lib_%05d.blend' % self.depth)])
+
+        bf = blendfile.open_blend(self.filepath)
+        try:
+            id_name_index = bf.id_name_index(b'SC')
+            self.assertIn(id_name_index[b'SCOther'], list(ExpandID.expand_SC(id_name_index[b'SCScene'])))
+        finally:
+            bf.close()
+
+
+class BlendFileIndexTest(BlendFileTempTestCase):
+
+    project = dict(objects=5, images=3, libraries=2)
+
+    def test_index(self):
+        from bam.blend import blendfile
+        from bam.blend.blendfile_path_walker import BlendFileIndex, ExpandID, LibraryExpandCache
+
+        filepath = self.filepath
+        result_expect = visit_from_blend_all(filepath)
+        self.assertNotEqual([], result_expect)
+
+        # so libraries are read
+        LibraryExpandCache.clear()
+        BlendFileIndex.cache_dir = os.path.join(self.dirpath, "index")
+        try:
+            # write the index
+            self.assertEqual(result_expect, visit_from_blend_all(filepath))
+            self.assertEqual(3, len(os.listdir(BlendFileIndex.cache_dir)))
+
+            # read the index (without opening any blend files)
+            stats = blendfile.stats_enable()
+            try:
+                self.assertEqual(result_expect, visit_from_blend_all(filepath))
+            finally:
+                blendfile.stats_disable()
+            self.assertEqual(0, stats.files)
+
+            # modified files are read again
+            filepath_lib = os.path.join(self.dirpath.encode(), b'lib', b'lib_00.blend')
+            os.utime(filepath_lib, ns=(0, 0))
+            stats = blendfile.stats_enable()
+            try:
+                self.assertEqual(result_expect, visit_from_blend_all(filepath))
+            finally:
+                blendfile.stats_disable()
+            self.assertEqual(1, stats.files)
+
+            # the ExpandID mode is part of the key
+            LibraryExpandCache.clear()
+            ExpandID.use_dna = True
+            try:
+                stats = blendfile.stats_enable()
+                try:
+                    self.assertEqual(result_expect, visit_from_blend_all(filepath))
+                finally:
+                    blendfile.stats_disable()
+            finally:
+                ExpandID.use_dna = False
+            self.assertEqual(3, stats.files)
+        finally:
+            BlendFileIndex.cache_dir = None
+
+    def test_index_untrusted(self):
+        import pickle
+        from bam.blend.blendfile_path_walker import BlendFileIndex
+
+        filepath_marker = os.path.join(self.dirpath, "marker")
+
+        class Exploit:
+            def __reduce__(self):
+                return (open, (filepath_marker, 'w'))
+
+        BlendFileIndex.cache_dir = os.path.join(self.dirpath, "index")
+        try:
+            BlendFileIndex.from_cache(self.filepath)
+            filepath_index, = [
+                os.path.join(BlendFileIndex.cache_dir, filename)
+                for filename in os.listdir(BlendFileIndex.cache_dir)]
+            for data in (b'corrupt', pickle.dumps(Exploit())):
+                with open(filepath_index, 'wb') as fh:
+                    fh.write(data)
+                self.assertEqual(self.filepath, BlendFileIndex.from_cache(self.filepath).filepath)
+                # pickle data is never loaded
+                self.assertFalse(os.path.exists(filepath_marker))
+        finally:
+            BlendFileIndex.cache_dir = None
+
+    def test_index_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from bam.blend.blendfile_path_walker import BlendFileIndex
+
+        BlendFileIndex.cache_dir = os.path.join(self.dirpath, "index")
+        try:
+            # threads writing the same index at once
+            with ThreadPoolExecutor(max_workers=THREAD_COUNT) as executor:
+                futures = [
+                    executor.submit(BlendFileIndex.from_cache, self.filepath)
+                    for _ in range(THREAD_COUNT * 4)]
+                for f in futures:
+                    self.assertEqual(self.filepath, f.result().filepath)
+            self.assertEqual(1, len(os.listdir(BlendFileIndex.cache_dir)))
+            self.assertEqual(self.filepath, BlendFileIndex.from_cache(self.filepath).filepath)
+        finally:
+            BlendFileIndex.cache_dir = None
+
+
+class LibraryExpandCacheTest(BlendFileTempTestCase):
+
+    project = dict(objects=5, images=3, libraries=2)
+
+    def tearDown(self):
+        from bam.blend.blendfile_path_walker import LibraryExpandCache
+        LibraryExpandCache.clear()
+        super().tearDown()
+
+    def test_library_expand_cache(self):
+        import shutil
+        from bam.blend import blendfile
+        from bam.blend.blendfile_path_walker import LibraryExpandCache
+
+        filepath = self.filepath
+        # a second shot, linking the same libraries
+        filepath_other = os.path.join(os.path.dirname(filepath), b'other.blend')
+        shutil.copy(filepath, filepath_other)
+
+        entries_size_max = LibraryExpandCache.entries_size_max
+        LibraryExpandCache.entries_size_max = 0
+        try:
+            result_expect = visit_from_blend_all(filepath)
+            result_expect_other = visit_from_blend_all(filepath_other)
+        finally:
+            LibraryExpandCache.entries_size_max = entries_size_max
+        self.assertNotEqual([], [item for item in result_expect if item[1] > 0])
+
+        LibraryExpandCache.clear()
+        self.assertEqual(result_expect, visit_from_blend_all(filepath))
+        self.assertNotEqual(0, len(LibraryExpandCache.entries))
+
+        # only the shot is read
+        stats = blendfile.stats_enable()
+        try:
+            self.assertEqual(result_expect_other, visit_from_blend_all(filepath_other))
+        finally:
+            blendfile.stats_disable()
+        self.assertEqual(1, stats.files)
+
+        # modified libraries are read again
+        filepath_lib = os.path.join(self.dirpath.encode(), b'lib', b'lib_00.blend')
+        os.utime(filepath_lib, ns=(0, 0))
+        stats = blendfile.stats_enable()
+        try:
+            self.assertEqual(result_expect, visit_from_blend_all(filepath))
+        finally:
+            blendfile.stats_disable()
+        self.assertEqual(2, stats.files)
+
+    def test_library_expand_cache_size(self):
+        from bam.blend.blendfile_path_walker import LibraryExpandCache
+
+        def entries_size_check():
+            self.assertEqual(
+                    sum(entry[3] for entry in LibraryExpandCache.entries.values()),
+                    LibraryExpandCache.entries_size)
+            self.assertLessEqual(LibraryExpandCache.entries_size, LibraryExpandCache.entries_size_max)
+
+        LibraryExpandCache.clear()
+        result_expect = visit_from_blend_all(self.filepath)
+        entries_len = len(LibraryExpandCache.entries)
+        entries_size = LibraryExpandCache.entries_size
+        self.assertGreater(entries_len, 1)
+        entries_size_check()
+
+        # least recently used entries are removed to fit the limit
+        entries_size_max = LibraryExpandCache.entries_size_max
+        LibraryExpandCache.entries_size_max = entries_size - 1
+        try:
+            LibraryExpandCache.clear()
+            self.assertEqual(result_expect, visit_from_blend_all(self.filepath))
+            self.assertLess(len(LibraryExpandCache.entries), entries_len)
+            self.assertNotEqual(0, len(LibraryExpandCache.entries))
+            entries_size_check()
+
+            # entries larger than the limit aren't added
+            LibraryExpandCache.entries_size_max = 1
+            LibraryExpandCache.clear()
+            self.assertEqual(result_expect, visit_from_blend_all(self.filepath))
+            self.assertEqual(0, len(LibraryExpandCache.entries))
+            entries_size_check()
+        finally:
+            LibraryExpandCache.entries_size_max = entries_size_max
+
+        LibraryExpandCache.clear()
+        self.assertEqual(0, LibraryExpandCache.entries_size)
+
+
+class DirectoryCacheTest(BlendFileTempTestCase):
+
+    def test_directory_cache(self):
+        from bam.blend.blendfile_path_walker import DirectoryCache, utils
+
+        dirpath = self.dirpath.encode()
+        names = [b'render_%04d.png' % i for i in range(1, 6)] + [
+            b'render_0001.exr', b'render_.png', b'render_00x1.png', b'other_0001.png', b'notes.txt']
+        for name in names:
+            with open(os.path.join(dirpath, name), 'wb'):
+                pass
+        os.mkdir(os.path.join(dirpath, b'subdir'))
+
+        filepath = os.path.join(dirpath, b'render_0003.png')
+        expect = sorted(os.path.join(dirpath, b'render_%04d.png' % i) for i in range(1, 6))
+        self.assertEqual(expect, sorted(utils.find_sequence_paths(filepath)))
+        self.assertEqual([], utils.find_sequence_paths(os.path.join(dirpath, b'notes.txt')))
+        self.assertEqual([], utils.find_sequence_paths(os.path.join(dirpath, b'missing', b'render_0001.png')))
+        self.assertEqual(
+                [os.fsdecode(f) for f in expect],
+                sorted(utils.find_sequence_paths(os.fsdecode(filepath))))
+
+        dir_cache = DirectoryCache()
+        self.assertEqual(expect, sorted(utils.find_sequence_paths(filepath, dir_cache=dir_cache)))
+        self.assertEqual(
+                [os.path.basename(f) for f in expect],
+                sorted(utils.find_sequence_paths(filepath, use_fullpath=False, dir_cache=dir_cache)))
+        for name in names + [b'subdir', b'missing.png']:
+            path = os.path.join(dirpath, name)
+            self.assertEqual(os.path.exists(path), dir_cache.exists(path))
+            self.assertEqual(os.path.isdir(path), dir_cache.isdir(path))
+        self.assertTrue(dir_cache.exists(dirpath))
+
+        # the directory is only read once
+        os.remove(filepath)
+        self.assertTrue(dir_cache.exists(filepath))
+        self.assertEqual(expect, sorted(utils.find_sequence_paths(filepath, dir_cache=dir_cache)))
+        self.assertFalse(DirectoryCache().exists(filepath))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -64,6 +64,10 @@ class DirectoryAPI(Resource):
             return jsonify(message="Path is not a directory %r" % path_root_abs)
 
         items_list = []
+        # {f_rel: summary} for blend files
+        blend_info = {}
+
+        from bam.blend import blendfile
 
         for f in os.listdir(path_root_abs):
 
@@ -78,10 +82,16 @@ class DirectoryAPI(Resource):
                 items_list.append((f, f_rel, "dir"))
             else:
                 items_list.append((f, f_rel, "file"))
+                if f.endswith(".blend"):
+                    try:
+                        blend_info[f_rel] = blendfile.probe(f_abs).as_dict()
+                    except Exception as e:
+                        log.info("Failed to probe blend file %r: %s" % (f_abs, e))
 
         project_files = {
             "parent_path": parent_path,
             "items_list": items_list,
+            "blend_info": blend_info,
             }
 
         return jsonify(project_files)